@@ -0,0 +1,886 @@
+"""End-to-end benchmarks for the optical transfer pipeline.
+
+    python -m benchmarks.bench                     # run, compare with benchmarks/baseline.json
+    python -m benchmarks.bench --quick --only grid,fec
+    python -m benchmarks.bench --save-baseline     # record this machine's results as the baseline
+
+Results are written as JSON (with machine info). Every metric records
+whether higher or lower is better; a metric that is worse than the
+baseline by more than --tolerance is reported as a regression and makes
+the run exit with status 1. Metrics with a fixed limit (such as heavy
+modules loaded by an entry point) fail whenever they exceed it.
+"""
+import argparse, json, os, platform, random, shutil, statistics, subprocess, sys, tempfile, time
+from typing import Callable, Dict
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from file_transfer.core.manifest import build_manifest
+from file_transfer.core.chunking import DEFAULT_LEAF_SIZE
+from file_transfer.core.source import ChunkSource
+from file_transfer.core.assembly import FileAssembler
+from file_transfer.core.encoding_grid import encode_grid_frame, frame_payload_size, FRAME_PAYLOAD_SIZE
+from file_transfer.core.decoding_grid import decode_grid_image, PaletteLUT
+from file_transfer.core.encoding_qr import manifest_to_qr_frames
+from file_transfer.core.channel import ChannelSimulator
+from file_transfer.core.fec import xor_parity
+from file_transfer.core.tiling import decode_mosaic, iter_mosaics, parse_layout, render_frame
+from file_transfer.core.combining import SoftCombiner, soft_evidence
+from file_transfer.core.security import ChunkCipher, EncryptedSource, TAG_SIZE
+from file_transfer.core.carousel import SCHEDULERS, Carousel, lead_frames
+from file_transfer.core.archive import FrameArchive, write_archive
+from file_transfer.core.profiling import PROFILER
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_TOLERANCE = 0.15  # fraction a metric may worsen before it counts as a regression
+COMBINE_CAPTURES = 6  # captures of each frame in the combining benchmark
+SCHEDULE_CYCLES = 20  # the schedule benchmark gives up on a receiver after this many cycles
+ARCHIVE_PNG_FRAMES = 50  # frames saved as PNG to estimate the size of a PNG folder
+SPARSE_DATA_FRACTION = 0.1  # share of the sparse benchmark's disk image that is not zeros
+# name -> (digest, digest bytes, Merkle leaf size); the first is how manifests were hashed before the options existed
+DIGEST_OPTIONS = {
+    'sha256_chunk_leaves': ('sha256', None, FRAME_PAYLOAD_SIZE),
+    'sha256': ('sha256', None, DEFAULT_LEAF_SIZE),
+    'sha256_16': ('sha256', 16, DEFAULT_LEAF_SIZE),
+    'blake2b': ('blake2b', None, DEFAULT_LEAF_SIZE),
+    'blake2b_16': ('blake2b', 16, DEFAULT_LEAF_SIZE),
+    'blake2s_16': ('blake2s', 16, DEFAULT_LEAF_SIZE),
+}
+PRIORITY_WINDOW = 0.5  # share of a cycle the priority benchmark's receiver films
+PRIORITY_LOSS = 0.02  # slots the priority benchmark's receiver misses
+# name -> (order, priority patterns) compared by the priority benchmark
+PRIORITY_POLICIES = {'path': ('path', ()), 'size': ('size', ()), 'priority': ('path', ('urgent/*',))}
+DIGEST_BLOCK_SIZE = 4096  # small dedup blocks, so block digests make up most of the manifest
+# Entry point -> (module, heavy modules its import must not load)
+IMPORT_TARGETS = {
+    'receiver_cli': ('receiver_cli', ('cv2', 'pyzbar', 'segno', 'PySide6', 'cryptography')),
+    'sender_cli': ('sender_cli', ('cv2', 'pyzbar', 'segno', 'PySide6', 'cryptography')),
+    'decoding_grid': ('file_transfer.core.decoding_grid', ('cv2', 'pyzbar', 'segno')),
+    'sender_app': ('file_transfer.gui.sender_app', ('cv2', 'pyzbar')),
+    'receiver_app': ('file_transfer.gui.receiver_app', ('pyzbar', 'segno')),
+}
+
+
+def machine_info() -> Dict:
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+def rate(fn: Callable[[], object], min_time: float, units: float = 1.0) -> float:
+    """Median calls (times units) per second over runs of at least min_time seconds."""
+    fn()  # warm-up
+    rates = []
+    for _ in range(3):
+        n, start = 0, time.perf_counter()
+        while True:
+            fn()
+            n += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / 3:
+                break
+        rates.append(n * units / elapsed)
+    return statistics.median(rates)
+
+
+def metric(value: float, unit: str, better: str = 'higher', limit: float = None) -> Dict:
+    m = {'value': round(value, 3), 'unit': unit, 'better': better}
+    if limit is not None:
+        m['limit'] = limit
+    return m
+
+
+def make_corpus(root: str, size: int, seed: int = 0):
+    """A folder of mixed content: random (incompressible), text and CSV-like data."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root, 'logs'), exist_ok=True)
+    with open(os.path.join(root, 'random.bin'), 'wb') as f:
+        f.write(rng.randbytes(size // 3))
+    with open(os.path.join(root, 'logs', 'app.log'), 'w') as f:
+        levels = ['INFO', 'DEBUG', 'WARN']
+        while f.tell() < size // 3:
+            f.write(f"2024-01-{rng.randint(1, 28):02d} {rng.choice(levels)} request {rng.randint(0, 10**6)} done\n")
+    with open(os.path.join(root, 'table.csv'), 'w') as f:
+        while f.tell() < size // 3:
+            f.write(','.join(str(rng.randint(0, 9999)) for _ in range(8)) + '\n')
+
+
+def bench_grid(cfg) -> Dict:
+    payloads = [os.urandom(FRAME_PAYLOAD_SIZE) for _ in range(16)]
+    frames = [encode_grid_frame(p, seq=i, chunk_idx=i) for i, p in enumerate(payloads)]
+    sim = ChannelSimulator(seed=1)
+    captures = [sim.capture(i, f) for i, f in enumerate(frames)]
+    bgr_captures = [(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), corners) for rgb, corners in captures]
+    captures = [(Image.fromarray(rgb), corners) for rgb, corners in captures]
+    it = {'enc': 0, 'dec': 0, 'cap': 0, 'bgr': 0}
+
+    def encode():
+        i = it['enc'] = (it['enc'] + 1) % len(payloads)
+        encode_grid_frame(payloads[i], seq=i, chunk_idx=i)
+
+    def decode():
+        i = it['dec'] = (it['dec'] + 1) % len(frames)
+        decode_grid_image(frames[i])
+
+    def decode_capture():
+        i = it['cap'] = (it['cap'] + 1) % len(captures)
+        img, corners = captures[i]
+        decode_grid_image(img, corners=corners)
+
+    def decode_capture_bgr():
+        # What the receivers do: the camera's BGR ndarray, read in place
+        i = it['bgr'] = (it['bgr'] + 1) % len(bgr_captures)
+        frame, corners = bgr_captures[i]
+        decode_grid_image(frame, corners=corners, channel_order='BGR')
+
+    return {
+        'encode_fps': metric(rate(encode, cfg.min_time), 'frames/s'),
+        'decode_fps': metric(rate(decode, cfg.min_time), 'frames/s'),
+        'decode_capture_fps': metric(rate(decode_capture, cfg.min_time), 'frames/s'),
+        'decode_capture_bgr_fps': metric(rate(decode_capture_bgr, cfg.min_time), 'frames/s'),
+    }
+
+
+def bench_manifest(cfg) -> Dict:
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        make_corpus(root, cfg.corpus_size)
+        mb = cfg.corpus_size / 1e6
+        out = {}
+        for mode in ('off', 'auto'):
+            start = time.perf_counter()
+            build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE, compression=mode)
+            out[f'build_{mode}_mbps'] = metric(mb / (time.perf_counter() - start), 'MB/s')
+        start = time.perf_counter()
+        build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE, compression='auto', chunking='cdc', dedup=True)
+        out['build_cdc_dedup_mbps'] = metric(mb / (time.perf_counter() - start), 'MB/s')
+        return out
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_digests(cfg) -> Dict:
+    """build_manifest MB/s and manifest size for each DIGEST_OPTIONS entry.
+
+    'stream' is the raw layout, where file digests and Merkle leaves are the
+    only work; 'blocks' adds dedup over DIGEST_BLOCK_SIZE blocks (no
+    compression), whose digests go into the manifest. Sizes are of the
+    compact JSON that the QR codes carry.
+    """
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        make_corpus(root, cfg.corpus_size)
+        mb = cfg.corpus_size / 1e6
+        out = {}
+        for name, (digest, size, leaf_size) in DIGEST_OPTIONS.items():
+            options = {'chunk_size': FRAME_PAYLOAD_SIZE, 'digest': digest, 'digest_bytes': size, 'leaf_size': leaf_size}
+            for layout, extra in (('stream', {}), ('blocks', {'dedup': True, 'block_size': DIGEST_BLOCK_SIZE})):
+                times = []
+                for _ in range(3):
+                    start = time.perf_counter()
+                    manifest = build_manifest(root, **options, **extra)
+                    times.append(time.perf_counter() - start)
+                out[f'{name}_{layout}_mbps'] = metric(mb / min(times), 'MB/s')
+            out[f'{name}_manifest_bytes'] = metric(len(json.dumps(manifest, separators=(',', ':'))), 'bytes', 'lower')
+        return out
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_fec(cfg) -> Dict:
+    group = [os.urandom(FRAME_PAYLOAD_SIZE) for _ in range(8)]
+    parity = xor_parity(group)
+    survivors = group[1:] + [parity]
+    assert xor_parity(survivors) == group[0]
+    mb = len(group) * FRAME_PAYLOAD_SIZE / 1e6
+    return {
+        'xor_encode_mbps': metric(rate(lambda: xor_parity(group), cfg.min_time, mb), 'MB/s'),
+        'xor_recover_mbps': metric(rate(lambda: xor_parity(survivors), cfg.min_time, mb), 'MB/s'),
+    }
+
+
+def loopback(root: str, out_dir: str, loss: float, display_fps: float, max_passes: int, seed: int) -> Dict:
+    """Sender -> simulated camera -> receiver, looping over the frames until the receiver is complete.
+
+    The camera captures every displayed frame once (camera FPS = display
+    FPS); drop_rate models frames lost to the channel. Displayed time is
+    counted in display frames, so goodput is independent of this machine's
+    speed; wall time measures how fast this machine runs the pipeline.
+    """
+    manifest = build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE, compression='auto')
+    source = ChunkSource(manifest, root)
+    frames = [encode_grid_frame(data, seq=seq, chunk_idx=idx) for seq, (idx, data) in enumerate(source)]
+    qr_frames = len(list(manifest_to_qr_frames(manifest)))
+    sim = ChannelSimulator(seed=seed, size=(640, 360), drop_rate=loss)
+    displayed = qr_frames  # manifest QR codes are shown once up front
+    decoded = 0
+    start = time.perf_counter()
+    with FileAssembler(manifest, out_dir) as assembler:
+        for _ in range(max_passes):
+            for frame in frames:
+                capture = sim.capture(displayed, frame)
+                displayed += 1
+                if capture is None:
+                    continue
+                rgb, corners = capture
+                result = decode_grid_image(Image.fromarray(rgb), corners=corners)
+                if result:
+                    decoded += 1
+                    header, payload = result
+                    assembler.write_chunk(header['chunk_idx'], payload)
+                if assembler.is_complete():
+                    break
+            if assembler.is_complete():
+                break
+        complete = assembler.is_complete()
+        ok = complete and all(assembler.verify().values())
+    wall = time.perf_counter() - start
+    seconds = displayed / display_fps
+    return {
+        'complete': complete and ok,
+        'frames_displayed': displayed,
+        'data_frames': len(frames),
+        'completion_s': seconds,
+        'goodput_Bps': manifest['total_size'] / seconds if complete else 0.0,
+        'wall_s': wall,
+        'decoded': decoded,
+    }
+
+
+def bench_transitions(cfg) -> Dict:
+    """Usable sender FPS: film a looping display at each --sender-fps with a --camera-fps rolling-shutter camera.
+
+    Captures torn between two frames should be rejected by the phase
+    marker before the full decode; goodput counts distinct correct chunks
+    per second of filming, and wrong chunks accepted must stay at zero.
+    """
+    seconds = cfg.film_captures / cfg.camera_fps
+    # Enough distinct frames that even the fastest sender never repeats one
+    payloads = [os.urandom(FRAME_PAYLOAD_SIZE) for _ in range(int(seconds * max(cfg.sender_fps)) + 2)]
+    frames = [np.asarray(encode_grid_frame(p, seq=i, chunk_idx=i)) for i, p in enumerate(payloads)]
+    sim = ChannelSimulator(seed=5, size=(640, 360))
+    out = {}
+    best = (0.0, 0)
+    for fps in cfg.sender_fps:
+        got, torn, wrong, decode_s = set(), 0, 0, 0.0
+        for shown, capture in sim.film(frames, fps, cfg.camera_fps, cfg.film_captures):
+            if capture is None:
+                continue
+            rgb, corners = capture
+            diag = {}
+            start = time.perf_counter()
+            result = decode_grid_image(rgb, corners=corners, diag=diag)
+            decode_s += time.perf_counter() - start
+            if result is None:
+                torn += diag.get('error') == 'transition'
+                continue
+            header, payload = result
+            if payload == payloads[header['chunk_idx'] % len(payloads)]:
+                got.add(header['chunk_idx'])
+            else:
+                wrong += 1
+        goodput = len(got) / seconds
+        tag = f'fps{fps:g}'
+        out[f'{tag}_chunks_per_s'] = metric(goodput, 'chunks/s')
+        out[f'{tag}_torn_rejected'] = metric(torn / cfg.film_captures, 'fraction of captures', 'lower')
+        out[f'{tag}_wrong_chunks'] = metric(wrong, 'chunks', 'lower', limit=0)
+        out[f'{tag}_decode_ms'] = metric(decode_s / cfg.film_captures * 1e3, 'ms/capture', 'lower')
+        best = max(best, (goodput, fps))
+    out['best_sender_fps'] = metric(best[1], f"fps with a {cfg.camera_fps:g} fps camera")
+    return out
+
+
+def bench_tiles(cfg) -> Dict:
+    """Decode cost and payload per displayed frame of tiled mosaics filmed by a --tile-camera sized camera.
+
+    The layouts in --tiles are rendered at their native size and filmed by
+    the same camera, so denser layouts get fewer capture pixels per cell.
+    Only tiles that decode correctly count towards the payload.
+    """
+    sim = ChannelSimulator(seed=9, size=cfg.tile_camera)
+    out = {}
+    for layout in cfg.tiles:
+        per_frame = layout[0] * layout[1]
+        payloads = [os.urandom(FRAME_PAYLOAD_SIZE) for _ in range(4 * per_frame)]
+        mosaics = list(iter_mosaics(enumerate(payloads), layout))
+        captures = [sim.capture(i, m) for i, m in enumerate(mosaics)]
+        good = sum(1 for rgb, corners in captures for r in decode_mosaic(rgb, layout, corners)
+                   if r and r[1] == payloads[r[0]['chunk_idx']])
+        it = {'i': 0}
+
+        def decode():
+            i = it['i'] = (it['i'] + 1) % len(captures)
+            rgb, corners = captures[i]
+            decode_mosaic(rgb, layout, corners)
+
+        tag = f'{layout[0]}x{layout[1]}'
+        out[f'{tag}_decode_fps'] = metric(rate(decode, cfg.min_time), 'captures/s')
+        out[f'{tag}_tiles_decoded'] = metric(good / len(payloads), 'fraction of tiles')
+        out[f'{tag}_bytes_per_frame'] = metric(good / len(captures) * FRAME_PAYLOAD_SIZE, 'B/displayed frame')
+    return out
+
+
+def bench_lighting(cfg) -> Dict:
+    """Frames decoded under --vignette and --glare, per palette, with local (reference cell) and global palettes."""
+    out = {}
+    for bits in (2, 3, 4):
+        sim = ChannelSimulator(seed=11, size=(1280, 720), vignette=cfg.vignette, glare=cfg.glare)
+        payloads = [os.urandom(frame_payload_size(bits_per_symbol=bits)) for _ in range(cfg.lighting_frames)]
+        captures = [sim.capture(i, encode_grid_frame(p, seq=i, chunk_idx=i, bits_per_symbol=bits))
+                    for i, p in enumerate(payloads)]
+        for mode, local in (('local', True), ('global', False)):
+            decode_grid_image(captures[0][0], bits_per_symbol=bits, corners=captures[0][1], local_palette=local)
+            good, elapsed = 0, 0.0
+            for p, (rgb, corners) in zip(payloads, captures):
+                start = time.perf_counter()
+                r = decode_grid_image(rgb, bits_per_symbol=bits, corners=corners, diag={}, local_palette=local)
+                elapsed += time.perf_counter() - start
+                good += bool(r and r[1] == p)
+            out[f'bits{bits}_{mode}_decoded'] = metric(good / len(payloads), 'fraction of frames')
+            out[f'bits{bits}_{mode}_decode_ms'] = metric(elapsed / len(payloads) * 1e3, 'ms/frame', 'lower')
+    return out
+
+
+def bench_classifier(cfg) -> Dict:
+    """Cell classification by distances to every palette colour and by PaletteLUT lookup, per palette.
+
+    Captures come from a camera with fixed exposure and white balance,
+    plus the default noise, blur and JPEG. Classification times are the
+    profiler's 'classify' and 'lut_classify' stages (the latter includes
+    reading the reference palette and any table rebuilds); 'fallback' is
+    the share of captures the table did not decode, which were classified
+    again by distances.
+    """
+    out = {}
+    was_enabled = PROFILER.enabled
+    PROFILER.enable()
+    try:
+        for bits in (2, 3, 4):
+            sim = ChannelSimulator(seed=17, size=(1280, 720), gamma=0.0, white_balance=0.0)
+            payloads = [os.urandom(frame_payload_size(bits_per_symbol=bits)) for _ in range(cfg.lighting_frames)]
+            captures = [sim.capture(i, encode_grid_frame(p, seq=i, chunk_idx=i, bits_per_symbol=bits))
+                        for i, p in enumerate(payloads)]
+            for mode in ('distance', 'lut'):
+                lut = PaletteLUT() if mode == 'lut' else None
+                PROFILER.reset()
+                good, elapsed = 0, 0.0
+                for p, (rgb, corners) in zip(payloads, captures):
+                    start = time.perf_counter()
+                    r = decode_grid_image(rgb, bits_per_symbol=bits, corners=corners, lut=lut)
+                    elapsed += time.perf_counter() - start
+                    good += bool(r and r[1] == p)
+                stats = PROFILER.stats()
+                stage = stats['lut_classify' if lut else 'classify']
+                out[f'bits{bits}_{mode}_classify_us'] = metric(stage['total_s'] / len(payloads) * 1e6, 'us/frame', 'lower')
+                out[f'bits{bits}_{mode}_decode_ms'] = metric(elapsed / len(payloads) * 1e3, 'ms/frame', 'lower')
+                out[f'bits{bits}_{mode}_decoded'] = metric(good / len(payloads), 'fraction of frames')
+                if lut:
+                    fallbacks = stats.get('classify', {}).get('count', 0)
+                    out[f'bits{bits}_lut_fallback'] = metric(fallbacks / len(payloads), 'fraction of frames', 'lower')
+                    out[f'bits{bits}_lut_builds'] = metric(lut.builds, 'tables', 'lower')
+    finally:
+        PROFILER.reset()
+        if not was_enabled:
+            PROFILER.disable()
+    return out
+
+
+def bench_combining(cfg) -> Dict:
+    """Captures a frame needs on a marginal channel (a --combine-size camera), alone and with soft combining.
+
+    Every frame is captured up to COMBINE_CAPTURES times. Without combining
+    it counts once one capture decodes by itself; with combining, once the
+    captures so far add up to a payload that checks. Frames never recovered
+    count as COMBINE_CAPTURES captures in the means.
+    """
+    sim = ChannelSimulator(seed=13, size=cfg.combine_size, noise=6, blur=1.0, jpeg_quality=70)
+    combiner = SoftCombiner()
+    single, combined, first = [], [], 0
+    combine_s, combines = 0.0, 0
+    for i in range(cfg.combine_frames):
+        payload = os.urandom(FRAME_PAYLOAD_SIZE)
+        frame = encode_grid_frame(payload, seq=i, chunk_idx=i)
+        alone = together = None
+        for n in range(1, COMBINE_CAPTURES + 1):
+            rgb, corners = sim.capture(i * COMBINE_CAPTURES + n, frame)
+            diag = {}
+            result = decode_grid_image(rgb, corners=corners, diag=diag)
+            if result and alone is None:
+                alone = n
+                first += n == 1
+            start = time.perf_counter()
+            chunks = combiner.collect([result] if result else [], soft_evidence([diag]))
+            combine_s += time.perf_counter() - start
+            combines += 1
+            if together is None and any(p == payload for _h, p in chunks):
+                together = n
+            if alone and together:
+                break
+        single.append(alone)
+        combined.append(together)
+
+    def within(needed, n):
+        return sum(1 for v in needed if v is not None and v <= n) / len(needed)
+
+    def mean(needed):
+        return statistics.mean(COMBINE_CAPTURES if v is None else v for v in needed)
+
+    return {
+        'first_capture_decoded': metric(first / cfg.combine_frames, 'fraction of frames'),
+        'single_within3': metric(within(single, 3), 'fraction of frames'),
+        'combined_within3': metric(within(combined, 3), 'fraction of frames'),
+        'single_captures': metric(mean(single), 'captures/frame', 'lower'),
+        'combined_captures': metric(mean(combined), 'captures/frame', 'lower'),
+        'single_unrecovered': metric(1 - within(single, COMBINE_CAPTURES), 'fraction of frames', 'lower'),
+        'combined_unrecovered': metric(1 - within(combined, COMBINE_CAPTURES), 'fraction of frames', 'lower'),
+        'combine_ms': metric(combine_s / combines * 1e3, 'ms/capture', 'lower'),
+    }
+
+
+def bench_encryption(cfg) -> Dict:
+    """Sender and receiver frames/s with and without per-chunk AEAD, and raw seal/open throughput.
+
+    The sender side renders a corpus to grid frames from the ChunkSource
+    (sealed on the thread pool when encrypted); the receiver side decodes
+    simulated captures, then verifies and decrypts each chunk.
+    """
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        make_corpus(root, cfg.loopback_size)
+        cipher = ChunkCipher(os.urandom(32), os.urandom(16).hex())
+        plain_manifest = build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE, compression='off')
+        sealed_manifest = build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE - TAG_SIZE, compression='off')
+        plain_source = ChunkSource(plain_manifest, root)
+        sealed_source = EncryptedSource(ChunkSource(sealed_manifest, root), cipher)
+        plain_frames, sealed_frames = len(plain_source), len(sealed_source)
+
+        def render(source):
+            for _ in iter_mosaics(source, (1, 1)):
+                pass
+
+        chunks = [data for _idx, data in ChunkSource(sealed_manifest, root)]
+        sealed = [cipher.encrypt(i, data) for i, data in enumerate(chunks)]
+        mb = sum(map(len, chunks)) / 1e6
+        out = {
+            'seal_MBps': metric(rate(lambda: [cipher.encrypt(i, d) for i, d in enumerate(chunks)], cfg.min_time, mb), 'MB/s'),
+            'open_MBps': metric(rate(lambda: [cipher.decrypt(i, d) for i, d in enumerate(sealed)], cfg.min_time, mb), 'MB/s'),
+            'sender_plain_fps': metric(rate(lambda: render(plain_source), cfg.min_time, plain_frames), 'frames/s'),
+            'sender_encrypted_fps': metric(rate(lambda: render(sealed_source), cfg.min_time, sealed_frames), 'frames/s'),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    sim = ChannelSimulator(seed=5)
+    plain_caps, sealed_caps = [], []
+    for i in range(16):
+        plain_caps.append(sim.capture(i, encode_grid_frame(os.urandom(FRAME_PAYLOAD_SIZE), seq=i, chunk_idx=i)))
+        data = cipher.encrypt(i, os.urandom(FRAME_PAYLOAD_SIZE - TAG_SIZE))
+        sealed_caps.append(sim.capture(i, encode_grid_frame(data, seq=i, chunk_idx=i)))
+    bad = []
+
+    def receive(captures, decrypt):
+        for rgb, corners in captures:
+            header, payload = decode_grid_image(rgb, corners=corners)
+            if decrypt and cipher.decrypt(header['chunk_idx'], payload) is None:
+                bad.append(header['chunk_idx'])
+
+    out['receiver_plain_fps'] = metric(rate(lambda: receive(plain_caps, False), cfg.min_time, len(plain_caps)), 'frames/s')
+    out['receiver_encrypted_fps'] = metric(rate(lambda: receive(sealed_caps, True), cfg.min_time, len(sealed_caps)), 'frames/s')
+    out['auth_failures'] = metric(len(bad), 'chunks', 'lower', limit=0)
+    return out
+
+
+def bench_schedule(cfg) -> Dict:
+    """Display slots a receiver joining at a random moment needs, for each sender scheduler.
+
+    A pure simulation of the slot order (nothing is rendered): the sender
+    loops over --schedule-frames data frames and one manifest QR, and
+    chunks decoded before the manifest are kept (as both receivers do).
+    Slots are lost at random with probability --schedule-loss, or, for the
+    periodic runs, every --schedule-period-th slot (a camera beating with
+    the display). Reports the slots until the manifest arrives and until
+    every frame has; a run still incomplete after SCHEDULE_CYCLES cycles
+    counts as that many slots.
+    """
+    rng = random.Random(11)
+    n = cfg.schedule_frames
+    limit = SCHEDULE_CYCLES * (n + 1)
+    out = {}
+
+    def join(cls, lost):
+        start = rng.randrange(4 * n)
+        have, manifest, slots = set(), None, 0
+        for i, (kind, idx) in enumerate(cls(1, n).slots()):
+            if i < start:
+                continue
+            slots += 1
+            if slots >= limit:
+                break
+            if lost(i):
+                continue
+            if kind == 'qr':
+                manifest = manifest or slots
+            else:
+                have.add(idx)
+            if manifest and len(have) == n:
+                break
+        return manifest or slots, slots
+
+    for name, cls in SCHEDULERS.items():
+        runs = [join(cls, lambda i: rng.random() < cfg.schedule_loss) for _ in range(cfg.schedule_joins)]
+        periodic = [join(cls, lambda i: i % cfg.schedule_period == 0) for _ in range(cfg.schedule_joins // 4)]
+        out[f'{name}_manifest_wait'] = metric(statistics.mean(w for w, _ in runs), 'slots', 'lower')
+        out[f'{name}_manifest_wait_max'] = metric(max(w for w, _ in runs), 'slots', 'lower')
+        out[f'{name}_completion'] = metric(statistics.mean(s for _, s in runs), 'slots', 'lower')
+        out[f'{name}_periodic_completion'] = metric(statistics.mean(s for _, s in periodic), 'slots', 'lower')
+    return out
+
+
+def bench_priority(cfg) -> Dict:
+    """What a receiver gets from a short look at a folder transfer, per file order.
+
+    The folder holds a large file that sorts first by path, twenty small
+    files and one file under urgent/. The receiver films the carousel from
+    its start for PRIORITY_WINDOW of a cycle and loses PRIORITY_LOSS of the
+    slots at random; a file counts once every chunk of its range is in.
+    Reports the mean share of files completed, the share of runs that got
+    the urgent file, and the slots until the first and the urgent file were
+    complete (the whole window if never).
+    """
+    rng = random.Random(21)
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        with open(os.path.join(root, 'archive.bin'), 'wb') as f:
+            f.write(rng.randbytes(cfg.corpus_size // 2))
+        os.makedirs(os.path.join(root, 'notes'))
+        for i in range(20):
+            with open(os.path.join(root, 'notes', f'{i:02d}.txt'), 'wb') as f:
+                f.write(rng.randbytes(8 * 1024))
+        os.makedirs(os.path.join(root, 'urgent'))
+        with open(os.path.join(root, 'urgent', 'keys.txt'), 'wb') as f:
+            f.write(rng.randbytes(2 * 1024))
+        out = {}
+        for name, (order, priority) in PRIORITY_POLICIES.items():
+            manifest = build_manifest(root, chunk_size=FRAME_PAYLOAD_SIZE, order=order, priority=priority)
+            n = manifest['total_chunks']
+            files = manifest['files']
+            urgent = next(i for i, f in enumerate(files) if f['path'].startswith('urgent/'))
+            lead = lead_frames(manifest.get('order', {}).get('lead_chunks', 0), 1, n)
+            window = int(n * PRIORITY_WINDOW)
+            owners = [[] for _ in range(n)]  # chunk -> files it holds part of
+            for fi, f in enumerate(files):
+                for c in range(f['first_chunk'], f['first_chunk'] + f['chunk_count']):
+                    owners[c].append(fi)
+            done, got_urgent, first, urgent_at = [], 0, [], []
+            for _ in range(cfg.schedule_joins):
+                missing = [f['chunk_count'] for f in files]
+                have, completed = set(), {}
+                for slots, (kind, idx) in enumerate(Carousel(1, n, lead=lead).slots(), 1):
+                    if slots > window:
+                        break
+                    if kind != 'data' or idx in have or rng.random() < PRIORITY_LOSS:
+                        continue
+                    have.add(idx)
+                    for fi in owners[idx]:
+                        missing[fi] -= 1
+                        if not missing[fi]:
+                            completed[fi] = slots
+                done.append(sum(1 for fi, f in enumerate(files) if f['chunk_count'] and fi in completed)
+                            / sum(1 for f in files if f['chunk_count']))
+                got_urgent += urgent in completed
+                first.append(min(completed.values(), default=window))
+                urgent_at.append(completed.get(urgent, window))
+            out[f'{name}_files_done'] = metric(statistics.mean(done), 'fraction of files')
+            out[f'{name}_urgent_done'] = metric(got_urgent / cfg.schedule_joins, 'fraction of runs')
+            out[f'{name}_first_file_slots'] = metric(statistics.mean(first), 'slots', 'lower')
+            out[f'{name}_urgent_slots'] = metric(statistics.mean(urgent_at), 'slots', 'lower')
+        return out
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def make_disk_image(path: str, size: int, seed: int = 0):
+    """A VM-image-like file: random extents (SPARSE_DATA_FRACTION of it) scattered in zeros, one 0xff run."""
+    rng = random.Random(seed)
+    extent = 256 * 1024
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for _ in range(int(size * SPARSE_DATA_FRACTION) // extent):
+            f.seek(rng.randrange(0, size - extent))
+            f.write(rng.randbytes(extent))
+        f.seek(size // 2)
+        f.write(b'\xff' * extent)
+
+
+def bench_sparse(cfg) -> Dict:
+    """Frames needed for a mostly-zero disk image without compression, compressed, and with
+    constant block elision on top, as well as manifest build MB/s, receive time and the share
+    of the received image the receiver allocated (elided zeros stay holes).
+    """
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        src = os.path.join(root, 'disk.img')
+        make_disk_image(src, cfg.corpus_size)
+        mb = cfg.corpus_size / 1e6
+        out = {'raw_frames': metric(build_manifest(src, chunk_size=FRAME_PAYLOAD_SIZE)['total_chunks'], 'frames', 'lower')}
+        failures = 0
+        for name, elide in (('compressed', False), ('elided', True)):
+            start = time.perf_counter()
+            manifest = build_manifest(src, chunk_size=FRAME_PAYLOAD_SIZE, compression='auto', elide=elide)
+            out[f'{name}_frames'] = metric(manifest['total_chunks'], 'frames', 'lower')
+            out[f'{name}_build_mbps'] = metric(mb / (time.perf_counter() - start), 'MB/s')
+            dest = os.path.join(root, name)
+            start = time.perf_counter()
+            with FileAssembler(manifest, dest) as assembler:
+                for idx, data in ChunkSource(manifest, src):
+                    assembler.write_chunk(idx, data)
+                failures += not all(assembler.verify().values())
+            out[f'{name}_receive_s'] = metric(time.perf_counter() - start, 's', 'lower')
+            st = os.stat(os.path.join(dest, 'disk.img'))
+            if hasattr(st, 'st_blocks'):
+                out[f'{name}_allocated'] = metric(st.st_blocks * 512 / st.st_size, 'of size', 'lower')
+        out['verify_failures'] = metric(failures, 'files', 'lower', limit=0)
+        return out
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_archive(cfg) -> Dict:
+    """Time to the first data frame of a send prepared from the files vs from a frame archive, and sizes.
+
+    From the files the sender builds the manifest (hashing and compressing
+    everything) before it can render; from an archive it maps the file and
+    expands one record. The PNG folder size is extrapolated from
+    ARCHIVE_PNG_FRAMES saved frames.
+    """
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        src = os.path.join(root, 'src')
+        make_corpus(src, cfg.corpus_size)
+        path = os.path.join(root, 'transfer.ofta')
+        start = time.perf_counter()
+        manifest = build_manifest(src, chunk_size=FRAME_PAYLOAD_SIZE, compression='auto')
+        source = ChunkSource(manifest, src)
+        render_frame(source, 0, (1, 1), 0)
+        prepare_source = time.perf_counter() - start
+        size = write_archive(path, manifest, source)
+        frames = len(source)
+
+        def prepare():
+            with FrameArchive(path) as archive:
+                render_frame(archive, 0, (1, 1), 0)
+
+        png = os.path.join(root, 'png')
+        os.makedirs(png)
+        with FrameArchive(path) as archive:
+            for i in range(min(ARCHIVE_PNG_FRAMES, frames)):
+                Image.fromarray(render_frame(archive, i, (1, 1), i & 1)).save(os.path.join(png, f'frame_{i:05d}.png'))
+            png_per_frame = sum(e.stat().st_size for e in os.scandir(png)) / min(ARCHIVE_PNG_FRAMES, frames)
+            sample = range(min(frames, 200))
+            archive_fps = rate(lambda: [render_frame(archive, i, (1, 1), i & 1) for i in sample], cfg.min_time, len(sample))
+        source_fps = rate(lambda: [render_frame(source, i, (1, 1), i & 1) for i in sample], cfg.min_time, len(sample))
+        return {
+            'prepare_source_ms': metric(prepare_source * 1000, 'ms', 'lower'),
+            'prepare_archive_ms': metric(1000 / rate(prepare, cfg.min_time), 'ms', 'lower'),
+            'render_source_fps': metric(source_fps, 'frames/s'),
+            'render_archive_fps': metric(archive_fps, 'frames/s'),
+            'archive_bytes_per_frame': metric(size / frames, 'bytes', 'lower'),
+            'png_bytes_per_frame': metric(png_per_frame, 'bytes', 'lower'),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_loopback(cfg) -> Dict:
+    root = tempfile.mkdtemp(prefix='oft-bench-')
+    try:
+        src = os.path.join(root, 'src')
+        make_corpus(src, cfg.loopback_size)
+        out = {}
+        for loss in cfg.losses:
+            tag = f'loss{int(round(loss * 100))}'
+            r = loopback(src, os.path.join(root, tag), loss, cfg.display_fps, cfg.max_passes, seed=7)
+            if not r['complete']:
+                print(f"  loopback at {loss:.0%} loss did not complete in {cfg.max_passes} passes", file=sys.stderr)
+            out[f'{tag}_goodput'] = metric(r['goodput_Bps'], f"B/s at {cfg.display_fps:g} fps")
+            out[f'{tag}_completion'] = metric(r['completion_s'], f"s at {cfg.display_fps:g} fps", 'lower')
+            out[f'{tag}_wall'] = metric(r['wall_s'], 's', 'lower')
+        return out
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def import_time(module: str, heavy) -> Dict:
+    """One cold `python -X importtime` import: cumulative milliseconds and the heavy modules it loaded."""
+    code = f"import sys, {module}; print(','.join(m for m in {tuple(heavy)!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          capture_output=True, text=True)
+    if proc.returncode:
+        return None  # a dependency of this entry point is not installed
+    for line in proc.stderr.splitlines():
+        # import time: <self us> | <cumulative us> | <indented module name>
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            loaded = proc.stdout.strip()
+            return {'ms': int(fields[1]) / 1000, 'loaded': loaded.split(',') if loaded else []}
+    return None
+
+
+def bench_imports(cfg) -> Dict:
+    out = {}
+    for name, (module, heavy) in IMPORT_TARGETS.items():
+        import_time(module, heavy)  # warm the filesystem and bytecode caches
+        runs = [import_time(module, heavy) for _ in range(cfg.import_runs)]
+        if None in runs:
+            print(f"  {name}: import failed (missing dependency?), skipped", file=sys.stderr)
+            continue
+        loaded = sorted(set().union(*(r['loaded'] for r in runs)))
+        if loaded:
+            print(f"  {name} imports {', '.join(loaded)}", file=sys.stderr)
+        out[f'{name}_ms'] = metric(statistics.median(r['ms'] for r in runs), 'ms', 'lower')
+        out[f'{name}_heavy_modules'] = metric(len(loaded), 'modules', 'lower', limit=0)
+    return out
+
+
+BENCHMARKS = {
+    'grid': bench_grid,
+    'manifest': bench_manifest,
+    'fec': bench_fec,
+    'digests': bench_digests,
+    'loopback': bench_loopback,
+    'transitions': bench_transitions,
+    'tiles': bench_tiles,
+    'lighting': bench_lighting,
+    'classifier': bench_classifier,
+    'combining': bench_combining,
+    'encryption': bench_encryption,
+    'schedule': bench_schedule,
+    'priority': bench_priority,
+    'archive': bench_archive,
+    'sparse': bench_sparse,
+    'imports': bench_imports,
+}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float):
+    """Yield (benchmark, metric, change) for metrics worse than baseline by more than tolerance."""
+    for name, metrics in results.items():
+        for key, m in metrics.items():
+            base = baseline.get('results', {}).get(name, {}).get(key)
+            if not base or not base['value']:
+                continue
+            change = m['value'] / base['value'] - 1
+            worse = -change if m['better'] == 'higher' else change
+            if worse > tolerance:
+                yield name, key, change
+
+
+def over_limit(results: Dict):
+    """Yield (benchmark, metric, value, limit) for metrics past their fixed limit."""
+    for name, metrics in results.items():
+        for key, m in metrics.items():
+            if 'limit' in m and (m['value'] > m['limit'] if m['better'] == 'lower' else m['value'] < m['limit']):
+                yield name, key, m['value'], m['limit']
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Optical transfer benchmark suite")
+    ap.add_argument('--only', help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}")
+    ap.add_argument('--quick', action='store_true', help='Shorter timings and smaller inputs')
+    ap.add_argument('--out', help='Write results JSON here (default: stdout)')
+    ap.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results to compare against')
+    ap.add_argument('--save-baseline', action='store_true', help='Store these results as the baseline')
+    ap.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                    help='Allowed fractional slowdown before a metric is flagged')
+    ap.add_argument('--fps', type=float, default=10, help='Display FPS assumed for loopback goodput')
+    ap.add_argument('--loss', default='0,0.1,0.3', help='Comma-separated frame loss rates for loopback')
+    ap.add_argument('--camera-fps', type=float, default=30, help='Camera FPS for the transitions benchmark')
+    ap.add_argument('--sender-fps', default='5,10,15,20,30', help='Comma-separated sender FPS for transitions')
+    ap.add_argument('--vignette', type=float, default=0.4, help='Corner darkening for the lighting benchmark')
+    ap.add_argument('--glare', type=float, default=0.3, help='Glare spot strength for the lighting benchmark')
+    ap.add_argument('--combine-size', default='280x158', help='Capture size (WxH) for the combining benchmark')
+    ap.add_argument('--schedule-frames', type=int, default=500, help='Data frames in the schedule benchmark')
+    ap.add_argument('--schedule-loss', type=float, default=0.2, help='Slot loss rate in the schedule benchmark')
+    ap.add_argument('--schedule-period', type=int, default=3,
+                    help='Every this many slots one is lost in the periodic schedule runs')
+    ap.add_argument('--tiles', default='1x1,2x2,3x3', help='Comma-separated tile layouts for the tiles benchmark')
+    ap.add_argument('--tile-camera', default='3840x2160', help='Capture size (WxH) for the tiles benchmark')
+    args = ap.parse_args()
+
+    args.min_time = 0.3 if args.quick else 1.5
+    args.corpus_size = (1 if args.quick else 8) * 1024 * 1024
+    args.loopback_size = (32 if args.quick else 128) * 1024
+    args.display_fps = args.fps
+    args.max_passes = 10
+    args.losses = [float(v) for v in args.loss.split(',')]
+    args.import_runs = 3 if args.quick else 7
+    args.sender_fps = [float(v) for v in args.sender_fps.split(',')]
+    args.film_captures = 90 if args.quick else 300
+    args.lighting_frames = 10 if args.quick else 40
+    args.combine_frames = 20 if args.quick else 60
+    args.schedule_joins = 50 if args.quick else 200
+    args.combine_size = tuple(int(v) for v in args.combine_size.lower().split('x'))
+    args.tiles = [parse_layout(v) for v in args.tiles.split(',')]
+    args.tile_camera = tuple(int(v) for v in args.tile_camera.lower().split('x'))
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise SystemExit(f"Unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in names:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = BENCHMARKS[name](args)
+
+    report = {
+        'machine': machine_info(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'quick': args.quick,
+        'results': results,
+    }
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('quick') != args.quick:
+            print("Baseline was recorded with a different --quick setting; not comparing", file=sys.stderr)
+        else:
+            regressions = [{'benchmark': n, 'metric': k, 'change': round(c, 3)}
+                           for n, k, c in compare(results, baseline, args.tolerance)]
+        report['baseline'] = {'path': args.baseline, 'machine': baseline.get('machine'),
+                              'tolerance': args.tolerance, 'regressions': regressions}
+    failures = [{'benchmark': n, 'metric': k, 'value': v, 'limit': lim} for n, k, v, lim in over_limit(results)]
+    if failures:
+        report['limit_failures'] = failures
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(text + '\n')
+        print(f"Baseline saved to {args.baseline}", file=sys.stderr)
+
+    for r in regressions:
+        print(f"REGRESSION {r['benchmark']}.{r['metric']}: {r['change']:+.0%} vs baseline", file=sys.stderr)
+    for f in failures:
+        print(f"LIMIT {f['benchmark']}.{f['metric']}: {f['value']:g} (limit {f['limit']:g})", file=sys.stderr)
+    if regressions or failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
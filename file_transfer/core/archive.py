@@ -0,0 +1,130 @@
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, Tuple
+import numpy as np
+from .encoding_grid import grid_symbols, _bytes_to_symbols, GRID_W, GRID_H, BITS_PER_SYMBOL, PALETTES
+from .decoding_grid import _decode_symbols
+
+ARCHIVE_MAGIC = b'OFTA'
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = '.ofta'
+# magic, version, bits per symbol, pad, grid_w, grid_h, manifest bytes, chunks, index offset
+_HEADER = struct.Struct('>4sHBxHHIIQ')
+
+
+def pack_symbols(symbols: np.ndarray, bits_per_symbol: int) -> bytes:
+    """Pack a symbol map bits_per_symbol bits per cell, MSB-first in raster order (last byte zero-padded)."""
+    syms = np.asarray(symbols, dtype=np.uint8).ravel()
+    bits = (syms[:, None] >> np.arange(bits_per_symbol - 1, -1, -1, dtype=np.uint8)) & 1
+    return np.packbits(bits.ravel()).tobytes()
+
+
+def write_archive(path: str, manifest: Dict, source: Iterable[Tuple[int, bytes]], grid_w: int = GRID_W,
+                  grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL) -> int:
+    """Store the manifest and every chunk's frame of source as a frame archive; returns its size in bytes.
+
+    source yields (chunk_idx, data) in order, as the sender would frame
+    them (compressed and sealed already). The file appears at path only
+    once it is complete.
+    """
+    if bits_per_symbol not in PALETTES:
+        raise ValueError(f"No palette for {bits_per_symbol} bits per symbol")
+    meta = json.dumps(manifest, separators=(',', ':')).encode('utf-8')
+    offsets = []
+    pos = _HEADER.size + len(meta)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        f.write(meta)
+        for chunk_idx, data in source:
+            if chunk_idx != len(offsets):
+                raise ValueError(f'Chunk {chunk_idx} out of order (expected {len(offsets)})')
+            record = pack_symbols(grid_symbols(data, chunk_idx, chunk_idx, grid_w, grid_h, bits_per_symbol),
+                                  bits_per_symbol)
+            offsets.append(pos)
+            f.write(record)
+            pos += len(record)
+        offsets.append(pos)
+        f.write(np.array(offsets, dtype='>u8').tobytes())
+        f.seek(0)
+        f.write(_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, bits_per_symbol, grid_w, grid_h,
+                             len(meta), len(offsets) - 1, pos))
+        size = pos + 8 * len(offsets)
+    os.replace(tmp, path)
+    return size
+
+
+class FrameArchive:
+    """A transfer prepared for sending again: the manifest plus every frame as a packed symbol map.
+
+    Layout: a fixed header (see _HEADER), the manifest as JSON, one record
+    per chunk holding its grid's cells at bits_per_symbol bits each
+    (header rows, payload and reference cells, as grid_symbols lays them
+    out), and an index of record offsets, one more than there are chunks.
+    Nothing is read up front: the file is memory-mapped, so opening costs
+    the header and manifest, and a frame costs one record, expanded to
+    pixels by the renderer (see tiling.render_frame).
+
+    Works as a ChunkSource for the sender: read_symbols() is what
+    render_frame uses, read_chunk() and iteration give the chunk payloads
+    back. Records hold chunks as framed, so an encrypted transfer's archive
+    only holds sealed chunks and is sent again without the key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._open()
+        except Exception:
+            self._mm.close()
+            raise
+
+    def _open(self):
+        if len(self._mm) < _HEADER.size:
+            raise ValueError(f'{self.path} is not a frame archive')
+        magic, version, bits, grid_w, grid_h, meta_len, chunks, index_off = _HEADER.unpack_from(self._mm)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f'{self.path} is not a frame archive')
+        if version != ARCHIVE_VERSION:
+            raise ValueError(f'{self.path}: unsupported frame archive version {version}')
+        if index_off + 8 * (chunks + 1) > len(self._mm) or bits not in PALETTES:
+            raise ValueError(f'{self.path}: truncated or corrupt frame archive')
+        self.bits_per_symbol, self.grid_w, self.grid_h = bits, grid_w, grid_h
+        self.manifest = json.loads(bytes(self._mm[_HEADER.size:_HEADER.size + meta_len]).decode('utf-8'))
+        self._index = np.frombuffer(self._mm, dtype='>u8', count=chunks + 1, offset=index_off)
+        self._cells = grid_w * grid_h
+
+    def __len__(self) -> int:
+        return len(self._index) - 1
+
+    def read_symbols(self, chunk_idx: int) -> np.ndarray:
+        """(grid_h, grid_w) symbol map of a chunk's frame."""
+        if not 0 <= chunk_idx < len(self):
+            raise IndexError(chunk_idx)
+        start, end = int(self._index[chunk_idx]), int(self._index[chunk_idx + 1])
+        symbols = _bytes_to_symbols(self._mm[start:end], self.bits_per_symbol)
+        return symbols[:self._cells].reshape(self.grid_h, self.grid_w)
+
+    def read_chunk(self, chunk_idx: int) -> bytes:
+        result = _decode_symbols(self.read_symbols(chunk_idx), self.bits_per_symbol)
+        if result is None:
+            raise ValueError(f'{self.path}: record {chunk_idx} is corrupt')
+        return result[1]
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        for chunk_idx in range(len(self)):
+            yield chunk_idx, self.read_chunk(chunk_idx)
+
+    def close(self):
+        self._index = None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,253 @@
+import os
+import bisect
+from typing import Dict, List, Optional, Tuple
+from .chunking import StreamMap, data_digest
+from .compression import decode, fill_value
+from .manifest import block_offsets, block_refs, digest_params, verify_file
+from .resume import ResumeState
+from .store import ChunkStore
+
+
+def safe_join(root: str, rel_path: str) -> str:
+    """Join a manifest path onto root, refusing absolute paths and '..' components."""
+    parts = [p for p in rel_path.replace('\\', '/').split('/') if p not in ('', '.')]
+    if not parts or rel_path.startswith('/') or os.path.splitdrive(rel_path)[0] or '..' in parts:
+        raise ValueError(f'Unsafe path in manifest: {rel_path!r}')
+    return os.path.join(root, *parts)
+
+
+class FileAssembler:
+    """Write received chunks straight into the files they belong to.
+
+    The sender streams every file of the manifest as one continuous byte
+    stream, so a chunk may end one file and start the next. Each chunk is
+    split into per-file segments and written at the right offset under
+    out_dir, recreating the directory tree (the manifest's 'dirs' lists the
+    empty directories, which no file recreates). Files are preallocated and written
+    positionally through a ChunkStore, so nothing is held in memory.
+
+    For block (compressed) layouts the chunks carry encoded blocks instead:
+    they are spooled to a hidden file under out_dir and each block is decoded
+    into its file(s) as soon as all the chunks it spans have arrived. Elided
+    ('fill') blocks span no chunks and are written when the assembler opens.
+
+    With resume=True the received-chunk bitmap is persisted next to the output
+    (see ResumeState) and checkpoint() makes progress survive a restart.
+
+    Every file is tracked on its own: once the last chunk of its range (or
+    the last of its blocks) is in, completed_files() hands it out, closed,
+    and check_file() verifies its digest, so files are usable long before
+    the whole transfer ends. A file that fails is forgotten and captured
+    again.
+    """
+
+    def __init__(self, manifest: Dict, out_dir: str, resume: bool = False):
+        self.manifest = manifest
+        self.out_dir = out_dir
+        self.chunk_size = manifest['chunk_size']
+        self.total_chunks = manifest.get('total_chunks', 0)
+        self.files = manifest.get('files', [])
+        self.paths = [safe_join(out_dir, f['path']) for f in self.files]
+        self.dirs = [safe_join(out_dir, d) for d in manifest.get('dirs', [])]
+        for d in self.dirs:
+            os.makedirs(d, exist_ok=True)
+        self.blocks = manifest.get('blocks')
+        self.resume = resume
+        self._closed = False
+        self.received = ResumeState(self._state_path('resume'), self.total_chunks)
+        self.store = ChunkStore(self.paths, [f['size'] for f in self.files])
+        self.verified: Dict[int, Optional[bool]] = {}  # file index -> check_file() result
+        self._completed: List[int] = []  # complete files not yet handed out by completed_files()
+        if self.blocks is None:
+            # Older manifests aligned every file to a chunk boundary and carried no offset
+            offsets = [f.get('offset', f['first_chunk'] * self.chunk_size) for f in self.files]
+            self._map = StreamMap([f['size'] for f in self.files], offsets)
+            # Chunks each file still waits for
+            self._missing = [sum(1 for c in range(f['first_chunk'], f['first_chunk'] + f['chunk_count'])
+                                 if c not in self.received) for f in self.files]
+        else:
+            self._enc_starts = block_offsets(manifest)
+            self._refs = block_refs(manifest)
+            self._digest = digest_params(manifest)
+            self._decoded = ResumeState(self._state_path('blocks'), len(self.blocks))
+            self.spool_path = self._state_path('spool', always=True)
+            self._spool = ChunkStore([self.spool_path], [self._enc_starts[-1]])
+            self._file_blocks = [sorted({b for first, count in f.get('blocks', []) for b in range(first, first + count)})
+                                 for f in self.files]
+            self._block_files = [sorted({fi for fi, _off in refs}) for refs in self._refs]
+            # Blocks each file still waits for
+            self._missing = [sum(1 for b in blocks if b not in self._decoded) for blocks in self._file_blocks]
+            for b in range(len(self.blocks)):
+                # Empty blocks, and blocks completed just before an interrupted run stopped
+                if b not in self._decoded and self._block_ready(b):
+                    self._decode_block(b)
+        self._completed = [fi for fi, n in enumerate(self._missing) if not n]
+
+    def _state_path(self, kind: str, always: bool = False) -> Optional[str]:
+        if not (self.resume or always):
+            return None
+        return os.path.join(self.out_dir, f".{self.manifest.get('session_id', 'transfer')}.{kind}")
+
+    def write_chunk(self, chunk_idx: int, data: bytes) -> bool:
+        """Write one chunk; returns False if it was already written."""
+        if chunk_idx in self.received:
+            return False
+        if self.total_chunks and chunk_idx >= self.total_chunks:
+            raise ValueError(f'Chunk index {chunk_idx} out of range')
+        pos = chunk_idx * self.chunk_size
+        if self.blocks is None:
+            view = memoryview(data)
+            for fi, file_off, a, b in self._map.segments(pos, len(data)):
+                self.store.write(fi, file_off, view[a:b])
+                self._missing[fi] -= 1
+                if not self._missing[fi]:
+                    self._completed.append(fi)
+            self.received.add(chunk_idx)
+            return True
+
+        self._spool.write(0, pos, data)
+        self.received.add(chunk_idx)
+        # Decode every block this chunk completes
+        b = max(bisect.bisect_right(self._enc_starts, pos) - 1, 0)
+        end = pos + len(data)
+        while b < len(self.blocks) and self._enc_starts[b] < end:
+            if b not in self._decoded and self._block_ready(b):
+                self._decode_block(b)
+            b += 1
+        return True
+
+    def _block_ready(self, block_idx: int) -> bool:
+        start, end = self._enc_starts[block_idx], self._enc_starts[block_idx + 1]
+        if end == start:
+            return True
+        first, last = start // self.chunk_size, (end - 1) // self.chunk_size
+        return all(c in self.received for c in range(first, last + 1))
+
+    def _decode_block(self, block_idx: int) -> bool:
+        """Decode a complete block into every file position that uses it.
+
+        A block that fails to decode or to match its digest was built from a
+        corrupted chunk: its chunks are forgotten so a later capture can
+        replace them.
+        """
+        entry = self.blocks[block_idx]
+        codec, src_len = entry[:2]
+        value = fill_value(codec)
+        if value is not None:
+            # Nothing was sent for a constant block; runs of zeros stay holes in the preallocated files
+            for fi, file_off in self._refs[block_idx]:
+                self.store.fill(fi, file_off, src_len, value)
+            self._block_decoded(block_idx)
+            return True
+        start, end = self._enc_starts[block_idx], self._enc_starts[block_idx + 1]
+        try:
+            data = decode(codec, self._spool.read(0, start, end - start))
+        except Exception:
+            data = None
+        if data is None or len(data) != src_len or (len(entry) > 3 and data_digest(data, *self._digest) != entry[3]):
+            if end > start:
+                self.received.difference_update(range(start // self.chunk_size, (end - 1) // self.chunk_size + 1))
+            return False
+        for fi, file_off in self._refs[block_idx]:
+            self.store.write(fi, file_off, data)
+        self._block_decoded(block_idx)
+        return True
+
+    def _block_decoded(self, block_idx: int):
+        self._decoded.add(block_idx)
+        for fi in self._block_files[block_idx]:
+            self._missing[fi] -= 1
+            if not self._missing[fi]:
+                self._completed.append(fi)
+
+    def completed_files(self) -> List[int]:
+        """Indices of the files completed since the last call, flushed and closed, in completion order."""
+        done, self._completed = self._completed, []
+        for fi in done:
+            self.store.close_file(fi)
+        return done
+
+    def check_file(self, file_idx: int) -> Optional[bool]:
+        """Verify a completed file against its manifest digest (None if it has none); see file_checked()."""
+        ok = verify_file(self.manifest, self.files[file_idx], self.paths[file_idx])
+        self.file_checked(file_idx, ok)
+        return ok
+
+    def file_checked(self, file_idx: int, ok: Optional[bool]):
+        """Record the verification of a completed file; one that failed is forgotten so it is received again."""
+        self.verified[file_idx] = ok
+        if ok is False:
+            self.forget_file(file_idx)
+
+    def forget_file(self, file_idx: int):
+        """Mark a file's chunks (and blocks) as missing, so captures write them again."""
+        if self.blocks is None:
+            f = self.files[file_idx]
+            chunks = range(f['first_chunk'], f['first_chunk'] + f['chunk_count'])
+        else:
+            chunks = set()
+            for b in self._file_blocks[file_idx]:
+                start, end = self._enc_starts[b], self._enc_starts[b + 1]
+                if end == start or b not in self._decoded:
+                    continue  # fill blocks are recreated from the manifest, not received
+                chunks.update(range(start // self.chunk_size, (end - 1) // self.chunk_size + 1))
+                self._decoded.discard(b)
+                for fi in self._block_files[b]:
+                    self._missing[fi] += 1
+        for c in chunks:
+            if c not in self.received:
+                continue
+            self.received.discard(c)
+            if self.blocks is None:
+                length = min(self.chunk_size, self.manifest.get('total_size', 0) - c * self.chunk_size)
+                for fi, _off, _a, _b in self._map.segments(c * self.chunk_size, length):
+                    self._missing[fi] += 1
+        self._completed = [fi for fi in self._completed if self._missing[fi]]
+        self.verified.pop(file_idx, None)
+
+    def missing_chunks(self) -> List[int]:
+        return [i for start, end in self.received.missing_ranges(self.total_chunks) for i in range(start, end)]
+
+    def missing_ranges(self, limit: int = None) -> List[Tuple[int, int]]:
+        return self.received.missing_ranges(self.total_chunks, limit)
+
+    def is_complete(self) -> bool:
+        return len(self.received) >= self.total_chunks
+
+    def checkpoint(self):
+        """Flush written data, then persist the received bitmap (in that order)."""
+        if self._closed:
+            return
+        self.store.flush()
+        if self.blocks is not None:
+            self._spool.flush()
+            self._decoded.save()
+        self.received.save()
+
+    def close(self):
+        if self._closed:
+            return
+        self.checkpoint()
+        self.store.close()
+        done = self.is_complete()
+        if self.blocks is not None:
+            self._spool.close()
+            done = len(self._decoded) == len(self.blocks)
+            if done:
+                os.remove(self.spool_path)
+                self._decoded.remove()
+        if done:
+            self.received.remove()
+        self._closed = True
+
+    def verify(self) -> Dict[str, Optional[bool]]:
+        """Check each reconstructed file against its manifest digest (files check_file() passed are not read again)."""
+        self.close()
+        return {f['path']: True if self.verified.get(fi) else verify_file(self.manifest, f, path)
+                for fi, (f, path) in enumerate(zip(self.files, self.paths))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import math
+import os
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from PIL import Image
+from .encoding_grid import (render_grid_array, frame_payload_size, _bytes_to_symbols,
+                            HEADER_ROWS, PALETTES, CELL_SIZE)
+from .decoding_grid import decode_grid_image
+from .encoding_qr import _segno
+from .video import frame_size
+
+# A calibration plan travels in one QR code as "OFTC:" + JSON, ahead of the sweep
+PLAN_PREFIX = b'OFTC:'
+DEFAULT_GRIDS = ((48, 27), (64, 36), (96, 54))
+DEFAULT_BITS = (2, 3, 4)
+DEFAULT_RATES = (10, 20)
+STEP_SECONDS = 1.5  # how long each setting is shown
+MIN_STEP_FRAMES = 8
+HEADER_BYTES = 22
+
+
+def build_plan(grids: Sequence[Tuple[int, int]] = DEFAULT_GRIDS, bits: Sequence[int] = DEFAULT_BITS,
+               rates: Sequence[int] = DEFAULT_RATES, step_seconds: float = STEP_SECONDS,
+               seed: Optional[int] = None) -> Dict:
+    """One step per (grid, bits per symbol, FPS), densest last within each rate."""
+    steps = []
+    for fps in rates:
+        for grid_w, grid_h in grids:
+            for b in bits:
+                if b not in PALETTES:
+                    raise ValueError(f'No palette for {b} bits per symbol')
+                if grid_w * HEADER_ROWS * b < HEADER_BYTES * 8:
+                    raise ValueError(f'A {grid_w}-cell wide grid cannot hold the frame header at {b} bits')
+                frame_payload_size(grid_w, grid_h, b)  # raises if the reference blocks do not fit
+                frames = max(MIN_STEP_FRAMES, round(step_seconds * fps))
+                steps.append([grid_w, grid_h, b, fps, frames])
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), 'big')
+    return {'version': 1, 'seed': seed, 'steps': steps}
+
+
+def plan_to_qr(plan: Dict):
+    data = PLAN_PREFIX + json.dumps(plan, separators=(',', ':')).encode('utf-8')
+    segno = _segno()
+    return segno.make(data, micro=False) if segno else data
+
+
+def parse_plan(payload: bytes) -> Optional[Dict]:
+    """The plan carried by a calibration QR payload, or None for any other QR."""
+    if not payload.startswith(PLAN_PREFIX):
+        return None
+    try:
+        return json.loads(payload[len(PLAN_PREFIX):].decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def pattern_payload(seed: int, step: int, seq: int, size: int) -> bytes:
+    """Known pseudo-random content of calibration frame seq of a step."""
+    return hashlib.shake_256(f'oft-cal:{seed}:{step}:{seq}'.encode()).digest(size)
+
+
+def iter_calibration_frames(plan: Dict, size: Tuple[int, int] = None) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """Yield (step, seq, rgb) for the sweep, every frame size pixels (default: the data frame size).
+
+    Whatever the grid, the data area sits inside the same CELL_SIZE border
+    as a transfer frame, so receiver corners set for transfers fit every
+    step. Cells are scaled with nearest neighbour to fill that area.
+    """
+    import cv2  # deferred: only the sender renders the sweep
+    width, height = size or frame_size()
+    b = CELL_SIZE
+    for step, (grid_w, grid_h, bits, _fps, frames) in enumerate(plan['steps']):
+        n = frame_payload_size(grid_w, grid_h, bits)
+        for seq in range(frames):
+            data = pattern_payload(plan['seed'], step, seq, n)
+            arr = render_grid_array(data, seq=seq, chunk_idx=step, grid_w=grid_w, grid_h=grid_h,
+                                    bits_per_symbol=bits, cell=1)[1:-1, 1:-1]
+            frame = np.full((height, width, 3), 255, dtype=np.uint8)
+            for ys in (slice(0, b), slice(height - b, height)):
+                for xs in (slice(0, b), slice(width - b, width)):
+                    frame[ys, xs] = (255, 0, 0)
+            frame[b:height - b, b:width - b] = cv2.resize(arr, (width - 2 * b, height - 2 * b),
+                                                          interpolation=cv2.INTER_NEAREST)
+            yield step, seq, frame
+
+
+def stream_rate(plan: Dict) -> int:
+    """Output FPS at which every step's rate is a whole number of repeated frames."""
+    rate = 1
+    for step in plan['steps']:
+        rate = math.lcm(rate, int(step[3]))
+    return rate
+
+
+class CalibrationAnalyzer:
+    """Measure a calibration sweep on the receiver and recommend the best setting.
+
+    Each capture is decoded with every geometry in the plan (the one that
+    last matched first); the frame header names the step and frame, so the
+    known content can be regenerated and compared symbol by symbol.
+    """
+
+    def __init__(self, plan: Dict):
+        self.plan = plan
+        self.steps = plan['steps']
+        self.geometries = list(dict.fromkeys((w, h, b) for w, h, b, _fps, _n in self.steps))
+        self._last = self.geometries[0]
+        self.best: List[Dict[int, int]] = [{} for _ in self.steps]  # per step: seq -> fewest symbol errors
+        self.errors = [0] * len(self.steps)
+        self.symbols = [0] * len(self.steps)
+        self.captures = 0
+        self.undecoded = 0
+
+    def decode(self, img: Union[Image.Image, np.ndarray], corners=None,
+               channel_order: str = 'RGB') -> Optional[Tuple[int, int, int, int]]:
+        """(step, seq, symbol errors, symbols) for one capture (as for decode_grid_image), or None.
+
+        Safe to call from worker threads.
+        """
+        order = [self._last] + [g for g in self.geometries if g != self._last]
+        for grid_w, grid_h, bits in order:
+            result = decode_grid_image(img, grid_w, grid_h, bits, corners=corners, diag={},
+                                       channel_order=channel_order, payload_check=False)
+            if not result:
+                continue
+            header, payload = result
+            step, seq = header['chunk_idx'], header['seq']
+            if step >= len(self.steps) or tuple(self.steps[step][:3]) != (grid_w, grid_h, bits) \
+                    or seq >= self.steps[step][4]:
+                continue  # a valid header from some other stream
+            self._last = (grid_w, grid_h, bits)
+            expected = pattern_payload(self.plan['seed'], step, seq, len(payload))
+            got = _bytes_to_symbols(payload, bits)
+            want = _bytes_to_symbols(expected, bits)
+            return step, seq, int(np.count_nonzero(got != want)), len(want)
+        return None
+
+    def add(self, observation: Optional[Tuple[int, int, int, int]]):
+        self.captures += 1
+        if observation is None:
+            self.undecoded += 1
+            return
+        step, seq, errors, symbols = observation
+        prev = self.best[step].get(seq)
+        self.best[step][seq] = errors if prev is None else min(prev, errors)
+        self.errors[step] += errors
+        self.symbols[step] += symbols
+
+    def feed(self, img: Union[Image.Image, np.ndarray], corners=None, channel_order: str = 'RGB'):
+        self.add(self.decode(img, corners, channel_order))
+
+    def results(self) -> List[Dict]:
+        out = []
+        for step, (grid_w, grid_h, bits, fps, frames) in enumerate(self.steps):
+            captured = len(self.best[step])
+            clean = sum(1 for e in self.best[step].values() if e == 0)
+            payload = frame_payload_size(grid_w, grid_h, bits)
+            out.append({
+                'step': step, 'grid': [grid_w, grid_h], 'bits': bits, 'fps': fps,
+                'frames': frames, 'captured': captured,
+                'capture_ratio': captured / frames,
+                'symbol_error_rate': self.errors[step] / self.symbols[step] if self.symbols[step] else None,
+                'clean_ratio': clean / frames,
+                # Only error-free frames count: a chunk with a wrong symbol is lost
+                'goodput_Bps': payload * fps * clean / frames,
+            })
+        return out
+
+    def recommend(self) -> Optional[Dict]:
+        """The measured setting with the highest expected goodput."""
+        candidates = [r for r in self.results() if r['goodput_Bps'] > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda r: (r['goodput_Bps'], -(r['symbol_error_rate'] or 0)))
+
+    def progress(self) -> Tuple[int, int]:
+        """(frames captured, frames in the sweep)."""
+        return sum(len(b) for b in self.best), sum(s[4] for s in self.steps)
+
+    def report(self) -> str:
+        lines = [f"{'grid':>7} {'bits':>4} {'fps':>4} {'captured':>9} {'SER':>9} {'clean':>6} {'goodput':>11}"]
+        for r in self.results():
+            ser = '--' if r['symbol_error_rate'] is None else f"{r['symbol_error_rate']:.2e}"
+            lines.append(f"{r['grid'][0]:>3}x{r['grid'][1]:<3} {r['bits']:>4} {r['fps']:>4} "
+                         f"{r['captured']:>4}/{r['frames']:<4} {ser:>9} {r['clean_ratio']:>6.0%} "
+                         f"{r['goodput_Bps'] / 1024:>7.1f} KB/s")
+        best = self.recommend()
+        if best:
+            lines.append(f"Recommended: {best['grid'][0]}x{best['grid'][1]} cells, {best['bits']} bits/symbol "
+                         f"({2 ** best['bits']} colours) at {best['fps']} FPS, "
+                         f"~{best['goodput_Bps'] / 1024:.1f} KB/s")
+        else:
+            lines.append("No setting delivered error-free frames; check focus, corners and lighting")
+        return '\n'.join(lines)
@@ -0,0 +1,152 @@
+import threading
+from functools import lru_cache
+from queue import Queue
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+import cv2
+from .tiling import Layout, decode_mosaic, detect_layout
+from .decoding_grid import PaletteLUT
+from .combining import soft_evidence
+from .profiling import PROFILER
+
+DIFF_THRESHOLD = 3.0  # mean abs difference (0-255) below which a capture repeats the previous one
+THUMB_SIZE = (64, 36)  # one pixel per grid cell is enough to tell frames apart
+PREFETCH_DEPTH = 64
+
+
+def open_capture(source: Union[str, int]) -> cv2.VideoCapture:
+    """Open a video file, or a capture device when source is an integer index."""
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise IOError(f'Cannot open video source {source!r}')
+    return cap
+
+
+def iter_capture(cap: cv2.VideoCapture) -> Iterator[np.ndarray]:
+    """Yield BGR frames until the stream ends."""
+    while True:
+        with PROFILER.stage('read'):
+            ok, frame = cap.read()
+        if not ok:
+            return
+        yield frame
+
+
+class FrameDeduper:
+    """Drop captures that repeat the previous kept frame.
+
+    Each frame is shrunk to a grayscale thumbnail with area averaging (which
+    also averages away sensor noise) and compared with the last kept one, so
+    a sender holding a frame for several capture periods costs one decode.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, thumb_size: Tuple[int, int] = THUMB_SIZE):
+        self.threshold = DIFF_THRESHOLD if threshold is None else threshold
+        self.thumb_size = thumb_size
+        self._last = None
+        self.seen = 0
+        self.dropped = 0
+
+    def is_new(self, frame: np.ndarray) -> bool:
+        self.seen += 1
+        with PROFILER.stage('dedup'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+            thumb = cv2.resize(gray, self.thumb_size, interpolation=cv2.INTER_AREA)
+            repeat = self._last is not None and cv2.absdiff(thumb, self._last).mean() < self.threshold
+        if repeat:
+            self.dropped += 1
+            return False
+        self._last = thumb
+        return True
+
+    def filter(self, frames: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        for frame in frames:
+            if self.is_new(frame):
+                yield frame
+
+
+def prefetch(items: Iterable, depth: int = PREFETCH_DEPTH) -> Iterator:
+    """Pull items from a background thread, so reading overlaps with the consumer."""
+    queue = Queue(maxsize=depth)
+    done = object()
+    error = []
+
+    def run():
+        try:
+            for item in items:
+                queue.put(item)
+        except Exception as e:  # re-raised in the consumer
+            error.append(e)
+        finally:
+            queue.put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is done:
+            break
+        yield item
+    if error:
+        raise error[0]
+
+
+def pixel_corners(corners: Optional[Sequence[Tuple[float, float]]], width: int, height: int) -> Optional[List[Tuple[int, int]]]:
+    """Map normalized (0.0-1.0) corners to pixel coordinates, as the receiver GUI does."""
+    if not corners or len(corners) != 4:
+        return None
+    return [(int(x * width), int(y * height)) for x, y in corners]
+
+
+@lru_cache(maxsize=None)
+def _pyzbar_decode():
+    """pyzbar's decode, imported on the first scan, or None without libzbar."""
+    try:
+        from pyzbar.pyzbar import decode
+    except ImportError:  # libzbar missing: fall back to OpenCV's detector
+        return None
+    return decode
+
+
+def scan_qr_codes(gray: np.ndarray) -> List[bytes]:
+    """Payloads of all QR codes in a grayscale image."""
+    decode_qr = _pyzbar_decode()
+    if decode_qr is not None:
+        return [code.data for code in decode_qr(gray)]
+    # The ArUco-based detector (OpenCV 4.8+) also reads the dense version 20+ codes of a large manifest
+    detector = cv2.QRCodeDetectorAruco() if hasattr(cv2, 'QRCodeDetectorAruco') else cv2.QRCodeDetector()
+    ok, texts, _points, _codes = detector.detectAndDecodeMulti(gray)
+    return [text.encode('utf-8') for text in texts if text] if ok else []
+
+
+def decode_capture(frame: np.ndarray, corners: Optional[Sequence[Tuple[float, float]]] = None,
+                   scan_qr: bool = True, layout: Optional[Layout] = (1, 1),
+                   lut: Optional[PaletteLUT] = None) -> Optional[Tuple]:
+    """Decode one BGR capture.
+
+    Returns ('grid', [(header, payload), ...], soft) for a data frame, one
+    entry per tile that decoded and soft evidence (see SoftCombiner) for
+    those that failed only their payload CRC, ('qr', [payloads]) for
+    manifest QR codes, or None. A layout of None is detected from the
+    tiles' phase markers. QR scanning is only attempted when the grid
+    decode fails and scan_qr is set, i.e. while the manifest is incomplete.
+    lut is shared by all captures, so its tables follow the lighting.
+    """
+    h, w = frame.shape[:2]
+    corners = pixel_corners(corners, w, h)
+    if layout is None:
+        layout = detect_layout(frame, corners) or (1, 1)
+    # Captures are already decoded on a pool; tiles of one capture stay on its thread
+    diags = []
+    results = decode_mosaic(frame, layout, corners, channel_order='BGR', workers=1, diags=diags, lut=lut)
+    decoded = [r for r in results if r]
+    soft = soft_evidence(diags)
+    if decoded or soft:
+        return 'grid', decoded, soft
+    if scan_qr:
+        with PROFILER.stage('qr_scan'):
+            codes = scan_qr_codes(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if codes:
+            return 'qr', codes
+    return None
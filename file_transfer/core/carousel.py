@@ -0,0 +1,128 @@
+from bisect import bisect_left
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+QR_EVERY = 50  # data frames between manifest re-injections in a carousel
+ROTATE_STEP = 0.382  # start offset advance per cycle, as a fraction of the cycle (golden section: offsets spread evenly)
+QR_GAP_STEP = 0.382  # slope of the 0/1 sequence added to qr_every between manifests (irrational-like: never periodic)
+
+Slot = Tuple[str, int]  # ('qr', manifest part) or ('data', data frame index)
+
+
+def lead_frames(lead_chunks: int, per_frame: int, frame_count: int) -> int:
+    """Data frames holding the first lead_chunks chunks (a manifest's order.lead_chunks)."""
+    return min(-(-lead_chunks // per_frame), frame_count)
+
+
+def frames_for_chunks(ranges: Iterable[Tuple[int, int]], per_frame: int, frame_count: int) -> List[int]:
+    """Data frames holding any chunk of the half-open [start, stop) chunk ranges, in order."""
+    frames = set()
+    for start, stop in ranges:
+        first, last = start // per_frame, min((stop - 1) // per_frame, frame_count - 1)
+        frames.update(range(first, last + 1))
+    return sorted(frames)
+
+
+class Scheduler:
+    """Display order of a looping sender, generated lazily one slot at a time.
+
+    The base scheduler plays the manifest QR parts, then every data frame
+    in order, and starts over. Subclasses change the order within a cycle
+    (data_order) and when the manifest is shown again (qr_every, in data
+    frames; 0 shows it only at the start of each cycle). The gap between
+    manifests alternates between qr_every and qr_every + 1 frames in a
+    pattern that never repeats, so a camera that loses every k-th
+    displayed frame cannot keep missing the manifest.
+
+    set_missing() restricts the cycles to some data frames, e.g. those
+    holding the chunks a receiver reports missing; it takes effect at the
+    next slot, starting a new cycle. set_missing(None) goes back to all.
+
+    The first lead data frames hold the files a transfer sends first (see
+    manifest.order_files); every cycle starts with them, whatever order
+    data_order gives the rest.
+    """
+
+    def __init__(self, qr_count: int, frame_count: int, qr_every: int = 0, lead: int = 0):
+        self.qr_count = qr_count
+        self.frame_count = frame_count
+        self.qr_every = qr_every
+        self.lead = lead
+        self.cycle = 0  # cycles started so far, minus one
+        self.position = 0  # data frames shown in the current cycle
+        self._only: Optional[List[int]] = None
+        self._version = 0
+
+    def set_missing(self, frames: Optional[Sequence[int]]):
+        """Repeat only these data frames (None or empty: all of them)."""
+        frames = sorted({f for f in frames if 0 <= f < self.frame_count}) if frames else []
+        self._only = frames or None
+        self._version += 1
+
+    @property
+    def cycle_frames(self) -> Sequence[int]:
+        """Data frames of one cycle before reordering."""
+        return range(self.frame_count) if self._only is None else self._only
+
+    def data_order(self, cycle: int, frames: Sequence[int]) -> Iterable[int]:
+        return frames
+
+    def slots(self, cycles: int = None) -> Iterator[Slot]:
+        """Slots to display, forever or for cycles cycles."""
+        qr = [('qr', k) for k in range(self.qr_count)]
+        if not self.frame_count:
+            while qr:
+                yield from qr
+                if cycles is not None:
+                    return
+        since_qr = None  # data frames since the manifest was last shown
+        injected = 0
+        self.cycle = -1
+        while cycles is None or self.cycle + 1 < cycles:
+            self.cycle += 1
+            self.position = 0
+            version = self._version
+            if not self.qr_every:
+                since_qr = None
+            frames = self.cycle_frames
+            split = bisect_left(frames, self.lead)
+            for frame in chain(frames[:split], self.data_order(self.cycle, frames[split:])):
+                # gap is qr_every plus the step of a Sturmian (non-periodic) 0/1 sequence
+                if since_qr is None or (self.qr_every and since_qr >= self.qr_every + int(injected * QR_GAP_STEP)
+                                        - int((injected - 1) * QR_GAP_STEP)):
+                    yield from qr
+                    since_qr = 0
+                    injected += 1
+                yield 'data', frame
+                since_qr += 1
+                self.position += 1
+                if self._version != version:
+                    break
+
+    def __iter__(self) -> Iterator[Slot]:
+        return self.slots()
+
+
+class Carousel(Scheduler):
+    """Loop over the data frames so that a receiver can join at any time.
+
+    The manifest is re-inserted every qr_every data frames, so a late
+    receiver waits at most that long for it, and each cycle starts
+    ROTATE_STEP of a cycle further on, so frames that a receiver missed
+    near the end of one cycle come round early in a later one.
+    """
+
+    def __init__(self, qr_count: int, frame_count: int, qr_every: int = QR_EVERY, rotate: bool = True,
+                 lead: int = 0):
+        super().__init__(qr_count, frame_count, qr_every, lead)
+        self.rotate = rotate
+
+    def data_order(self, cycle: int, frames: Sequence[int]) -> Iterable[int]:
+        n = len(frames)
+        if not self.rotate or n < 2:
+            return frames
+        start = round(cycle * ROTATE_STEP * n) % n
+        return (frames[(start + i) % n] for i in range(n))  # lazy: nothing is built per cycle
+
+
+SCHEDULERS = {'linear': Scheduler, 'carousel': Carousel}
@@ -0,0 +1,220 @@
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+import numpy as np
+import cv2
+from PIL import Image
+from .compression import parallel_map
+from .encoding_grid import CELL_SIZE
+
+BACKGROUND = (40, 40, 40)  # bezel / room around the screen
+NOISE_BANK_FRAMES = 4  # pre-generated sensor noise, sliced at a random offset per capture
+RS_BAND = 0.08  # rolling-shutter transition band, as a fraction of the frame height
+RS_READOUT = 0.75  # sensor readout time, as a fraction of the camera frame period
+CLOCK_DRIFT = 0.01  # camera vs display clock mismatch, so captures sweep across display switches
+
+
+def _to_array(frame: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    if isinstance(frame, Image.Image):
+        return np.asarray(frame.convert('RGB'))
+    if frame.ndim == 2:
+        return np.repeat(frame[:, :, None], 3, axis=2)
+    return frame
+
+
+def grid_corners(width: int, height: int, cell: int = CELL_SIZE) -> np.ndarray:
+    """TL, TR, BR, BL corners of the data grid (inside the 1-cell border) of a rendered frame."""
+    return np.array([[cell, cell], [width - cell, cell],
+                     [width - cell, height - cell], [cell, height - cell]], dtype=np.float32)
+
+
+class ChannelSimulator:
+    """Turn rendered sender frames into camera-like captures.
+
+    Each capture goes through, in order: a random drop, rolling-shutter
+    blending with the next frame, a perspective warp onto the camera sensor,
+    Gaussian blur, per-channel gamma and white-balance gain, uneven lighting
+    (vignetting and a glare spot), additive sensor noise and JPEG
+    compression. Every stage is a whole-image OpenCV/numpy
+    operation, and the randomness of capture i depends only on (seed, i), so
+    a run is reproducible even when frames are degraded on several threads.
+    """
+
+    def __init__(self, seed: int = 0, size: Tuple[int, int] = (960, 540), fill: float = 0.85,
+                 warp: float = 0.03, blur: float = 0.8, noise: float = 3.0, gamma: float = 0.1,
+                 white_balance: float = 0.08, jpeg_quality: Optional[int] = 85,
+                 rolling_shutter: float = 0.0, drop_rate: float = 0.0, vignette: float = 0.0,
+                 glare: float = 0.0):
+        """
+        size: (width, height) of the simulated capture.
+        fill: fraction of the capture width/height the screen spans.
+        warp: random displacement of each screen corner, as a fraction of the capture size.
+        blur: Gaussian blur sigma in capture pixels (0 disables).
+        noise: sensor noise standard deviation in 8-bit levels (0 disables).
+        gamma: gamma is drawn from [1 - gamma, 1 + gamma].
+        white_balance: per-channel gain is drawn from [1 - wb, 1 + wb].
+        jpeg_quality: JPEG/MJPEG quality, or None for no compression.
+        rolling_shutter: probability that a capture straddles the switch to the next frame.
+        drop_rate: probability that a capture is lost.
+        vignette: brightness lost at the capture corners, as a fraction (falls off with radius squared).
+        glare: peak brightness a reflection adds at a random spot, as a fraction of full scale.
+        """
+        self.seed = seed
+        self.size = size
+        self.fill = fill
+        self.warp = warp
+        self.blur = blur
+        self.noise = noise
+        self.gamma = gamma
+        self.white_balance = white_balance
+        self.jpeg_quality = jpeg_quality
+        self.rolling_shutter = rolling_shutter
+        self.drop_rate = drop_rate
+        self.vignette = vignette
+        self.glare = glare
+        self._noise_bank = None
+        if noise > 0:
+            w, h = size
+            bank = np.random.default_rng([seed, 0x6e6f]).normal(0, noise, (h * NOISE_BANK_FRAMES, w, 3))
+            self._noise_bank = np.clip(np.rint(bank), -127, 127).astype(np.int16)
+
+    def _homography(self, rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+        out_w, out_h = self.size
+        scale = self.fill * min(out_w / width, out_h / height)
+        x0, y0 = (out_w - width * scale) / 2, (out_h - height * scale) / 2
+        src = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+        dst = src * scale + np.array([x0, y0], dtype=np.float32)
+        dst += rng.uniform(-self.warp, self.warp, (4, 2)).astype(np.float32) * np.array([out_w, out_h], dtype=np.float32)
+        return cv2.getPerspectiveTransform(src, dst)
+
+    def _rolling_shutter(self, rng: np.random.Generator, cur: np.ndarray, nxt: np.ndarray,
+                         switch: Optional[float] = None) -> np.ndarray:
+        """Rows above the switch line (random, or at fraction switch of the height) show this frame,
+        rows below it the next, with a linear ramp between."""
+        h = cur.shape[0]
+        band = max(1, int(h * RS_BAND))
+        start = int(rng.integers(-band, h)) if switch is None else int(switch * h) - band // 2
+        out = cur.copy()
+        lo, hi = max(start, 0), min(start + band, h)
+        if hi > lo:
+            alpha = ((np.arange(lo, hi) - start + 0.5) / band).astype(np.float32)[:, None, None]
+            out[lo:hi] = (cur[lo:hi] * (1 - alpha) + nxt[lo:hi] * alpha + 0.5).astype(np.uint8)
+        out[max(hi, 0):] = nxt[max(hi, 0):]
+        return out
+
+    def _color_lut(self, rng: np.random.Generator) -> np.ndarray:
+        levels = np.arange(256, dtype=np.float32) / 255.0
+        gamma = rng.uniform(1 - self.gamma, 1 + self.gamma)
+        gains = rng.uniform(1 - self.white_balance, 1 + self.white_balance, 3)
+        lut = np.stack([255.0 * levels ** gamma * g for g in gains], axis=1)
+        return np.clip(np.rint(lut), 0, 255).astype(np.uint8).reshape(256, 1, 3)
+
+    def _lighting(self, rng: np.random.Generator, img: np.ndarray) -> np.ndarray:
+        """Darken towards the corners and wash out a Gaussian spot (a quarter of the height wide)."""
+        h, w = img.shape[:2]
+        y = (np.arange(h, dtype=np.float32) - h / 2) / (h / 2)
+        x = (np.arange(w, dtype=np.float32) - w / 2) / (w / 2)
+        gain = 1 - self.vignette * (x[None, :] ** 2 + y[:, None] ** 2) / 2
+        out = img * gain[:, :, None]
+        if self.glare > 0:
+            gx, gy = rng.uniform(0.2, 0.8) * w, rng.uniform(0.2, 0.8) * h
+            s = h / 4
+            spot = np.exp(-(np.arange(w, dtype=np.float32) - gx) ** 2 / (2 * s * s))[None, :] \
+                * np.exp(-(np.arange(h, dtype=np.float32) - gy) ** 2 / (2 * s * s))[:, None]
+            out += (255 * self.glare) * spot[:, :, None]
+        return np.clip(out, 0, 255).astype(np.uint8)
+
+    def capture(self, index: int, frame: Union[Image.Image, np.ndarray],
+                next_frame: Union[Image.Image, np.ndarray, None] = None,
+                cell: int = CELL_SIZE, switch: Optional[float] = None) -> Optional[Tuple[np.ndarray, List[Tuple[int, int]]]]:
+        """Simulate capture number index of frame (rendered with cell-pixel cells).
+
+        With next_frame, the capture straddles the switch to it with the
+        rolling_shutter probability, or always if switch (the fraction of
+        the rows read before the display switched) is given.
+
+        Returns (rgb, corners) where corners are the pixel positions of the
+        data grid (TL, TR, BR, BL) for decode_grid_image, or None if dropped.
+        """
+        rng = np.random.default_rng([self.seed, index])
+        if rng.random() < self.drop_rate:
+            return None
+        src = _to_array(frame)
+        if next_frame is not None and (switch is not None or rng.random() < self.rolling_shutter):
+            src = self._rolling_shutter(rng, src, _to_array(next_frame), switch)
+
+        height, width = src.shape[:2]
+        M = self._homography(rng, width, height)
+        img = cv2.warpPerspective(src, M, self.size, flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_CONSTANT, borderValue=BACKGROUND)
+        if self.blur > 0:
+            k = 2 * int(np.ceil(2 * self.blur)) + 1  # +-2 sigma; OpenCV's default 6 sigma is 3x slower
+            img = cv2.GaussianBlur(img, (k, k), self.blur)
+        if self.gamma > 0 or self.white_balance > 0:
+            img = cv2.LUT(img, self._color_lut(rng))
+        if self.vignette > 0 or self.glare > 0:
+            img = self._lighting(rng, img)
+        if self._noise_bank is not None:
+            off = int(rng.integers(0, self._noise_bank.shape[0] - img.shape[0] + 1))
+            noisy = img.astype(np.int16)
+            noisy += self._noise_bank[off:off + img.shape[0]]
+            img = np.clip(noisy, 0, 255, out=noisy).astype(np.uint8)
+        if self.jpeg_quality is not None:
+            # The codec expects BGR; feeding RGB would subsample chroma with red and blue swapped
+            ok, buf = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                                   [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            img = cv2.cvtColor(cv2.imdecode(buf, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+        corners = cv2.perspectiveTransform(grid_corners(width, height, cell)[None], M)[0]
+        return img, [(int(round(x)), int(round(y))) for x, y in corners]
+
+    def simulate(self, frames: Iterable[Union[Image.Image, np.ndarray]], repeat: int = 1,
+                 workers: int = None) -> Iterator[Optional[Tuple[np.ndarray, List[Tuple[int, int]]]]]:
+        """Capture every frame repeat times, in order, on a thread pool.
+
+        The last capture of each frame blends into the following one when
+        rolling shutter is enabled. Dropped captures yield None.
+        """
+        def jobs():
+            prev = None
+            n = 0
+            for frame in frames:
+                if prev is not None:
+                    for r in range(repeat):
+                        yield n, prev, frame if r == repeat - 1 else None
+                        n += 1
+                prev = frame
+            if prev is not None:
+                for _ in range(repeat):
+                    yield n, prev, None
+                    n += 1
+
+        return parallel_map(lambda job: self.capture(*job), jobs(), workers)
+
+    def film(self, frames: List[Union[Image.Image, np.ndarray]], display_fps: float, camera_fps: float,
+             captures: int, readout: float = RS_READOUT, drift: float = CLOCK_DRIFT,
+             workers: int = None) -> Iterator[Tuple[int, Optional[Tuple[np.ndarray, List[Tuple[int, int]]]]]]:
+        """Film a display looping over frames at display_fps with a camera at camera_fps.
+
+        Yields (index of the frame on screen when the capture started,
+        capture or None). The sensor reads its rows over readout camera
+        frame periods, so a capture during which the display switches frames
+        is torn at the matching row, as a real rolling shutter would be.
+        The camera clock runs drift faster than nominal, as unsynchronized
+        clocks do; otherwise rates that divide each other would stay locked
+        to one phase.
+        """
+        def jobs():
+            for i in range(captures):
+                start = i / (camera_fps * (1 + drift))
+                shown = int(start * display_fps)
+                switch_at = (shown + 1) / display_fps
+                span = readout / camera_fps
+                if switch_at < start + span:
+                    yield i, shown, frames[(shown + 1) % len(frames)], (switch_at - start) / span
+                else:
+                    yield i, shown, None, None
+
+        def run(job):
+            i, shown, nxt, switch = job
+            return shown, self.capture(i, frames[shown % len(frames)], nxt, switch=switch)
+
+        return parallel_map(run, jobs(), workers)
@@ -1,8 +1,15 @@
 import os
+import bisect
 import hashlib
-from typing import Iterator, Tuple, List
+from typing import Iterator, Tuple, List, Optional
 
 DEFAULT_CHUNK_SIZE = 65536  # 64 KiB
+# Digest algorithms for file, block and Merkle hashes -> longest digest in bytes
+DIGEST_ALGOS = {'sha256': 32, 'blake2b': 64, 'blake2s': 32}
+DEFAULT_DIGEST = 'sha256'
+MIN_DIGEST_SIZE = 16  # shorter digests would let dedup mistake different blocks for one another
+DEFAULT_LEAF_SIZE = 65536  # chunk stream bytes per Merkle leaf, whatever the frame payload size
+HASH_READ_SIZE = 1024 * 1024
 
 def iter_file_chunks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[int, bytes]]:
     """Yield (offset_index, data) for the file at path.
@@ -17,6 +24,64 @@ def iter_file_chunks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterato
             yield idx, data
             idx += 1
 
+def iter_stream_chunks(paths: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[int, bytes]]:
+    """Yield (chunk_index, data) over the concatenation of all files in paths.
+    Chunks run across file boundaries, so small files share chunks instead of
+    each padding out a partially filled one.
+    """
+    buf = bytearray()
+    idx = 0
+    for p in paths:
+        with open(p, 'rb') as f:
+            while True:
+                data = f.read(chunk_size - len(buf))
+                if not data:
+                    break
+                buf += data
+                if len(buf) == chunk_size:
+                    yield idx, bytes(buf)
+                    buf.clear()
+                    idx += 1
+    if buf:
+        yield idx, bytes(buf)
+
+class StreamMap:
+    """Locate byte ranges of a concatenated stream within its member files."""
+
+    def __init__(self, sizes: List[int], offsets: List[int] = None):
+        if offsets is None:
+            offsets, pos = [], 0
+            for size in sizes:
+                offsets.append(pos)
+                pos += size
+        self.sizes = list(sizes)
+        self.offsets = list(offsets)
+        # Empty files occupy no bytes and never receive data
+        self._members = [i for i, size in enumerate(self.sizes) if size > 0]
+        self._starts = [self.offsets[i] for i in self._members]
+
+    def segments(self, pos: int, length: int) -> List[Tuple[int, int, int, int]]:
+        """Map stream[pos:pos+length] to (file_index, file_offset, data_start, data_end) segments."""
+        base = pos
+        end = pos + length
+        out = []
+        i = max(bisect.bisect_right(self._starts, pos) - 1, 0)
+        while i < len(self._members) and pos < end:
+            fi = self._members[i]
+            f_start = self.offsets[fi]
+            f_end = f_start + self.sizes[fi]
+            i += 1
+            if pos >= f_end:
+                continue
+            if pos < f_start:
+                pos = f_start  # a gap in the stream (not produced by build_manifest)
+                if pos >= end:
+                    break
+            seg_end = min(end, f_end)
+            out.append((fi, pos - f_start, pos - base, seg_end - base))
+            pos = seg_end
+        return out
+
 def collect_files(root: str) -> List[str]:
     """Return a sorted list of file paths (recursively) or the single file if root is a file."""
     if os.path.isfile(root):
@@ -28,22 +93,93 @@ def collect_files(root: str) -> List[str]:
             paths.append(full)
     return sorted(paths)
 
-def hash_file_sha256(path: str) -> str:
-    h = hashlib.sha256()
+def collect_empty_dirs(root: str) -> List[str]:
+    """Return the sorted directories under root (a folder) holding neither files nor subdirectories."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(base for base, dirs, files in os.walk(root) if base != root and not dirs and not files)
+
+def digest_size(algo: str = DEFAULT_DIGEST, size: Optional[int] = None) -> int:
+    """Check an algorithm and digest length in bytes (None: the algorithm's full length); returns the length."""
+    if algo not in DIGEST_ALGOS:
+        raise ValueError(f"Unknown digest {algo!r} (choose from {', '.join(DIGEST_ALGOS)})")
+    longest = DIGEST_ALGOS[algo]
+    size = longest if size is None else size
+    if not MIN_DIGEST_SIZE <= size <= longest:
+        raise ValueError(f'{algo} digests are {MIN_DIGEST_SIZE} to {longest} bytes, not {size}')
+    return size
+
+def new_hash(algo: str = DEFAULT_DIGEST, size: Optional[int] = None):
+    """A hashlib object; BLAKE2 is parameterized for size-byte output, sha256 is cut by hex_digest()."""
+    if algo == 'sha256':
+        return hashlib.sha256()
+    return getattr(hashlib, algo)(digest_size=digest_size(algo, size))
+
+def hex_digest(h, size: Optional[int] = None) -> str:
+    return h.hexdigest()[:2 * size] if size else h.hexdigest()
+
+def data_digest(data: bytes, algo: str = DEFAULT_DIGEST, size: Optional[int] = None) -> str:
+    h = new_hash(algo, size)
+    h.update(data)
+    return hex_digest(h, size)
+
+def hash_file(path: str, algo: str = DEFAULT_DIGEST, size: Optional[int] = None) -> str:
+    h = new_hash(algo, size)
     with open(path, 'rb') as f:
-        for block in iter(lambda: f.read(1024 * 1024), b''):
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
             h.update(block)
-    return h.hexdigest()
+    return hex_digest(h, size)
+
+def hash_file_sha256(path: str) -> str:
+    return hash_file(path)
+
+class LeafHasher:
+    """Merkle leaves of a byte stream fed in pieces of any size: one digest per leaf_size bytes."""
+
+    def __init__(self, leaf_size: int = DEFAULT_LEAF_SIZE, algo: str = DEFAULT_DIGEST, size: Optional[int] = None):
+        self.leaf_size = leaf_size
+        self.algo, self.size = algo, size
+        self.leaves: List[str] = []
+        self._h = new_hash(algo, size)
+        self._fill = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.leaf_size - self._fill)
+            self._h.update(view[:n])
+            self._fill += n
+            view = view[n:]
+            if self._fill == self.leaf_size:
+                self.leaves.append(hex_digest(self._h, self.size))
+                self._h = new_hash(self.algo, self.size)
+                self._fill = 0
+
+    def finish(self) -> List[str]:
+        if self._fill:
+            self.leaves.append(hex_digest(self._h, self.size))
+            self._fill = 0
+        return self.leaves
+
+def stream_digests(file_paths: List[str], leaf_size: int = DEFAULT_LEAF_SIZE, algo: str = DEFAULT_DIGEST,
+                   size: Optional[int] = None) -> Tuple[List[str], List[str]]:
+    """(file digests, Merkle leaves of the concatenated stream), reading every file once."""
+    leaves = LeafHasher(leaf_size, algo, size)
+    digests = []
+    for path in file_paths:
+        h = new_hash(algo, size)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                h.update(block)
+                leaves.update(block)
+        digests.append(hex_digest(h, size))
+    return digests, leaves.finish()
 
 def build_merkle_leaves(file_paths: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[str]:
-    """Compute sha256 for each chunk as hex string (leaf). Heavy for huge sets; prototype only."""
-    leaves = []
-    for p in file_paths:
-        for _idx, data in iter_file_chunks(p, chunk_size):
-            leaves.append(hashlib.sha256(data).hexdigest())
-    return leaves
-
-def merkle_root(leaves: List[str]) -> str:
+    """Compute sha256 for each chunk of the concatenated stream as hex string (leaf). Heavy for huge sets; prototype only."""
+    return stream_digests(file_paths, chunk_size)[1]
+
+def merkle_root(leaves: List[str], algo: str = DEFAULT_DIGEST, size: Optional[int] = None) -> str:
     """Compute a simple binary Merkle root from hex digest leaves."""
     if not leaves:
         return ''
@@ -55,6 +191,8 @@ def merkle_root(leaves: List[str]) -> str:
                 pair = level[i] + level[i]  # duplicate last
             else:
                 pair = level[i] + level[i+1]
-            nxt.append(hashlib.sha256(pair).digest())
+            h = new_hash(algo, size)
+            h.update(pair)
+            nxt.append(h.digest()[:size] if size else h.digest())
         level = nxt
     return level[0].hex()
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+from .decoding_grid import decode_soft
+
+SOFT_CACHE_FRAMES = 64  # incomplete frames whose evidence is kept; the least recently seen is evicted first
+
+
+def soft_evidence(diags: Iterable[dict]) -> List[Tuple[dict, np.ndarray]]:
+    """(header, distances) of every tile whose header decoded but whose payload CRC failed."""
+    return [(d['header'], d['soft']) for d in diags if d.get('error') == 'payload']
+
+
+class SoftCombiner:
+    """Combine repeated captures of a frame until its payload CRC checks.
+
+    The sender loops, so a frame that one capture misreads in a few cells
+    usually comes round again. Each failed capture leaves the squared
+    distance of every cell to every palette colour; summing them over
+    captures lets the clear readings of a cell outvote the marginal ones,
+    so a frame can be recovered from two or three imperfect captures.
+    Evidence is kept for at most max_frames frames, least recently seen
+    evicted first. Not thread-safe: feed it from the thread that writes
+    chunks.
+    """
+
+    def __init__(self, bits_per_symbol: int = 2, max_frames: int = SOFT_CACHE_FRAMES):
+        self.bits_per_symbol = bits_per_symbol
+        self.max_frames = max_frames
+        self._frames: 'OrderedDict[Tuple[int, int], list]' = OrderedDict()  # (seq, chunk_idx) -> [sum, captures]
+        self.combined = 0  # frames recovered from several captures
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def add(self, header: dict, dists: np.ndarray) -> Optional[Tuple[dict, bytes]]:
+        """Add one failed capture of a frame; returns (header, payload) once the combined evidence checks."""
+        key = (header['seq'], header['chunk_idx'])
+        entry = self._frames.pop(key, None)
+        if entry is None or entry[0].shape != dists.shape:
+            entry = [np.array(dists, dtype=np.float32), 1]
+        else:
+            entry[0] += dists
+            entry[1] += 1
+            result = decode_soft(entry[0], self.bits_per_symbol)
+            if result and (result[0]['seq'], result[0]['chunk_idx']) == key:
+                self.combined += 1
+                return result
+        self._frames[key] = entry
+        while len(self._frames) > self.max_frames:
+            self._frames.popitem(last=False)
+            self.evicted += 1
+        return None
+
+    def discard(self, header: dict):
+        """Forget a frame that has been decoded from a single capture."""
+        self._frames.pop((header['seq'], header['chunk_idx']), None)
+
+    def collect(self, decoded: Iterable[Tuple[dict, bytes]],
+                soft: Iterable[Tuple[dict, np.ndarray]]) -> List[Tuple[dict, bytes]]:
+        """The frames one capture decoded directly, plus those its failed tiles completed."""
+        out = []
+        for header, payload in decoded:
+            self.discard(header)
+            out.append((header, payload))
+        for header, dists in soft:
+            result = self.add(header, dists)
+            if result:
+                out.append(result)
+        return out
@@ -0,0 +1,140 @@
+import bz2
+import lzma
+import math
+import os
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Compression modes accepted by build_manifest
+MODES = ('off', 'fast', 'auto', 'max')
+
+# Blocks whose sampled entropy is above this are treated as already compressed
+# (archives, media, encrypted data) and sent raw without trying any codec.
+ENTROPY_SKIP = 7.2  # bits per byte
+SAMPLE_SLICES = 8
+SAMPLE_SLICE_LEN = 512
+
+_LZMA_FILTERS = {p: [{'id': lzma.FILTER_LZMA2, 'preset': p}] for p in (6, 9)}
+
+
+def estimate_entropy(data: bytes) -> float:
+    """Cheap Shannon entropy estimate (bits/byte) from a few evenly spaced samples."""
+    n = len(data)
+    if n == 0:
+        return 0.0
+    if n <= SAMPLE_SLICES * SAMPLE_SLICE_LEN:
+        sample = data
+    else:
+        step = n // SAMPLE_SLICES
+        sample = b''.join(data[i * step: i * step + SAMPLE_SLICE_LEN] for i in range(SAMPLE_SLICES))
+    total = len(sample)
+    ent = 0.0
+    for count in Counter(sample).values():
+        p = count / total
+        ent -= p * math.log2(p)
+    return ent
+
+
+def constant_byte(data: bytes) -> Optional[int]:
+    """The byte value data consists of, if it is one byte repeated (all zeros, say); None otherwise or if empty."""
+    if not data or data[0] != data[-1]:
+        return None
+    return data[0] if data == data[:1] * len(data) else None
+
+
+def fill_codec(value: int) -> str:
+    return f'fill:{value}'
+
+
+def fill_value(codec: str) -> Optional[int]:
+    """The byte a 'fill:<value>' codec repeats, or None for any other codec."""
+    name, _, value = codec.partition(':')
+    return int(value) if name == 'fill' else None
+
+
+def encode(codec: str, data: bytes) -> bytes:
+    """Compress data with a codec string such as 'zlib:6', 'bz2:9', 'lzma:6' or 'raw'.
+
+    'fill:<value>' encodes a constant block to nothing: its codec and length describe it.
+    """
+    name, _, level = codec.partition(':')
+    if name == 'raw':
+        return bytes(data)
+    if name == 'fill':
+        return b''
+    if name == 'zlib':
+        return zlib.compress(data, int(level))
+    if name == 'bz2':
+        return bz2.compress(data, int(level))
+    if name == 'lzma':
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS[int(level)])
+    raise ValueError(f'Unknown codec: {codec}')
+
+
+def decode(codec: str, data: bytes) -> bytes:
+    name, _, level = codec.partition(':')
+    if name == 'raw':
+        return bytes(data)
+    if name == 'zlib':
+        return zlib.decompress(data)
+    if name == 'bz2':
+        return bz2.decompress(data)
+    if name == 'lzma':
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS[int(level)])
+    raise ValueError(f'Unknown codec: {codec}')
+
+
+def _candidates(mode: str, entropy: float) -> List[str]:
+    if mode == 'fast':
+        return ['zlib:1']
+    if mode == 'max':
+        return ['zlib:9', 'bz2:9', 'lzma:9']
+    # auto: zlib everywhere, the slower codecs only where they tend to pay off
+    if entropy < 6.0:
+        return ['zlib:6', 'bz2:9', 'lzma:6']
+    return ['zlib:6']
+
+
+def compress_block(data: bytes, mode: str = 'auto') -> Tuple[str, bytes]:
+    """Pick the smallest encoding of one block; returns (codec, encoded)."""
+    if mode == 'off' or not data:
+        return 'raw', bytes(data)
+    entropy = estimate_entropy(data)
+    if entropy >= ENTROPY_SKIP:
+        return 'raw', bytes(data)
+    best_codec, best = 'raw', data
+    for codec in _candidates(mode, entropy):
+        enc = encode(codec, data)
+        if len(enc) < len(best):
+            best_codec, best = codec, enc
+        if codec.startswith('zlib') and len(enc) > 0.9 * len(data):
+            break  # zlib barely helps; the heavier codecs won't either
+    return best_codec, bytes(best)
+
+
+def parallel_map(fn, items: Iterable, workers: int = None) -> Iterator:
+    """Ordered map over a thread pool with a bounded look-ahead window.
+
+    zlib, bz2 and lzma release the GIL, so threads scale across cores without
+    holding more than a few blocks in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def compress_blocks(blocks: Iterable[bytes], mode: str = 'auto', workers: int = None) -> Iterator[Tuple[str, bytes]]:
+    """Compress blocks in parallel, yielding (codec, encoded) in input order."""
+    return parallel_map(lambda b: compress_block(b, mode), blocks, workers)
@@ -1,30 +1,38 @@
 import struct
 import zlib
-from typing import Tuple, Optional, List
+from functools import lru_cache
+from typing import Tuple, Optional, List, Union
 from PIL import Image
-import math
 import numpy as np
-import cv2
+from .profiling import PROFILER
+from .encoding_grid import palette_for, phase_marker_cells, reference_cells, data_cell_mask
 
 PALETTE_4 = [(0,0,0),(255,255,255),(255,0,0),(0,255,0)]
 HEADER_ROWS = 2
+HEADER_SIZE = 22
 MAGIC = 0xABCD
+PHASE_MIN_CONTRAST = 120  # white - black reference, summed over RGB, for a marker group to count
+PHASE_MARGIN = 0.5  # min normalized A - B contrast: rejects blends beyond ~25% of the other frame
+REF_MIN_DISTANCE = 24.0  # min RGB distance between a region's reference colours for the region to count
+LUT_BITS = 5  # bits kept per channel to index a PaletteLUT table: 32^3 entries, 8 RGB levels per bin
+LUT_DRIFT = 12.0  # RGB distance a palette colour may move before its table is rebuilt
+LUT_TABLES = 4  # tables a PaletteLUT keeps, e.g. one per tile of a mosaic lit differently
 
-def _color_dist(c1, c2):
-    return sum((a-b)**2 for a,b in zip(c1, c2))
-
-def _refine_palette_and_decode(samples: List[Tuple[int, int, int]]) -> List[int]:
+def _refine_palette_and_decode(samples: List[Tuple[int, int, int]], palette=PALETTE_4) -> List[int]:
     """
     Uses K-Means-like approach to adapt the expected palette to the actual image colors.
     Initializes centroids with the ideal palette, then shifts them to match the data.
     """
-    if not samples:
+    if len(samples) == 0:
         return []
-        
+    return np.argmin(_kmeans_distances(samples, palette), axis=1).tolist()
+
+def _kmeans_distances(samples, palette=PALETTE_4) -> np.ndarray:
+    """(N, colours) squared distances of the samples to the adapted centroids (see _refine_palette_and_decode)."""
     data = np.array(samples, dtype=np.float32)
     
     # Init centroids with expected palette
-    centroids = np.array(PALETTE_4, dtype=np.float32)
+    centroids = np.array(palette, dtype=np.float32)
     
     # Run a few iterations of K-Means to adapt centroids
     # This handles lighting variations (e.g. gray instead of black, dim red)
@@ -36,7 +44,7 @@ def _refine_palette_and_decode(samples: List[Tuple[int, int, int]]) -> List[int]
         
         # Update centroids
         new_centroids = centroids.copy()
-        for i in range(4):
+        for i in range(len(palette)):
             mask = (labels == i)
             if np.any(mask):
                 new_centroids[i] = data[mask].mean(axis=0)
@@ -46,33 +54,220 @@ def _refine_palette_and_decode(samples: List[Tuple[int, int, int]]) -> List[int]
             break
         centroids = new_centroids
         
-    # Final assignment
-    dists = np.linalg.norm(data[:, None] - centroids, axis=2)
-    symbols = np.argmin(dists, axis=1)
-    
-    return symbols.tolist()
-
-def _symbols_to_bytes(symbols: list, bits_per_symbol: int = 2) -> bytes:
-    out = bytearray()
-    buffer = 0
-    bits_in_buffer = 0
-    for sym in symbols:
-        buffer = (buffer << bits_per_symbol) | sym
-        bits_in_buffer += bits_per_symbol
-        while bits_in_buffer >= 8:
-            shift = bits_in_buffer - 8
-            out.append((buffer >> shift) & 0xFF)
-            bits_in_buffer -= 8
-    return bytes(out)
-
-def decode_grid_image(img: Image.Image, grid_w: int = 64, grid_h: int = 36, bits_per_symbol: int = 2, corners: List[Tuple[int, int]] = None) -> Optional[Tuple[dict, bytes]]:
-    img = img.convert('RGB')
+    # Final distances
+    diff = data[:, None] - centroids
+    return np.einsum('nkc,nkc->nk', diff, diff)
+
+@lru_cache(maxsize=None)
+def _reference_weights(grid_w: int, grid_h: int, bits_per_symbol: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(grid_h, regions down) and (grid_w, regions across) linear interpolation weights between the
+    centres of the reference blocks, constant beyond the outermost ones."""
+    ys, xs = reference_cells(grid_w, grid_h, bits_per_symbol)
+    cy = ys[:, 0, :].mean(axis=-1) + 0.5
+    cx = xs[0, :, :].mean(axis=-1) + 0.5
+    wy = np.stack([np.interp(np.arange(grid_h) + 0.5, cy, e) for e in np.eye(len(cy))], axis=1)
+    wx = np.stack([np.interp(np.arange(grid_w) + 0.5, cx, e) for e in np.eye(len(cx))], axis=1)
+    return wy.astype(np.float32), wx.astype(np.float32)
+
+def _reference_colours(cells: np.ndarray, bits_per_symbol: int) -> Optional[np.ndarray]:
+    """(regions down, regions across, colours, 3) palette read from each region's reference block, or None.
+
+    Regions whose reference colours run together (washed out or occluded)
+    take the average of the readable ones; None if none is readable.
+    """
+    grid_h, grid_w = cells.shape[:2]
+    ys, xs = reference_cells(grid_w, grid_h, bits_per_symbol)
+    refs = cells[ys, xs].astype(np.float32)
+    n = refs.shape[2]
+    gaps = np.linalg.norm(refs[:, :, :, None] - refs[:, :, None, :], axis=-1)
+    gaps[:, :, np.arange(n), np.arange(n)] = np.inf
+    readable = gaps.min(axis=(2, 3)) >= REF_MIN_DISTANCE
+    if not readable.any():
+        return None
+    if not readable.all():
+        refs[~readable] = refs[readable].mean(axis=0)
+    return refs
+
+def _local_distances(cells: np.ndarray, bits_per_symbol: int) -> Optional[np.ndarray]:
+    """(grid_h, grid_w, colours) squared distances of a cell sample grid to per-cell palettes, or None.
+
+    Every region's reference block gives the colour each symbol has in that
+    part of the capture; each cell's palette is interpolated between the
+    blocks around it, so glare and vignetting shift the palette with them.
+    None if no reference block is readable (see _reference_colours).
+    """
+    grid_h, grid_w = cells.shape[:2]
+    refs = _reference_colours(cells, bits_per_symbol)
+    if refs is None:
+        return None
+    wy, wx = _reference_weights(grid_w, grid_h, bits_per_symbol)
+    local = np.einsum('yj,xi,jikc->yxkc', wy, wx, refs, optimize=True)  # (grid_h, grid_w, colours, 3)
+    diff = local - cells.astype(np.float32)[:, :, None, :]
+    return np.einsum('yxkc,yxkc->yxk', diff, diff)
+
+class PaletteLUT:
+    """Classify cells with a quantized RGB -> symbol table instead of distances to every colour.
+
+    The table has 2^(3 * lut_bits) entries, each the nearest colour of a
+    palette to the centre of its RGB bin, so classifying a cell is one
+    gather whatever the palette size. The palette is the mean of a
+    capture's reference blocks (see _reference_colours); a table is reused
+    while no colour of the capture's palette has moved more than drift from
+    the one it was built for, and rebuilt (1-2 ms) only when one has.
+    The last LUT_TABLES tables are kept, so tiles or scenes that alternate
+    between lightings do not rebuild every capture.
+
+    The table only knows one palette per capture, not the per-cell ones of
+    _local_distances, and cells within half a bin of a decision boundary
+    may go either way; decode_grid_image falls back to distances whenever
+    a table-classified capture does not decode. Safe to share between
+    threads: tables are replaced, never modified.
+    """
+
+    def __init__(self, lut_bits: int = LUT_BITS, drift: float = LUT_DRIFT, tables: int = LUT_TABLES):
+        if not 1 <= lut_bits <= 8:
+            raise ValueError(f'lut_bits must be 1..8, not {lut_bits}')
+        self.lut_bits = lut_bits
+        self.drift = drift
+        self.max_tables = tables
+        self._tables: List[Tuple[np.ndarray, np.ndarray]] = []  # (palette, table), most recently used first
+        self.builds = 0
+
+    def build(self, palette: np.ndarray) -> np.ndarray:
+        """(bins, bins, bins) uint8 table of the palette colour nearest each bin centre."""
+        step = 1 << (8 - self.lut_bits)
+        centres = np.arange(1 << self.lut_bits, dtype=np.float32) * step + (step - 1) / 2
+        best = np.full((len(centres),) * 3, np.inf, dtype=np.float32)
+        table = np.zeros(best.shape, dtype=np.uint8)
+        for k, (r, g, b) in enumerate(np.asarray(palette, dtype=np.float32)):
+            # squared distance is separable per channel: three 1-D terms broadcast to the cube
+            d = ((centres - r) ** 2)[:, None, None] + ((centres - g) ** 2)[None, :, None] \
+                + ((centres - b) ** 2)[None, None, :]
+            closer = d < best
+            best[closer] = d[closer]
+            table[closer] = k
+        self.builds += 1
+        return table
+
+    def table_for(self, palette: np.ndarray) -> np.ndarray:
+        """A table built for a palette within drift of this one, building it if there is none."""
+        tables = self._tables
+        for i, (built_for, table) in enumerate(tables):
+            if np.sqrt(((palette - built_for) ** 2).sum(axis=-1)).max() <= self.drift:
+                if i:
+                    self._tables = [tables[i]] + tables[:i] + tables[i + 1:]
+                return table
+        table = self.build(palette)
+        self._tables = ([(np.array(palette, dtype=np.float32), table)] + tables)[:self.max_tables]
+        return table
+
+    def classify(self, cells: np.ndarray, palette: np.ndarray) -> np.ndarray:
+        """Symbol of every cell of an (..., 3) uint8 RGB sample grid for the palette it was fitted to."""
+        table = self.table_for(palette)
+        q = (cells >> (8 - self.lut_bits)).astype(np.intp)
+        return table[q[..., 0], q[..., 1], q[..., 2]]
+
+def _symbols_to_bytes(symbols, bits_per_symbol: int = 2) -> bytes:
+    syms = np.asarray(symbols, dtype=np.uint8)
+    # MSB-first bits of every symbol, packed 8 at a time (a trailing partial byte is dropped)
+    bits = (syms[:, None] >> np.arange(bits_per_symbol - 1, -1, -1, dtype=np.uint8)) & 1
+    bits = bits.ravel()
+    return np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
+
+def read_phase_marker(lum: np.ndarray) -> Optional[int]:
+    """Phase (frame parity) from the marker groups' brightness, shape (groups, 4), or -1 if mixed.
+
+    Each group's static white and black cells give a local reference, so
+    uneven lighting does not matter. A torn capture shows both phases, a
+    blended one leaves A and B at similar grey levels; both return -1.
+    None means there is no readable marker (an unmarked frame, or a border
+    lost to glare), in which case the frame should just be decoded.
+    """
+    lum = lum.astype(np.float32)
+    span = lum[:, 0] - lum[:, 1]
+    ok = span >= PHASE_MIN_CONTRAST
+    if np.count_nonzero(ok) * 2 < len(span):
+        return None
+    contrast = (lum[ok, 2] - lum[ok, 3]) / span[ok]
+    phase = 0 if np.median(contrast) > 0 else 1
+    if phase:
+        contrast = -contrast
+    return phase if contrast.min() > PHASE_MARGIN else -1
+
+def _marker_brightness(img_arr: np.ndarray, px: np.ndarray, py: np.ndarray) -> Optional[np.ndarray]:
+    """Summed RGB of the pixels at (px, py), or None if any falls outside the image."""
+    height, width = img_arr.shape[:2]
+    if px.min() < 0 or py.min() < 0 or px.max() >= width or py.max() >= height:
+        return None
+    return img_arr[py, px, :3].sum(axis=-1, dtype=np.int32)
+
+def frame_phase(img_arr: np.ndarray, grid_w: int = 64, grid_h: int = 36,
+                corners: List[Tuple[int, int]] = None) -> Optional[int]:
+    """read_phase_marker for the grid frame in an RGB or BGR array.
+
+    With corners (of the data grid, as for decode_grid_image) the marker
+    cells, one cell outside them, are mapped through the perspective;
+    without, the array is the frame with its border.
+    """
+    xs, ys = phase_marker_cells(grid_w, grid_h)
+    if corners is not None:
+        import cv2
+        grid = np.array([[0, 0], [grid_w, 0], [grid_w, grid_h], [0, grid_h]], dtype=np.float32)
+        M = cv2.getPerspectiveTransform(grid, np.array(corners, dtype=np.float32))
+        cells = np.stack([xs - 0.5, ys - 0.5], axis=-1).reshape(1, -1, 2).astype(np.float32)
+        pts = np.rint(cv2.perspectiveTransform(cells, M)[0]).astype(np.intp)
+        px, py = pts[:, 0], pts[:, 1]
+    else:
+        height, width = img_arr.shape[:2]
+        px = ((xs.ravel() + 0.5) * (width / (grid_w + 2))).astype(np.intp)
+        py = ((ys.ravel() + 0.5) * (height / (grid_h + 2))).astype(np.intp)
+    lum = _marker_brightness(img_arr, px, py)
+    return None if lum is None else read_phase_marker(lum.reshape(xs.shape))
+
+def decode_grid_image(img: Union[Image.Image, np.ndarray, memoryview], grid_w: int = 64, grid_h: int = 36, bits_per_symbol: int = 2, corners: List[Tuple[int, int]] = None, diag: Optional[dict] = None, channel_order: str = 'RGB', phase_check: bool = True, local_palette: bool = True, payload_check: bool = True, lut: Optional[PaletteLUT] = None) -> Optional[Tuple[dict, bytes]]:
+    """Decode a grid frame to (header, payload), or None.
+
+    img is a PIL image, or an (H, W, 3 or 4) uint8 array (ndarray, or a
+    memoryview with that shape) whose colour channels are in channel_order
+    ('RGB' or 'BGR', e.g. straight from OpenCV). Arrays are read in place:
+    only the cell centres are gathered and the palette is flipped instead
+    of the frame, so a camera frame is never copied or converted.
+
+    With phase_check, the border's phase marker is read first (a few hundred
+    pixels) and a capture that blends or tears two frames is rejected
+    before the warp and full decode.
+
+    With local_palette, cells are classified against palettes interpolated
+    from the reference blocks (see _local_distances); otherwise, or if no
+    block is readable, against one palette fitted to the whole frame.
+
+    With lut, cells are first classified by table lookup against the palette
+    of the reference blocks (see PaletteLUT); a capture that does not decode
+    that way is classified again by distances as above.
+
+    With payload_check, a payload that does not match the header's payload
+    CRC is rejected; calibration turns it off to count symbol errors.
+
+    If diag is given, a failed decode sets diag['error'] to 'transition',
+    'header', 'magic', 'crc', 'truncated' or 'payload'. On 'payload' the
+    header was intact: diag['header'] holds it and diag['soft'] the
+    (grid_h, grid_w, colours) squared distance of every cell to every
+    palette colour, which decode_soft can combine across captures.
+    """
+    if channel_order not in ('RGB', 'BGR'):
+        raise ValueError(f"channel_order must be 'RGB' or 'BGR', not {channel_order!r}")
+    if isinstance(img, Image.Image):
+        with PROFILER.stage('rgb_convert'):
+            img_arr = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+        channel_order = 'RGB'
+    else:
+        img_arr = np.asarray(img)  # no copy for ndarrays and buffers
+        if img_arr.ndim != 3 or img_arr.shape[2] not in (3, 4):
+            raise ValueError(f'Expected an (H, W, 3|4) image array, got shape {img_arr.shape}')
     
     # Perspective Correction if corners provided
     if corners and len(corners) == 4:
-        # Convert PIL to OpenCV
-        cv_img = np.array(img)
-        cv_img = cv_img[:, :, ::-1].copy() # RGB to BGR
+        import cv2  # deferred: only perspective correction needs OpenCV
         
         # Source points (corners)
         src_pts = np.array(corners, dtype=np.float32)
@@ -90,24 +285,27 @@ def decode_grid_image(img: Image.Image, grid_w: int = 64, grid_h: int = 36, bits
             [0, dst_h]
         ], dtype=np.float32)
         
-        # Warp
-        M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-        warped = cv2.warpPerspective(cv_img, M, (dst_w, dst_h))
+        if phase_check:
+            with PROFILER.stage('phase_check'):
+                phase = frame_phase(img_arr, grid_w, grid_h, corners)
+            if phase == -1:
+                if diag is not None:
+                    diag['error'] = 'transition'
+                return None
         
-        # Convert back to PIL for sampling loop (or just sample numpy)
-        # Let's just sample numpy for speed
-        img_arr = cv2.cvtColor(warped, cv2.COLOR_BGR2RGB)
+        # Warp (any channel order; OpenCV only needs contiguous pixels, which camera frames already are)
+        with PROFILER.stage('warp'):
+            M = cv2.getPerspectiveTransform(src_pts, dst_pts)
+            img_arr = cv2.warpPerspective(np.ascontiguousarray(img_arr), M, (dst_w, dst_h))
         
         width, height = dst_w, dst_h
         cell_w = cell_size
         cell_h = cell_size
-        
-        # Use the warped image array
-        get_pixel = lambda x, y: img_arr[y, x]
+        border = 0  # corners enclose the data grid itself
         
     else:
         # Standard full-image sampling
-        width, height = img.size
+        height, width = img_arr.shape[:2]
         
         # Detect border (encoder adds 1-cell border)
         # We use aspect ratio to guess if border is present, which is more robust than exact modulo check
@@ -127,54 +325,92 @@ def decode_grid_image(img: Image.Image, grid_w: int = 64, grid_h: int = 36, bits
             border = 0
             cell_w = width / grid_w
             cell_h = height / grid_h
-
-        img_arr = np.array(img)
-        get_pixel = lambda x, y: img_arr[y, x]
+        
+        if phase_check and border:
+            with PROFILER.stage('phase_check'):
+                phase = frame_phase(img_arr, grid_w, grid_h)
+            if phase == -1:
+                if diag is not None:
+                    diag['error'] = 'transition'
+                return None
     
-    samples = []
-    for y in range(grid_h):
-        for x in range(grid_w):
-            # Sample center of cell
-            px = int((x + border + 0.5) * cell_w)
-            py = int((y + border + 0.5) * cell_h)
-            # Clamp to bounds
-            px = max(0, min(width-1, px))
-            py = max(0, min(height-1, py))
-            
-            color = get_pixel(px, py)
-            samples.append(color)
-            
-    # Adaptive decode
-    symbols = _refine_palette_and_decode(samples)
+    # Sample the centre of every cell in one gather, clamped to bounds
+    with PROFILER.stage('sampling'):
+        px = np.clip(((np.arange(grid_w) + border + 0.5) * cell_w).astype(int), 0, width - 1)
+        py = np.clip(((np.arange(grid_h) + border + 0.5) * cell_h).astype(int), 0, height - 1)
+        cells = img_arr[py[:, None], px[None, :], :3]
             
+    # Adaptive decode; the reference cells show the palette in its RGB order
+    if channel_order == 'BGR':
+        cells = cells[..., ::-1]
+    if lut is not None:
+        with PROFILER.stage('lut_classify'):
+            refs = _reference_colours(cells, bits_per_symbol)
+            symbols = None if refs is None else lut.classify(cells, refs.mean(axis=(0, 1)))
+        if symbols is not None:
+            result = _decode_symbols(symbols, bits_per_symbol, {}, payload_check)
+            if result is not None:
+                return result
+    dists = None
+    if local_palette:
+        with PROFILER.stage('classify'):
+            dists = _local_distances(cells, bits_per_symbol)
+    if dists is None:
+        with PROFILER.stage('kmeans'):
+            dists = _kmeans_distances(cells.reshape(-1, 3), palette_for(bits_per_symbol)).reshape(grid_h, grid_w, -1)
+    result = _decode_symbols(dists.argmin(axis=-1), bits_per_symbol, diag, payload_check)
+    if result is None and diag is not None and diag.get('error') == 'payload':
+        diag['soft'] = dists
+    return result
+
+def decode_soft(dists: np.ndarray, bits_per_symbol: int = 2, diag: Optional[dict] = None) -> Optional[Tuple[dict, bytes]]:
+    """Decode a frame from per-cell squared palette distances, shape (grid_h, grid_w, colours).
+
+    Summing the diag['soft'] distances of several captures of one frame
+    weighs every cell by how clearly each capture showed it, so cells
+    misread by one capture are outvoted by the others.
+    """
+    return _decode_symbols(dists.argmin(axis=-1), bits_per_symbol, diag)
+
+def _decode_symbols(symbols: np.ndarray, bits_per_symbol: int, diag: Optional[dict] = None,
+                    payload_check: bool = True) -> Optional[Tuple[dict, bytes]]:
+    """Parse the header and payload of a (grid_h, grid_w) symbol grid."""
+    grid_h, grid_w = symbols.shape
     # Extract header symbols
     header_capacity = grid_w * HEADER_ROWS
-    header_syms = symbols[:header_capacity]
-    header_bytes = _symbols_to_bytes(header_syms, bits_per_symbol)
+    header_syms = symbols.ravel()[:header_capacity]
+    with PROFILER.stage('unpack'):
+        header_bytes = _symbols_to_bytes(header_syms, bits_per_symbol)
     
-    # Parse header: magic(2), seq(4), chunk_idx(4), payload_len(4), crc(4) = 18 bytes
-    if len(header_bytes) < 18:
-        # print("Header too short")
+    # Parse header: magic(2), seq(4), chunk_idx(4), payload_len(4), payload_crc(4), crc(4) = 22 bytes
+    if len(header_bytes) < HEADER_SIZE:
+        if diag is not None:
+            diag['error'] = 'header'
         return None
         
-    magic, seq, chunk_idx, payload_len = struct.unpack('>HIII', header_bytes[:14])
-    stored_crc = struct.unpack('>I', header_bytes[14:18])[0]
+    magic, seq, chunk_idx, payload_len, payload_crc = struct.unpack('>HIIII', header_bytes[:18])
+    stored_crc = struct.unpack('>I', header_bytes[18:22])[0]
     
     if magic != MAGIC:
-        # print(f"Invalid magic: {hex(magic)}")
+        if diag is not None:
+            diag['error'] = 'magic'
         return None
         
-    calc_crc = zlib.crc32(header_bytes[:14]) & 0xFFFFFFFF
+    with PROFILER.stage('crc'):
+        calc_crc = zlib.crc32(header_bytes[:18]) & 0xFFFFFFFF
     if calc_crc != stored_crc:
-        print("CRC mismatch")
+        if diag is not None:
+            diag['error'] = 'crc'
         return None # Header corruption
         
     # Extract payload
-    data_syms = symbols[header_capacity:]
-    data_bytes = _symbols_to_bytes(data_syms, bits_per_symbol)
+    data_syms = symbols[data_cell_mask(grid_w, grid_h, bits_per_symbol)]
+    with PROFILER.stage('unpack'):
+        data_bytes = _symbols_to_bytes(data_syms, bits_per_symbol)
     
     if len(data_bytes) < payload_len:
-        print(f"Payload truncated: got {len(data_bytes)}, expected {payload_len}")
+        if diag is not None:
+            diag['error'] = 'truncated'
         return None # Truncated
         
     payload = data_bytes[:payload_len]
@@ -184,8 +420,18 @@ def decode_grid_image(img: Image.Image, grid_w: int = 64, grid_h: int = 36, bits
         'chunk_idx': chunk_idx,
         'payload_len': payload_len
     }
+    if payload_check:
+        with PROFILER.stage('crc'):
+            ok = zlib.crc32(payload) & 0xFFFFFFFF == payload_crc
+        if not ok:
+            if diag is not None:
+                diag['error'] = 'payload'
+                diag['header'] = header_info
+            return None
     return header_info, payload
 
 def decode_grid_frame(img_path: str, grid_w: int = 64, grid_h: int = 36, bits_per_symbol: int = 2) -> Optional[Tuple[dict, bytes]]:
-    img = Image.open(img_path)
+    with PROFILER.stage('image_load'):
+        img = Image.open(img_path)
+        img.load()
     return decode_grid_image(img, grid_w, grid_h, bits_per_symbol)
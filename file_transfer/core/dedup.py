@@ -0,0 +1,108 @@
+import hashlib
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+
+# Content-defined chunking defaults (bytes)
+CDC_MIN_SIZE = 4 * 1024
+CDC_AVG_SIZE = 16 * 1024
+CDC_MAX_SIZE = 64 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Gear table: one pseudo-random 32-bit value per byte value, fixed so that
+# sender and any later run cut identical content at identical places.
+GEAR = np.array([int.from_bytes(hashlib.sha256(b'oft-gear' + bytes([i])).digest()[:4], 'big')
+                 for i in range(256)], dtype=np.uint32)
+WINDOW = 32  # bytes that influence the 32-bit gear hash
+
+
+def _gear_hash(buf: np.ndarray) -> np.ndarray:
+    """Rolling gear hash h[i] = sum(GEAR[buf[i-k]] << k for k < 32), vectorized.
+
+    Built by doubling the window, H2m[i] = Hm[i] + (Hm[i-m] << m), so it takes
+    log2(32) = 5 passes over the buffer instead of 32.
+    """
+    h = GEAR[buf]
+    m = 1
+    while m < WINDOW:
+        h[m:] += h[:-m] << np.uint32(m)  # the shifted copy is made before the in-place add
+        m *= 2
+    return h
+
+
+def cdc_cut_points(data: bytes, min_size: int = CDC_MIN_SIZE, avg_size: int = CDC_AVG_SIZE,
+                   max_size: int = CDC_MAX_SIZE) -> List[int]:
+    """Return block end offsets for data (the last one is len(data)).
+
+    A block ends after byte i when the top log2(avg_size) bits of the gear
+    hash are zero, subject to min_size/max_size. min_size must cover the hash
+    window so cut decisions never depend on bytes before the block start.
+    """
+    n = len(data)
+    if n == 0:
+        return []
+    if min_size < WINDOW:
+        raise ValueError(f'min_size must be at least {WINDOW}')
+    bits = max(1, int(avg_size).bit_length() - 1)
+    h = _gear_hash(np.frombuffer(data, dtype=np.uint8))
+    candidates = np.flatnonzero((h >> np.uint32(32 - bits)) == 0) + 1
+    cuts = []
+    last = 0
+    while n - last > min_size:
+        i = np.searchsorted(candidates, last + min_size)
+        cut = int(candidates[i]) if i < len(candidates) else n
+        cut = min(cut, last + max_size, n)
+        cuts.append(cut)
+        last = cut
+    if last < n:
+        cuts.append(n)
+    return cuts
+
+
+def iter_cdc_blocks(path: str, min_size: int = CDC_MIN_SIZE, avg_size: int = CDC_AVG_SIZE,
+                    max_size: int = CDC_MAX_SIZE, read_size: int = READ_SIZE) -> Iterator[bytes]:
+    """Yield content-defined blocks of the file at path.
+
+    Each read buffer starts at a block boundary (the unfinished tail is carried
+    over), so the cuts do not depend on read_size.
+    """
+    carry = b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(read_size)
+            eof = not data
+            buf = carry + data
+            if not buf:
+                break
+            cuts = cdc_cut_points(buf, min_size, avg_size, max_size)
+            if not eof:
+                cuts = cuts[:-1]  # the tail may still grow with the next read
+            start = 0
+            for cut in cuts:
+                yield buf[start:cut]
+                start = cut
+            carry = buf[start:]
+            if eof:
+                break
+
+
+class DedupIndex:
+    """Map block digests to the index of the first block with that content."""
+
+    def __init__(self):
+        self._index: Dict[str, int] = {}
+        self.refs = 0
+        self.duplicate_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def add(self, digest: str, size: int = 0) -> Tuple[int, bool]:
+        """Return (block_index, is_new) for a block with the given digest."""
+        self.refs += 1
+        idx = self._index.get(digest)
+        if idx is not None:
+            self.duplicate_bytes += size
+            return idx, False
+        idx = len(self._index)
+        self._index[digest] = idx
+        return idx, True
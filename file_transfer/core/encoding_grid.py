@@ -1,47 +1,117 @@
+from functools import lru_cache
 from typing import Tuple
 import struct
 import zlib
-from PIL import Image, ImageDraw
+import numpy as np
+from PIL import Image
 
 PALETTE_4 = [(0,0,0),(255,255,255),(255,0,0),(0,255,0)]  # 2 bits per symbol
+# Larger palettes extend the smaller ones: RGB cube corners, then half-intensity mixes
+PALETTE_8 = PALETTE_4 + [(0,0,255),(0,255,255),(255,0,255),(255,255,0)]  # 3 bits
+PALETTE_16 = PALETTE_8 + [(128,128,128),(255,128,0),(128,0,255),(0,128,255),
+                          (255,0,128),(128,255,0),(0,255,128),(128,0,0)]  # 4 bits
+PALETTES = {2: PALETTE_4, 3: PALETTE_8, 4: PALETTE_16}
 HEADER_ROWS = 2
 MAGIC = 0xABCD
 
 GRID_W = 64
 GRID_H = 36
 BITS_PER_SYMBOL = 2
-FRAME_PAYLOAD_SIZE = (GRID_W * (GRID_H - HEADER_ROWS) * BITS_PER_SYMBOL) // 8
+CELL_SIZE = 12  # pixels per symbol
+PHASE_GROUP = 4  # border cells per phase-marker group: white, black, A, B
+REF_REGIONS = (4, 3)  # regions (across, down) of the data rows, each holding one block of reference cells
 
-def pack_header(seq: int, chunk_idx: int, payload_len: int) -> bytes:
-    """Pack header: magic(2), seq(4), chunk_idx(4), payload_len(4), crc(4). Total 18 bytes."""
-    fmt = '>HIII'
-    data = struct.pack(fmt, MAGIC, seq, chunk_idx, payload_len)
+def palette_for(bits_per_symbol: int) -> list:
+    if bits_per_symbol not in PALETTES:
+        raise ValueError(f"No palette for {bits_per_symbol} bits per symbol")
+    return PALETTES[bits_per_symbol]
+
+@lru_cache(maxsize=None)
+def reference_cells(grid_w: int = GRID_W, grid_h: int = GRID_H,
+                    bits_per_symbol: int = BITS_PER_SYMBOL) -> Tuple[np.ndarray, np.ndarray]:
+    """(ys, xs) of the reference cells, each of shape (regions down, regions across, palette size).
+
+    The data rows are split into REF_REGIONS regions and the middle of each
+    holds a block showing every palette colour once, symbol k at [..., k]
+    (2x2 cells for 4 colours, 2x4 for 8, 4x4 for 16). Coordinates are in
+    the data grid, without the border.
+    """
+    n = len(palette_for(bits_per_symbol))
+    cols = 2 if n <= 4 else 4
+    rows = n // cols
+    rx, ry = REF_REGIONS
+    data_h = grid_h - HEADER_ROWS
+    if grid_w // rx < cols or data_h // ry < rows:
+        raise ValueError(f"A {grid_w}x{grid_h} grid is too small for {rx}x{ry} reference blocks of {n} colours")
+    x0 = (np.arange(rx) * grid_w + (grid_w - rx * cols) // 2) // rx
+    y0 = HEADER_ROWS + (np.arange(ry) * data_h + (data_h - ry * rows) // 2) // ry
+    k = np.arange(n)
+    xs = x0[None, :, None] + (k % cols)[None, None, :] + np.zeros((ry, 1, 1), dtype=np.intp)
+    ys = y0[:, None, None] + (k // cols)[None, None, :] + np.zeros((1, rx, 1), dtype=np.intp)
+    xs.flags.writeable = ys.flags.writeable = False  # shared through the cache
+    return ys, xs
+
+@lru_cache(maxsize=None)
+def data_cell_mask(grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL) -> np.ndarray:
+    """(grid_h, grid_w) bool mask of the payload cells: the data rows minus the reference cells.
+
+    Payload symbols fill these cells in raster order.
+    """
+    mask = np.zeros((grid_h, grid_w), dtype=bool)
+    mask[HEADER_ROWS:] = True
+    mask[reference_cells(grid_w, grid_h, bits_per_symbol)] = False
+    mask.flags.writeable = False
+    return mask
+
+def frame_payload_size(grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL) -> int:
+    """Payload bytes one frame of this geometry carries."""
+    return int(data_cell_mask(grid_w, grid_h, bits_per_symbol).sum()) * bits_per_symbol // 8
+
+@lru_cache(maxsize=None)
+def phase_marker_cells(grid_w: int = GRID_W, grid_h: int = GRID_H) -> Tuple[np.ndarray, np.ndarray]:
+    """(xs, ys) of the phase-marker border cells, each of shape (groups, PHASE_GROUP).
+
+    Coordinates are in the bordered grid (the border is row/column 0 and
+    grid_w + 1 / grid_h + 1). Groups run along all four edges, corners
+    excluded, so a tear at any row or column crosses some of them.
+    """
+    edges = [[(x, 0) for x in range(1, grid_w + 1)], [(x, grid_h + 1) for x in range(1, grid_w + 1)],
+             [(0, y) for y in range(1, grid_h + 1)], [(grid_w + 1, y) for y in range(1, grid_h + 1)]]
+    groups = [edge[i:i + PHASE_GROUP] for edge in edges
+              for i in range(0, len(edge) - PHASE_GROUP + 1, PHASE_GROUP)]
+    cells = np.array(groups, dtype=np.intp)
+    xs, ys = cells[..., 0], cells[..., 1]
+    xs.flags.writeable = ys.flags.writeable = False  # shared through the cache
+    return xs, ys
+
+FRAME_PAYLOAD_SIZE = frame_payload_size()
+
+def pack_header(seq: int, chunk_idx: int, payload: bytes) -> bytes:
+    """Pack header: magic(2), seq(4), chunk_idx(4), payload_len(4), payload_crc(4), crc(4). Total 22 bytes."""
+    fmt = '>HIIII'
+    data = struct.pack(fmt, MAGIC, seq, chunk_idx, len(payload), zlib.crc32(payload) & 0xFFFFFFFF)
     crc = zlib.crc32(data) & 0xFFFFFFFF
     return data + struct.pack('>I', crc)
 
-def _bytes_to_symbols(data: bytes, bits_per_symbol: int = 2) -> list:
-    symbols = []
-    buffer = 0
-    bits_in_buffer = 0
-    mask = (1 << bits_per_symbol) - 1
-    for b in data:
-        buffer = (buffer << 8) | b
-        bits_in_buffer += 8
-        while bits_in_buffer >= bits_per_symbol:
-            shift = bits_in_buffer - bits_per_symbol
-            sym = (buffer >> shift) & mask
-            symbols.append(sym)
-            buffer &= (1 << shift) - 1 if shift > 0 else 0
-            bits_in_buffer -= bits_per_symbol
-    if bits_in_buffer > 0:
-        sym = (buffer << (bits_per_symbol - bits_in_buffer)) & mask
-        symbols.append(sym)
-    return symbols
+def _bytes_to_symbols(data: bytes, bits_per_symbol: int = 2) -> np.ndarray:
+    """Split data MSB-first into bits_per_symbol-bit symbols (last one zero-padded)."""
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    pad = (-len(bits)) % bits_per_symbol
+    if pad:
+        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
+    weights = (1 << np.arange(bits_per_symbol - 1, -1, -1)).astype(np.uint8)
+    return bits.reshape(-1, bits_per_symbol) @ weights
 
 
-def encode_grid_frame(chunk_bytes: bytes, seq: int, chunk_idx: int, grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL) -> Image:
-    """Create a PNG image with embedded header and chunk data."""
-    header_bytes = pack_header(seq, chunk_idx, len(chunk_bytes))
+def grid_symbols(chunk_bytes: bytes, seq: int, chunk_idx: int, grid_w: int = GRID_W, grid_h: int = GRID_H,
+                 bits_per_symbol: int = BITS_PER_SYMBOL) -> np.ndarray:
+    """(grid_h, grid_w) uint8 symbol map of a data frame: header rows, payload and reference cells.
+
+    Every region of the data rows shows the whole palette in a block of
+    reference cells (see reference_cells), from which the decoder learns how
+    each colour looks in that part of the capture.
+    """
+    header_bytes = pack_header(seq, chunk_idx, chunk_bytes[:frame_payload_size(grid_w, grid_h, bits_per_symbol)])
     
     header_symbols = _bytes_to_symbols(header_bytes, bits_per_symbol)
     data_symbols = _bytes_to_symbols(chunk_bytes, bits_per_symbol)
@@ -50,67 +120,63 @@ def encode_grid_frame(chunk_bytes: bytes, seq: int, chunk_idx: int, grid_w: int
     header_capacity = grid_w * HEADER_ROWS
     if len(header_symbols) > header_capacity:
         raise ValueError("Header too large for reserved rows")
-    header_symbols += [0] * (header_capacity - len(header_symbols))
-    
-    # Pad data to fill rest of grid
-    data_capacity = grid_w * (grid_h - HEADER_ROWS)
-    if len(data_symbols) > data_capacity:
-        # In a real app, we might split or error. For now, truncate or warn.
-        # But chunk_size should be chosen to fit.
-        # 64*34 = 2176 symbols. @2bits = 4352 bits = 544 bytes.
-        # Wait, default chunk size is 64KB. That won't fit in one frame!
-        # We need to split chunks into frame payloads.
-        # OR we increase grid size / bits per symbol.
-        # For this prototype, let's assume the caller handles sizing or we just fit what we can.
-        # The user asked to handle "file size as much as possible".
-        # So we should probably support multi-frame chunks or just smaller chunks.
-        # Let's assume the input `chunk_bytes` is already sized for one frame.
-        pass
-        
-    all_symbols = header_symbols + data_symbols
-    total_capacity = grid_w * grid_h
-    if len(all_symbols) < total_capacity:
-        all_symbols += [0] * (total_capacity - len(all_symbols))
-    else:
-        all_symbols = all_symbols[:total_capacity]
-
-    cell = 12  # pixel size per symbol
     
-    # Add 1-cell border for alignment
+    # Data beyond the grid capacity is cut off; callers size chunks to
+    # FRAME_PAYLOAD_SIZE so one chunk fills at most one frame.
+    symbols = np.zeros((grid_h, grid_w), dtype=np.uint8)
+    symbols.ravel()[:len(header_symbols)] = header_symbols
+    mask = data_cell_mask(grid_w, grid_h, bits_per_symbol)
+    slots = symbols[mask]
+    data_symbols = data_symbols[:len(slots)]
+    slots[:len(data_symbols)] = data_symbols
+    symbols[mask] = slots
+    ref_ys, ref_xs = reference_cells(grid_w, grid_h, bits_per_symbol)
+    symbols[ref_ys, ref_xs] = np.arange(ref_ys.shape[-1], dtype=np.uint8)
+    return symbols
+
+
+def render_symbols(symbols: np.ndarray, phase: int, bits_per_symbol: int = BITS_PER_SYMBOL,
+                   cell: int = CELL_SIZE, phase_marker: bool = True) -> np.ndarray:
+    """Expand a (grid_h, grid_w) symbol map to an RGB uint8 array (H, W, 3), border and anchors included.
+
+    With phase_marker the border carries the frame-transition guard: every
+    group of border cells reads white, black, A, B, with A white and B black
+    in phase 0 and the reverse in phase 1. The phase is the parity of the
+    displayed frame, so consecutive frames differ in every A/B cell and a
+    capture that blends or tears two frames shows up before any decoding
+    (see decoding_grid.read_phase_marker).
+    """
+    grid_h, grid_w = symbols.shape
+    palette = np.array(palette_for(bits_per_symbol), dtype=np.uint8)
+    cells = palette[symbols]
+
+    # 1-cell white alignment border with red corner anchors
     border = 1
-    img_w = (grid_w + 2 * border) * cell
-    img_h = (grid_h + 2 * border) * cell
-    
-    img = Image.new('RGB', (img_w, img_h), (0,0,0))
-    draw = ImageDraw.Draw(img)
-    
-    # Draw Alignment Border (White)
-    # Top
-    draw.rectangle([0, 0, img_w-1, cell-1], fill=(255,255,255))
-    # Bottom
-    draw.rectangle([0, img_h-cell, img_w-1, img_h-1], fill=(255,255,255))
-    # Left
-    draw.rectangle([0, 0, cell-1, img_h-1], fill=(255,255,255))
-    # Right
-    draw.rectangle([img_w-cell, 0, img_w-1, img_h-1], fill=(255,255,255))
-    
-    # Draw Corner Anchors (Red)
-    # TL
-    draw.rectangle([0, 0, cell-1, cell-1], fill=(255,0,0))
-    # TR
-    draw.rectangle([img_w-cell, 0, img_w-1, cell-1], fill=(255,0,0))
-    # BL
-    draw.rectangle([0, img_h-cell, cell-1, img_h-1], fill=(255,0,0))
-    # BR
-    draw.rectangle([img_w-cell, img_h-cell, img_w-1, img_h-1], fill=(255,0,0))
-    
-    for y in range(grid_h):
-        for x in range(grid_w):
-            sym = all_symbols[y * grid_w + x]
-            color = PALETTE_4[sym % len(PALETTE_4)]
-            # Offset by border
-            dx = x + border
-            dy = y + border
-            draw.rectangle([dx*cell, dy*cell, (dx+1)*cell-1, (dy+1)*cell-1], fill=color)
-            
-    return img
+    framed = np.full((grid_h + 2 * border, grid_w + 2 * border, 3), 255, dtype=np.uint8)
+    framed[border:-border, border:-border] = cells
+    for y in (0, -1):
+        for x in (0, -1):
+            framed[y, x] = (255, 0, 0)
+    if phase_marker:
+        xs, ys = phase_marker_cells(grid_w, grid_h)
+        odd = phase & 1
+        framed[ys[:, 1], xs[:, 1]] = 0
+        framed[ys[:, 2], xs[:, 2]] = 0 if odd else 255
+        framed[ys[:, 3], xs[:, 3]] = 255 if odd else 0
+
+    # Scale each cell up to cell x cell pixels
+    return np.repeat(np.repeat(framed, cell, axis=0), cell, axis=1)
+
+
+def render_grid_array(chunk_bytes: bytes, seq: int, chunk_idx: int, grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL, cell: int = CELL_SIZE, phase_marker: bool = True, phase: int = None) -> np.ndarray:
+    """Render a data frame as an RGB uint8 array (H, W, 3), border and anchors included.
+
+    The phase marker shows phase, or the parity of seq unless given (see render_symbols).
+    """
+    symbols = grid_symbols(chunk_bytes, seq, chunk_idx, grid_w, grid_h, bits_per_symbol)
+    return render_symbols(symbols, seq if phase is None else phase, bits_per_symbol, cell, phase_marker)
+
+
+def encode_grid_frame(chunk_bytes: bytes, seq: int, chunk_idx: int, grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL) -> Image:
+    """Create a PNG image with embedded header and chunk data."""
+    return Image.fromarray(render_grid_array(chunk_bytes, seq, chunk_idx, grid_w, grid_h, bits_per_symbol))
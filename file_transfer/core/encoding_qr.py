@@ -1,21 +1,91 @@
 import json
-from typing import Dict, Iterator, Tuple
+import re
+import zlib
+from typing import Dict, Iterator, Tuple, Optional
 
-try:
-    import segno
-except ImportError:  # placeholder if dependency missing at runtime
-    segno = None
+def _segno():
+    """segno, imported on first use (receivers never build QR codes), or None if missing."""
+    try:
+        import segno
+    except ImportError:  # placeholder if dependency missing at runtime
+        return None
+    return segno
 
 MAX_QR_PAYLOAD = 2000  # conservative bytes for robustness
+# Multi-part manifests are prefixed "OFTM<idx>/<count>/<tag>:" so parts can be
+# collected in any order; tag names the manifest (see manifest_tag) so parts
+# of two manifests are never joined. A manifest that fits one QR is sent as
+# plain JSON. Parts without a tag (older senders) are still read.
+PART_PREFIX = b'OFTM'
+_PART_RE = re.compile(rb'^OFTM(\d+)/(\d+)(?:/([0-9a-f]+))?:')
+
+
+def manifest_tag(manifest: Dict, data: bytes) -> str:
+    """Short name of a manifest for its QR parts: the start of its session id, or of its CRC-32."""
+    session = str(manifest.get('session_id', ''))
+    if re.fullmatch(r'[0-9a-f]{8,}', session):
+        return session[:8]
+    return f'{zlib.crc32(data) & 0xFFFFFFFF:08x}'
 
 
 def manifest_to_qr_frames(manifest: Dict) -> Iterator[Tuple[int, 'segno.QRCode']]:
     """Split manifest JSON into multiple QR codes if needed."""
     data = json.dumps(manifest, separators=(',', ':')).encode('utf-8')
+    count = (len(data) + MAX_QR_PAYLOAD - 1) // MAX_QR_PAYLOAD
+    tag = manifest_tag(manifest, data)
     for idx in range(0, len(data), MAX_QR_PAYLOAD):
         chunk = data[idx: idx + MAX_QR_PAYLOAD]
+        if count > 1:
+            chunk = PART_PREFIX + f'{idx // MAX_QR_PAYLOAD}/{count}/{tag}:'.encode() + chunk
+        segno = _segno()
         if segno:
             qr = segno.make(chunk, micro=False)
         else:
             qr = chunk  # fallback raw bytes placeholder
         yield idx // MAX_QR_PAYLOAD, qr
+
+
+class ManifestCollector:
+    """Reassemble a manifest from QR payloads captured in any order.
+
+    A part of another manifest (another tag or part count, e.g. a resend
+    starting mid-recording) starts the collection over, and parts that do
+    not join into valid JSON are dropped, so a stray part never ends a
+    receive.
+    """
+
+    def __init__(self):
+        self.parts: Dict[int, bytes] = {}
+        self.count = 0
+        self.tag: Optional[bytes] = None
+
+    def add(self, payload: bytes) -> Optional[Dict]:
+        """Feed one decoded QR payload; returns the manifest once it is complete."""
+        m = _PART_RE.match(payload)
+        if m is None:
+            if b'"files":' in payload and b'"total_chunks":' in payload:
+                try:
+                    return json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    return None  # a fragment of an unprefixed multi-QR manifest
+            return None
+        idx, count, tag = int(m.group(1)), int(m.group(2)), m.group(3)
+        if idx >= count:
+            return None
+        if (count, tag) != (self.count, self.tag):
+            # A different (or first) manifest: start over
+            self.parts = {}
+            self.count, self.tag = count, tag
+        self.parts[idx] = payload[m.end():]
+        if len(self.parts) < self.count:
+            return None
+        data = b''.join(self.parts[i] for i in range(self.count))
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:  # parts of two untagged manifests of the same size (UnicodeDecodeError included)
+            self.parts = {}
+            return None
+
+    @property
+    def progress(self) -> Tuple[int, int]:
+        return len(self.parts), self.count
@@ -0,0 +1,85 @@
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+WINDOW = 5  # seconds of history behind every rate
+
+
+class RateCounters:
+    """Event counters with per-second ring buffers, for live rates over the last WINDOW seconds.
+
+    count() is O(1) and allocation-free, so it can sit on the capture path;
+    rates are only summed when a display asks for them.
+    """
+
+    def __init__(self, names: Iterable[str], window: int = WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.names = tuple(names)
+        self.totals: Dict[str, int] = {n: 0 for n in self.names}
+        self._rings: Dict[str, list] = {n: [0] * window for n in self.names}
+        self._stamps = [-1] * window  # which whole second each slot currently holds
+        self.started = clock()
+
+    def _slot(self, now: float) -> int:
+        sec = int(now)
+        slot = sec % self.window
+        if self._stamps[slot] != sec:
+            self._stamps[slot] = sec
+            for ring in self._rings.values():
+                ring[slot] = 0
+        return slot
+
+    def count(self, name: str, n: int = 1):
+        self._rings[name][self._slot(self.clock())] += n
+        self.totals[name] += n
+
+    def rate(self, name: str) -> float:
+        """Events per second over the last window (or since start, if shorter)."""
+        now = self.clock()
+        sec = int(now)
+        ring = self._rings[name]
+        recent = sum(ring[i] for i, stamp in enumerate(self._stamps) if sec - self.window < stamp <= sec)
+        span = min(self.window - 1 + (now - sec), now - self.started)
+        return recent / span if span > 0 else 0.0
+
+    def recent(self, name: str) -> int:
+        """Events in the current window."""
+        sec = int(self.clock())
+        return sum(self._rings[name][i] for i, stamp in enumerate(self._stamps) if sec - self.window < stamp <= sec)
+
+    def ratio(self, name: str, of: str) -> Optional[float]:
+        """recent(name) / recent(of) over the window, or None with no events."""
+        base = self.recent(of)
+        return self.recent(name) / base if base else None
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
+
+def format_ranges(ranges: Iterable[Tuple[int, int]]) -> str:
+    """[(start, stop), ...] half-open -> '3-7, 12, 40-41'."""
+    return ', '.join(f'{a}' if b - a == 1 else f'{a}-{b - 1}' for a, b in ranges)
+
+
+def parse_ranges(text: str) -> List[Tuple[int, int]]:
+    """'3-7, 12, 40-41' (as format_ranges writes, a trailing ', ...' allowed) -> [(3, 8), (12, 13), (40, 42)]."""
+    ranges = []
+    for part in text.replace(';', ',').split(','):
+        part = part.strip()
+        if not part or part == '...':
+            continue
+        try:
+            a, _, b = part.partition('-')
+            start, stop = int(a), int(b or a) + 1
+        except ValueError:
+            raise ValueError(f"Not a chunk range: {part!r} (use e.g. 3-7, 12)")
+        if start < 0 or stop <= start:
+            raise ValueError(f"Empty or negative chunk range: {part!r}")
+        ranges.append((start, stop))
+    return ranges
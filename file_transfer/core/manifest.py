@@ -1,44 +1,336 @@
-import os, json, time, hashlib
-from typing import List, Dict
-from .chunking import collect_files, hash_file_sha256, DEFAULT_CHUNK_SIZE, build_merkle_leaves, merkle_root
+import os, json, time
+from fnmatch import fnmatchcase
+from typing import List, Dict, Optional, Sequence, Tuple
+from .chunking import (collect_empty_dirs, collect_files, iter_file_chunks, DEFAULT_CHUNK_SIZE, DEFAULT_DIGEST, DEFAULT_LEAF_SIZE,
+                       DIGEST_ALGOS, LeafHasher, data_digest, digest_size, hash_file, hex_digest, merkle_root,
+                       new_hash, stream_digests)
+from .compression import MODES, compress_block, constant_byte, fill_codec, fill_value, parallel_map
+from .dedup import DedupIndex, iter_cdc_blocks, CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE
 
+CHUNKING_METHODS = ('fixed', 'cdc')
+ORDERS = ('path', 'size')  # file order within each priority class: sorted path, or smallest first
 
-def build_manifest(root: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict:
-    files = collect_files(root)
-    file_entries = []
-    total_chunks = 0
-    chunk_index_cursor = 0
-    for fpath in files:
-        size = os.path.getsize(fpath)
-        # number of chunks for this file
-        chunks = (size + chunk_size - 1) // chunk_size
-        entry = {
-            'path': os.path.relpath(fpath, root) if os.path.isdir(root) else os.path.basename(fpath),
-            'size': size,
-            'sha256': hash_file_sha256(fpath),
-            'first_chunk': chunk_index_cursor,
-            'chunk_count': chunks
-        }
-        file_entries.append(entry)
-        chunk_index_cursor += chunks
-        total_chunks += chunks
-    leaves = build_merkle_leaves(files, chunk_size)
-    root_hash = merkle_root(leaves)
+
+def build_manifest(root: str, chunk_size: int = DEFAULT_CHUNK_SIZE, compression: str = 'off',
+                   block_size: int = DEFAULT_CHUNK_SIZE, workers: int = None,
+                   chunking: str = 'fixed', dedup: bool = False, elide: bool = False,
+                   digest: str = DEFAULT_DIGEST, digest_bytes: int = None, leaf_size: int = DEFAULT_LEAF_SIZE,
+                   order: str = 'path', priority: Sequence[str] = ()) -> Dict:
+    """Describe root (file or folder) for transfer.
+
+    With compression 'off', fixed chunking, no dedup and no elision the files
+    are sent as one raw byte stream. Otherwise each file is cut into blocks
+    (of block_size, or content-defined with chunking='cdc'), identical blocks
+    are sent once when dedup is on, and a codec is picked per block (see
+    compression.MODES). With elide, blocks that are one byte repeated (the
+    zeros of disk images and preallocated files) get the 'fill' codec: they
+    put nothing in the chunk stream and consecutive ones in a file share one
+    entry, so they cost no frames.
+
+    File digests, block digests and the Merkle root use digest (see
+    chunking.DIGEST_ALGOS), digest_bytes long (default: the full length);
+    Merkle leaves cover leaf_size bytes of the chunk stream each.
+
+    Files go into the stream in order (see order_files): those matching the
+    priority patterns first, then the rest. 'order' records the policy and
+    lead_chunks, the chunks that hold every priority file, which senders
+    show at the start of every cycle (see carousel.Scheduler).
+    """
+    if compression not in MODES:
+        raise ValueError(f'Unknown compression mode: {compression}')
+    if chunking not in CHUNKING_METHODS:
+        raise ValueError(f'Unknown chunking method: {chunking}')
+    hashing = {'algo': digest, 'size': digest_size(digest, digest_bytes), 'leaf_size': leaf_size}
+    if leaf_size < 1:
+        raise ValueError(f'Merkle leaves need at least one byte, not {leaf_size}')
+    if order not in ORDERS:
+        raise ValueError(f'Unknown file order: {order}')
+    files = order_files(collect_files(root), root, order, priority)
+    if compression == 'off' and chunking == 'fixed' and not dedup and not elide:
+        file_entries, total_size, total_chunks, leaves, extra = _stream_layout(root, files, chunk_size, hashing)
+    else:
+        file_entries, total_size, total_chunks, leaves, extra = _block_layout(
+            root, files, chunk_size, compression, block_size, workers, chunking, dedup, elide, hashing)
+    root_hash = merkle_root(leaves, digest, hashing['size'])
     manifest = {
         'version': 1,
-        'session_id': hashlib.sha256(str(time.time()).encode()).hexdigest()[:32],
+        'session_id': os.urandom(16).hex(),  # also salts the chunk keys and nonces of encrypted transfers
         'created_utc': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
         'files': file_entries,
         'chunk_size': chunk_size,
+        'total_size': total_size,
         'total_chunks': total_chunks,
         'merkle_root': root_hash,
+        'digest': hashing,
         'encryption': {'enabled': False},
         'fec': {'scheme': 'parity', 'data': 8, 'parity': 1},
         'encoding': {'bootstrap': 'qr', 'data': 'grid'}
     }
+    manifest.update(extra)
+    dirs = [_rel_path(d, root) for d in collect_empty_dirs(root)]
+    if dirs:
+        manifest['dirs'] = dirs  # files recreate every other directory
+    if order != 'path' or priority:
+        leading = sum(1 for fpath in files if _priority_class(_rel_path(fpath, root), priority) < len(priority))
+        manifest['order'] = {'policy': order, 'priority': list(priority),
+                             'lead_chunks': _lead_chunks(manifest, leading)}
     return manifest
 
 
+def _priority_class(rel_path: str, priority: Sequence[str]) -> int:
+    """Index of the first priority pattern matching a '/'-separated path, len(priority) if none does."""
+    for i, pattern in enumerate(priority):
+        if fnmatchcase(rel_path, pattern):
+            return i
+    return len(priority)
+
+
+def order_files(files: List[str], root: str, order: str = 'path', priority: Sequence[str] = ()) -> List[str]:
+    """Arrange files in transfer order.
+
+    priority lists glob patterns (fnmatch, matched against the path relative
+    to root with '/' separators; a plain path matches only itself): files
+    matching the first pattern come first, then those matching the second,
+    and so on, then all others. Within each class files are sorted by path,
+    or with order 'size' smallest first, so that many small files are
+    complete before a large one starts.
+    """
+    def key(fpath):
+        rel = _rel_path(fpath, root)
+        return _priority_class(rel, priority), os.path.getsize(fpath) if order == 'size' else 0, rel
+
+    return sorted(files, key=key)
+
+
+def _lead_chunks(manifest: Dict, files: int) -> int:
+    """Chunks from the start of the stream up to the end of the first files files."""
+    if not files:
+        return 0
+    if 'blocks' not in manifest:
+        last = manifest['files'][files - 1]
+        return last['first_chunk'] + last['chunk_count']
+    # Blocks are numbered in file order, so the leading files' blocks come before any other file's
+    offsets = block_offsets(manifest)
+    end = max((first + count for f in manifest['files'][:files] for first, count in f['blocks']), default=0)
+    return (offsets[end] + manifest['chunk_size'] - 1) // manifest['chunk_size']
+
+
+def _rel_path(fpath: str, root: str) -> str:
+    rel = os.path.relpath(fpath, root) if os.path.isdir(root) else os.path.basename(fpath)
+    return rel.replace(os.sep, '/')
+
+
+def _chunk_range(start: int, length: int, chunk_size: int):
+    """(first_chunk, chunk_count) of the chunks touched by stream[start:start+length]."""
+    first_chunk = start // chunk_size
+    if not length:
+        return first_chunk, 0
+    return first_chunk, (start + length - 1) // chunk_size - first_chunk + 1
+
+
+def file_digest_key(hashing: Optional[Dict]) -> str:
+    """Name of the file digest in a manifest's file entries: 'sha256' for full SHA-256, else 'digest'."""
+    if not hashing or (hashing['algo'], hashing['size']) == ('sha256', DIGEST_ALGOS['sha256']):
+        return 'sha256'
+    return 'digest'
+
+
+def digest_params(manifest: Dict) -> Tuple[str, int]:
+    """(algorithm, digest bytes) of a manifest's file and block digests; full SHA-256 before they were selectable."""
+    hashing = manifest.get('digest')
+    if not hashing:
+        return DEFAULT_DIGEST, DIGEST_ALGOS[DEFAULT_DIGEST]
+    return hashing['algo'], hashing['size']
+
+
+def verify_file(manifest: Dict, entry: Dict, path: str) -> Optional[bool]:
+    """Whether the file at path has the digest its manifest entry records (None if it records none)."""
+    expected = entry.get(file_digest_key(manifest.get('digest')))
+    if not expected:
+        return None
+    return hash_file(path, *digest_params(manifest)) == expected
+
+
+def _stream_layout(root: str, files: List[str], chunk_size: int, hashing: Dict):
+    file_entries = []
+    # Files are laid out back to back in one byte stream; chunks cut across
+    # file boundaries, so 'offset' is the file's position in that stream.
+    # One read of every file gives its digest and the Merkle leaves.
+    digests, leaves = stream_digests(files, hashing['leaf_size'], hashing['algo'], hashing['size'])
+    key = file_digest_key(hashing)
+    offset = 0
+    for fpath, file_digest in zip(files, digests):
+        size = os.path.getsize(fpath)
+        first_chunk, chunks = _chunk_range(offset, size, chunk_size)
+        entry = {
+            'path': _rel_path(fpath, root),
+            'size': size,
+            key: file_digest,
+            'offset': offset,
+            'first_chunk': first_chunk,
+            'chunk_count': chunks
+        }
+        file_entries.append(entry)
+        offset += size
+    total_chunks = (offset + chunk_size - 1) // chunk_size
+    return file_entries, offset, total_chunks, leaves, {}
+
+
+def _ranges(indices: List[int]) -> List[List[int]]:
+    """Collapse block indices into [first, count] runs."""
+    out = []
+    for i in indices:
+        if out and out[-1][0] + out[-1][1] == i:
+            out[-1][1] += 1
+        else:
+            out.append([i, 1])
+    return out
+
+
+def _block_layout(root: str, files: List[str], chunk_size: int, mode: str, block_size: int, workers: int,
+                  chunking: str, dedup: bool, elide: bool, hashing: Dict):
+    # Each file is cut into blocks; 'blocks' lists [codec, source_len, encoded_len, digest]
+    # for every unique block and the chunk stream is the concatenation of their
+    # encodings. Files list the blocks they are made of, so a duplicate block
+    # crosses the link once and is written to every place that uses it.
+    algo, size = hashing['algo'], hashing['size']
+    file_hashes = [new_hash(algo, size) for _ in files]
+
+    def read_blocks():
+        # File digests are taken from the blocks as they are read, so every file is read once
+        for fi, fpath in enumerate(files):
+            if chunking == 'cdc':
+                blocks = iter_cdc_blocks(fpath)
+            else:
+                blocks = (data for _idx, data in iter_file_chunks(fpath, block_size))
+            for data in blocks:
+                file_hashes[fi].update(data)
+                yield fi, data
+
+    def digest(item):
+        fi, data = item
+        return fi, data, data_digest(data, algo, size)
+
+    index = DedupIndex()
+
+    def assign(hashed):
+        # Runs in order on the consumer side, so block numbers are deterministic
+        for fi, data, dg in hashed:
+            if dedup:
+                b, new = index.add(dg, len(data))
+            else:
+                b, new = index.refs, True
+                index.refs += 1
+            yield fi, data, dg, b, new
+
+    def work(item):
+        fi, data, dg, b, new = item
+        value = constant_byte(data) if new and elide else None
+        if value is not None:
+            codec, enc = fill_codec(value), b''
+        else:
+            codec, enc = compress_block(data, mode) if new else (None, None)
+        return fi, len(data), dg, b, codec, enc
+
+    blocks = []
+    file_blocks = [[] for _ in files]
+    leaves = LeafHasher(hashing['leaf_size'], algo, size)
+    enc_pos = 0
+    hashed = parallel_map(digest, read_blocks(), workers)
+    filled = 0
+    for fi, src_len, dg, b, codec, enc in parallel_map(work, assign(hashed), workers):
+        if enc is None:
+            file_blocks[fi].append(b)
+            continue  # duplicate of an earlier block
+        if fill_value(codec) is not None:
+            filled += src_len
+            if not dedup and blocks and blocks[-1][0] == codec and file_blocks[fi][-1:] == [len(blocks) - 1]:
+                # extend the run; its content is implied by codec and length, so the entry carries no digest
+                blocks[-1][1] += src_len
+                continue
+            file_blocks[fi].append(len(blocks))
+            blocks.append([codec, src_len, 0])
+            continue
+        file_blocks[fi].append(len(blocks))
+        blocks.append([codec, src_len, len(enc), dg])
+        enc_pos += len(enc)
+        leaves.update(enc)
+
+    file_entries = []
+    total_size = 0
+    key = file_digest_key(hashing)
+    for fpath, refs, h in zip(files, file_blocks, file_hashes):
+        file_size = os.path.getsize(fpath)
+        file_entries.append({
+            'path': _rel_path(fpath, root),
+            'size': file_size,
+            key: hex_digest(h, size),
+            'blocks': _ranges(refs),
+        })
+        total_size += file_size
+    total_chunks = (enc_pos + chunk_size - 1) // chunk_size
+    if chunking == 'cdc':
+        blocking = {'method': 'cdc', 'min_size': CDC_MIN_SIZE, 'avg_size': CDC_AVG_SIZE, 'max_size': CDC_MAX_SIZE}
+    else:
+        blocking = {'method': 'fixed', 'block_size': block_size}
+    extra = {
+        'layout': 'blocks',
+        'compression': {'mode': mode},
+        'blocking': blocking,
+        'dedup': {'enabled': dedup, 'duplicate_bytes': index.duplicate_bytes},
+        'elide': {'enabled': elide, 'filled_bytes': filled},
+        'encoded_size': enc_pos,
+        'blocks': blocks,
+    }
+    return file_entries, total_size, total_chunks, leaves.finish(), extra
+
+
+def block_offsets(manifest: Dict) -> List[int]:
+    """Start of each block in the encoded chunk stream, plus the total length at the end."""
+    offsets = [0]
+    for _codec, _src_len, enc_len in (b[:3] for b in manifest['blocks']):
+        offsets.append(offsets[-1] + enc_len)
+    return offsets
+
+
+def block_refs(manifest: Dict) -> List[List[Tuple[int, int]]]:
+    """For each block, the (file_index, file_offset) positions it decodes to."""
+    blocks = manifest['blocks']
+    refs = [[] for _ in blocks]
+    for fi, f in enumerate(manifest['files']):
+        pos = 0
+        for first, count in f.get('blocks', []):
+            for b in range(first, first + count):
+                refs[b].append((fi, pos))
+                pos += blocks[b][1]
+    return refs
+
+
 def save_manifest(manifest: Dict, path: str):
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(manifest, f, indent=2)
+
+
+def changed_files(manifest: Dict, root: str) -> List[str]:
+    """Manifest paths whose file under root is missing, resized, or does not match its digest (or has none).
+
+    A manifest is only reused for a session when this is empty: an
+    encrypted session seals a chunk index under the same nonce every time,
+    so sending different plaintext under it would reuse nonces.
+    """
+    changed = []
+    for entry, path in zip(manifest['files'], source_paths(manifest, root)):
+        try:
+            same = os.path.getsize(path) == entry['size'] and verify_file(manifest, entry, path)
+        except OSError:
+            same = False
+        if not same:
+            changed.append(entry['path'])
+    return changed
+
+
+def source_paths(manifest: Dict, root: str) -> List[str]:
+    """Return the local paths of the manifest's files in stream order."""
+    if os.path.isfile(root):
+        return [root]
+    return [os.path.join(root, *f['path'].split('/')) for f in manifest['files']]
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+# Histogram bucket upper bounds in seconds: 1us doubling up to ~2s, then +Inf
+BUCKETS = [1e-6 * 2 ** i for i in range(22)]
+DUMP_FORMATS = ('jsonl', 'prom')
+_NULL = nullcontext()
+
+
+class _Histogram:
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (clamped to the observed max)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+
+class Profiler:
+    """Per-stage latency histograms for the decode pipeline.
+
+    Instrumented code wraps each stage in `with PROFILER.stage('name'):`.
+    While disabled, stage() hands back one shared no-op context manager, so
+    the hot path pays only for a method call (about half a microsecond).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._hists: Dict[str, _Histogram] = {}
+        self._lock = threading.Lock()
+        self._dumper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._hists = {}
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            hist = self._hists.get(name)
+            if hist is None:
+                hist = self._hists[name] = _Histogram()
+            hist.add(seconds)
+
+    def stage(self, name: str):
+        """Context manager timing one pass through a pipeline stage."""
+        if not self.enabled:
+            return _NULL
+        return _Timer(self, name)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Snapshot of every stage: count, total seconds and latency summary in milliseconds."""
+        with self._lock:
+            out = {}
+            for name, h in sorted(self._hists.items()):
+                out[name] = {
+                    'count': h.count,
+                    'total_s': round(h.total, 6),
+                    'mean_ms': round(h.total / h.count * 1e3, 4),
+                    'min_ms': round(h.min * 1e3, 4),
+                    'p50_ms': round(h.quantile(0.5) * 1e3, 4),
+                    'p90_ms': round(h.quantile(0.9) * 1e3, 4),
+                    'p99_ms': round(h.quantile(0.99) * 1e3, 4),
+                    'max_ms': round(h.max * 1e3, 4),
+                }
+            return out
+
+    def summary(self) -> str:
+        """Human-readable table of stats(), slowest total first."""
+        stats = self.stats()
+        lines = [f"{'stage':<16}{'count':>9}{'total s':>10}{'mean ms':>10}{'p90 ms':>10}{'max ms':>10}"]
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1]['total_s']):
+            lines.append(f"{name:<16}{s['count']:>9}{s['total_s']:>10.2f}{s['mean_ms']:>10.3f}"
+                         f"{s['p90_ms']:>10.3f}{s['max_ms']:>10.3f}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix: str = 'oft_stage') -> str:
+        """Prometheus text exposition of the histograms (cumulative buckets)."""
+        lines = [f'# HELP {prefix}_seconds Latency of optical receiver pipeline stages.',
+                 f'# TYPE {prefix}_seconds histogram']
+        with self._lock:
+            for name, h in sorted(self._hists.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_seconds_bucket{{stage="{name}",le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{prefix}_seconds_bucket{{stage="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'{prefix}_seconds_sum{{stage="{name}"}} {h.total:.9g}')
+                lines.append(f'{prefix}_seconds_count{{stage="{name}"}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str, fmt: str = 'jsonl'):
+        """Append a JSON line snapshot, or atomically rewrite a Prometheus text file."""
+        if fmt == 'jsonl':
+            with open(path, 'a') as f:
+                f.write(json.dumps({'time': time.time(), 'stages': self.stats()}) + '\n')
+        elif fmt == 'prom':
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp, path)  # textfile collectors must never see a partial file
+        else:
+            raise ValueError(f'Unknown dump format: {fmt}')
+
+    def start_dump(self, path: str, interval: float = 10.0, fmt: str = 'jsonl'):
+        """Dump every interval seconds from a daemon thread until stop_dump()."""
+        if fmt not in DUMP_FORMATS:
+            raise ValueError(f'Unknown dump format: {fmt}')
+        self.stop_dump()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.dump(path, fmt)
+
+        self._dumper = threading.Thread(target=run, daemon=True)
+        self._dumper.start()
+
+    def stop_dump(self):
+        if self._dumper is not None:
+            self._stop.set()
+            self._dumper.join()
+            self._dumper = None
+
+
+PROFILER = Profiler()
+
+
+def configure_from_env(environ=os.environ) -> bool:
+    """Enable PROFILER from OFT_PROFILE=<path>[,interval[,format]] (format from the extension if omitted)."""
+    spec = environ.get('OFT_PROFILE')
+    if not spec:
+        return False
+    PROFILER.enable()
+    parts: List[str] = spec.split(',')
+    path = parts[0]
+    if path and path != '1':
+        interval = float(parts[1]) if len(parts) > 1 else 10.0
+        fmt = parts[2] if len(parts) > 2 else ('prom' if path.endswith('.prom') else 'jsonl')
+        PROFILER.start_dump(path, interval, fmt)
+    return True
@@ -1,25 +1,223 @@
-import json, os
-from typing import Set
+import json, os, re, struct
+from typing import Iterator, List, Optional, Tuple
+
+SNAPSHOT_MAGIC = b'OFTR'
+SNAPSHOT_HEADER = struct.Struct('<4sBQ')  # magic, version, bitmap length in bits
+JOURNAL_RECORD = struct.Struct('<Q')       # chunk index; top bit set = cleared
+CLEAR_FLAG = 1 << 63
+COMPACT_EVERY = 1 << 16                    # journal records between snapshots
+
+_NOT_FULL = re.compile(rb'[^\xff]')
+_NOT_EMPTY = re.compile(rb'[^\x00]')
+
 
 class ResumeState:
-    def __init__(self, path: str):
+    """Bitmap of received chunk indices, persisted as a snapshot plus an append-only journal.
+
+    mark() only touches memory; save() appends the indices marked since the
+    last save to '<path>.journal' and fsyncs it, so a checkpoint costs a few
+    bytes per new chunk instead of rewriting the whole state. Once the journal
+    grows past compact_every records it is folded into the snapshot, written
+    to a temporary file and atomically renamed over '<path>'. A torn journal
+    tail from a crash is ignored on load. With path=None the state lives in
+    memory only.
+    """
+
+    def __init__(self, path: Optional[str] = None, total: int = 0, compact_every: int = COMPACT_EVERY):
         self.path = path
-        self.received: Set[int] = set()
-        self._load()
+        self.total = total
+        self.compact_every = compact_every
+        self._bits = bytearray((total + 7) // 8)
+        self._count = 0
+        self._pending = bytearray()
+        self._journal_records = 0
+        if path:
+            self._load()
+
+    # -- persistence -----------------------------------------------------
+
+    @property
+    def journal_path(self) -> str:
+        return self.path + '.journal'
 
     def _load(self):
         if os.path.exists(self.path):
-            try:
-                with open(self.path, 'r') as f:
-                    data = json.load(f)
-                    self.received = set(data.get('received', []))
-            except Exception:
-                self.received = set()
-
-    def mark(self, chunk_index: int):
-        self.received.add(chunk_index)
-
-    def save(self):
-        tmp = {'received': sorted(self.received)}
-        with open(self.path, 'w') as f:
-            json.dump(tmp, f)
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if data[:1] == b'{':
+                # Legacy format: {"received": [sorted indices]}
+                try:
+                    for idx in json.loads(data).get('received', []):
+                        self._set(idx)
+                except ValueError:
+                    pass
+                self._journal_records = self.compact_every  # rewrite in the new format on next save
+            elif data[:4] == SNAPSHOT_MAGIC and len(data) >= SNAPSHOT_HEADER.size:
+                _magic, _version, nbits = SNAPSHOT_HEADER.unpack_from(data)
+                bits = data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + (nbits + 7) // 8]
+                self._ensure(nbits)
+                self._bits[:len(bits)] = bits
+                self._count = self.popcount()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % JOURNAL_RECORD.size  # drop a torn final record
+            for (rec,) in JOURNAL_RECORD.iter_unpack(data[:usable]):
+                if rec & CLEAR_FLAG:
+                    self._clear(rec & ~CLEAR_FLAG)
+                else:
+                    self._set(rec)
+            self._journal_records = usable // JOURNAL_RECORD.size
+
+    def save(self, fsync: bool = True):
+        """Append newly marked indices to the journal; compact it when it gets long."""
+        if not self.path:
+            return
+        if self._pending:
+            with open(self.journal_path, 'ab') as f:
+                f.write(self._pending)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+            self._journal_records += len(self._pending) // JOURNAL_RECORD.size
+            self._pending.clear()
+        if self._journal_records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Write a fresh snapshot atomically, then start an empty journal."""
+        if not self.path:
+            return
+        self._pending.clear()  # already applied to the bitmap, which the snapshot covers
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, len(self._bits) * 8))
+            f.write(self._bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        # The snapshot now covers every journal record; replaying them again would be harmless
+        with open(self.journal_path + '.tmp', 'wb'):
+            pass
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self._journal_records = 0
+
+    def remove(self):
+        """Delete the persisted state (e.g. once the transfer is complete)."""
+        if not self.path:
+            return
+        for p in (self.path, self.journal_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+    # -- bitmap ----------------------------------------------------------
+
+    def _ensure(self, nbits: int):
+        need = (nbits + 7) // 8
+        if need > len(self._bits):
+            self._bits.extend(bytes(need - len(self._bits)))
+
+    def _set(self, idx: int) -> bool:
+        self._ensure(idx + 1)
+        byte, mask = idx >> 3, 1 << (idx & 7)
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def _clear(self, idx: int) -> bool:
+        byte, mask = idx >> 3, 1 << (idx & 7)
+        if byte >= len(self._bits) or not self._bits[byte] & mask:
+            return False
+        self._bits[byte] &= ~mask & 0xFF
+        self._count -= 1
+        return True
+
+    def mark(self, chunk_index: int) -> bool:
+        """Record a received chunk; returns False if it was already marked."""
+        if not self._set(chunk_index):
+            return False
+        if self.path:
+            self._pending += JOURNAL_RECORD.pack(chunk_index)
+        return True
+
+    def unmark(self, chunk_index: int) -> bool:
+        """Forget a chunk (e.g. it turned out to be corrupt)."""
+        if not self._clear(chunk_index):
+            return False
+        if self.path:
+            self._pending += JOURNAL_RECORD.pack(chunk_index | CLEAR_FLAG)
+        return True
+
+    # set-like helpers so a ResumeState can stand in for a set of indices
+    add = mark
+    discard = unmark
+
+    def difference_update(self, indices):
+        for idx in indices:
+            self.unmark(idx)
+
+    def __contains__(self, chunk_index: int) -> bool:
+        byte = chunk_index >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (chunk_index & 7)))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        for start, end in self.present_ranges():
+            yield from range(start, end)
+
+    # -- queries ---------------------------------------------------------
+
+    def popcount(self) -> int:
+        """Number of set bits, counted from the bitmap itself."""
+        return int.from_bytes(self._bits, 'little').bit_count()
+
+    def _limit(self, total: Optional[int]) -> int:
+        return total if total is not None else (self.total or len(self._bits) * 8)
+
+    def _next(self, pos: int, limit: int, want: bool) -> int:
+        """First index in [pos, limit) whose bit equals want, or limit if none."""
+        nbits = len(self._bits) * 8
+        skip = 0x00 if want else 0xFF
+        while pos < limit:
+            if pos >= nbits:
+                return limit if want else pos  # bits past the bitmap are all clear
+            b = self._bits[pos >> 3]
+            if pos & 7 == 0 and b == skip:
+                # Jump over whole bytes that cannot contain a match
+                m = (_NOT_EMPTY if want else _NOT_FULL).search(self._bits, pos >> 3)
+                pos = m.start() * 8 if m else nbits
+                continue
+            if bool(b & (1 << (pos & 7))) == want:
+                return pos
+            pos += 1
+        return limit
+
+    def first_missing(self, total: Optional[int] = None) -> Optional[int]:
+        """Lowest index not yet received, or None if all of [0, total) are in."""
+        limit = self._limit(total)
+        idx = self._next(0, limit, False)
+        return idx if idx < limit else None
+
+    def missing_ranges(self, total: Optional[int] = None, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Half-open [start, end) ranges of indices not yet received, at most limit of them."""
+        return self._ranges(False, total, limit)
+
+    def present_ranges(self, total: Optional[int] = None) -> List[Tuple[int, int]]:
+        return self._ranges(True, total, None)
+
+    def _ranges(self, want: bool, total: Optional[int], limit: Optional[int]) -> List[Tuple[int, int]]:
+        end_all = self._limit(total)
+        out = []
+        pos = 0
+        while pos < end_all and (limit is None or len(out) < limit):
+            start = self._next(pos, end_all, want)
+            if start >= end_all:
+                break
+            end = self._next(start, end_all, not want)
+            out.append((start, end))
+            pos = end
+        return out
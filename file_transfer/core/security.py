@@ -1,27 +1,171 @@
-from typing import Tuple
+from typing import Dict, Iterator, Optional, Tuple
 import hashlib
-try:
-    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
-except ImportError:
-    ChaCha20Poly1305 = None
+import os
+from .compression import parallel_map
+
+AEAD_ALGO = 'CHACHA20-POLY1305'
+KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16  # bytes the tag adds to every chunk; senders shrink chunks by this to keep one chunk per frame
+ENCRYPT_BATCH = 64  # chunks sealed per pool task; a single chunk is too little work to hand to a thread
 
 
 def sha256(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
 
+def _chacha():
+    # deferred: the cryptography package takes ~30 ms to import and only encrypted transfers need it
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    except ImportError:
+        raise RuntimeError('ChaCha20Poly1305 not available (pip install cryptography)')
+    return ChaCha20Poly1305
+
+
 def encrypt_aead(key: bytes, plaintext: bytes, aad: bytes = b'') -> Tuple[bytes, bytes]:
-    """Return (nonce, ciphertext_with_tag). Uses ChaCha20-Poly1305 if available."""
-    if ChaCha20Poly1305 is None:
-        raise RuntimeError('ChaCha20Poly1305 not available')
-    nonce = hashlib.sha256(key + aad).digest()[:12]  # NOT secure random (prototype!)
-    cipher = ChaCha20Poly1305(key)
+    """Return (nonce, ciphertext_with_tag) with a random nonce."""
+    nonce = os.urandom(NONCE_SIZE)
+    cipher = _chacha()(key)
     ct = cipher.encrypt(nonce, plaintext, aad)
     return nonce, ct
 
 
 def decrypt_aead(key: bytes, nonce: bytes, ciphertext: bytes, aad: bytes = b'') -> bytes:
-    if ChaCha20Poly1305 is None:
-        raise RuntimeError('ChaCha20Poly1305 not available')
-    cipher = ChaCha20Poly1305(key)
+    cipher = _chacha()(key)
     return cipher.decrypt(nonce, ciphertext, aad)
+
+
+def load_key(path: str, create: bool = False) -> bytes:
+    """Read a 32-byte key file (raw, or 64 hex digits); with create, write a random one if it is missing."""
+    if create and not os.path.exists(path):
+        key = os.urandom(KEY_SIZE)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(key.hex() + '\n')
+        return key
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) != KEY_SIZE:
+        try:
+            data = bytes.fromhex(data.decode('ascii').strip())
+        except ValueError:
+            pass
+    if len(data) != KEY_SIZE:
+        raise ValueError(f'{path} does not hold a {KEY_SIZE}-byte key (raw or hex)')
+    return data
+
+
+def key_id(key: bytes) -> str:
+    """Short fingerprint naming a key in the manifest, so a receiver can tell it holds the wrong one."""
+    return hashlib.sha256(b'oft-key-id:' + key).hexdigest()[:16]
+
+
+def encryption_info(key: bytes) -> Dict:
+    """The manifest 'encryption' entry of a transfer sealed with key."""
+    return {'enabled': True, 'algo': AEAD_ALGO, 'nonce_len': NONCE_SIZE, 'tag_len': TAG_SIZE,
+            'nonce': 'session-chunk', 'key_id': key_id(key)}
+
+
+def chunk_nonce(session_id: str, chunk_idx: int) -> bytes:
+    """First 4 bytes of the session id, then the chunk index as a 64-bit big-endian counter.
+
+    A session may seal a chunk index again (a resend), but only with the
+    same plaintext: different data under the same nonce leaks the XOR of
+    the two and breaks authentication. Reusing a session's manifest is
+    only safe for an unchanged source (see manifest.changed_files).
+    """
+    return bytes.fromhex(session_id)[:4] + chunk_idx.to_bytes(8, 'big')
+
+
+class ChunkCipher:
+    """Seal and open the chunks of one session.
+
+    The session key is HKDF-SHA256 of the transfer key salted with the
+    session id, and every chunk gets its own nonce from the session id and
+    chunk index (see chunk_nonce), so no (key, nonce) pair is used twice
+    even when a key file serves many transfers. A chunk moved to another
+    index or session fails its tag. Safe to share between threads.
+
+    Nonces are a function of the session and chunk index alone, so a
+    session must never seal different plaintext for the same index (see
+    chunk_nonce).
+    """
+
+    def __init__(self, key: bytes, session_id: str):
+        chacha = _chacha()
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        if len(key) != KEY_SIZE:
+            raise ValueError(f'Key must be {KEY_SIZE} bytes')
+        self.session_id = session_id
+        session_key = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=bytes.fromhex(session_id),
+                           info=b'oft-chunks').derive(key)
+        self._aead = chacha(session_key)
+        self._invalid_tag = InvalidTag
+
+    @classmethod
+    def for_manifest(cls, manifest: Dict, key: Optional[bytes]) -> Optional['ChunkCipher']:
+        """Cipher for an encrypted manifest's chunks, or None if it is not encrypted.
+
+        Raises ValueError when the transfer is encrypted and key is missing or not the one it names.
+        """
+        info = manifest.get('encryption', {})
+        if not info.get('enabled'):
+            return None
+        if info.get('algo', AEAD_ALGO) != AEAD_ALGO:
+            raise ValueError(f"Unsupported encryption {info.get('algo')}")
+        if key is None:
+            raise ValueError('The transfer is encrypted; a key file is needed')
+        if info.get('key_id') not in (None, key_id(key)):
+            raise ValueError(f"Wrong key: the transfer was sealed with key {info['key_id']}, not {key_id(key)}")
+        return cls(key, manifest['session_id'])
+
+    def encrypt(self, chunk_idx: int, data: bytes) -> bytes:
+        """data + TAG_SIZE byte tag."""
+        return self._aead.encrypt(chunk_nonce(self.session_id, chunk_idx), data, None)
+
+    def decrypt(self, chunk_idx: int, data: bytes) -> Optional[bytes]:
+        """The plaintext of a sealed chunk, or None if its tag does not verify."""
+        try:
+            return self._aead.decrypt(chunk_nonce(self.session_id, chunk_idx), data, None)
+        except self._invalid_tag:
+            return None
+
+
+class EncryptedSource:
+    """A ChunkSource whose chunks come out sealed (encrypt-then-FEC: this stage runs before framing).
+
+    Iteration seals ENCRYPT_BATCH chunks per task on a thread pool, in order;
+    read_chunk() seals one chunk on the calling thread.
+    """
+
+    def __init__(self, source, cipher: ChunkCipher, workers: int = None):
+        self.source = source
+        self.cipher = cipher
+        self.workers = workers
+        self.manifest = source.manifest
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+    def read_chunk(self, chunk_idx: int) -> bytes:
+        return self.cipher.encrypt(chunk_idx, self.source.read_chunk(chunk_idx))
+
+    def _seal(self, batch):
+        return [(idx, self.cipher.encrypt(idx, data)) for idx, data in batch]
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        def batches():
+            batch = []
+            for item in self.source:
+                batch.append(item)
+                if len(batch) == ENCRYPT_BATCH:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        for sealed in parallel_map(self._seal, batches(), self.workers):
+            yield from sealed
@@ -0,0 +1,102 @@
+import bisect
+from collections import OrderedDict
+from typing import Dict, Iterator, Tuple
+from .chunking import StreamMap, iter_stream_chunks
+from .compression import encode, parallel_map
+from .manifest import source_paths, block_offsets, block_refs
+
+BLOCK_CACHE_SIZE = 32
+
+
+class ChunkSource:
+    """Sender-side view of the chunk stream a manifest describes.
+
+    Iterating yields (chunk_index, data) in order; read_chunk() gives random
+    access to a single chunk. For block (compressed) layouts each block is
+    re-encoded with the codec recorded in the manifest, which is cheaper than
+    the codec search done while building it; 'fill' blocks are never read.
+    """
+
+    def __init__(self, manifest: Dict, root: str, workers: int = None):
+        self.manifest = manifest
+        self.paths = source_paths(manifest, root)
+        self.chunk_size = manifest['chunk_size']
+        self.total_chunks = manifest['total_chunks']
+        self.workers = workers
+        self.blocks = manifest.get('blocks')
+        files = manifest['files']
+        if self.blocks is None:
+            self._map = StreamMap([f['size'] for f in files], [f['offset'] for f in files])
+        else:
+            self._enc_starts = block_offsets(manifest)
+            self._refs = block_refs(manifest)
+            self._cache: 'OrderedDict[int, bytes]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.total_chunks
+
+    def _read(self, file_idx: int, offset: int, length: int) -> bytes:
+        with open(self.paths[file_idx], 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def encode_block(self, block_idx: int) -> bytes:
+        codec, src_len, enc_len = self.blocks[block_idx][:3]
+        if not enc_len:
+            return b''  # an empty or 'fill' block: nothing to read
+        file_idx, offset = self._refs[block_idx][0]
+        enc = encode(codec, self._read(file_idx, offset, src_len))
+        if len(enc) != enc_len:
+            raise RuntimeError(f'Block {block_idx} re-encoded to {len(enc)} bytes, manifest says {enc_len} '
+                               '(source changed since the manifest was built?)')
+        return enc
+
+    def _cached_block(self, block_idx: int) -> bytes:
+        enc = self._cache.get(block_idx)
+        if enc is None:
+            enc = self.encode_block(block_idx)
+            self._cache[block_idx] = enc
+            if len(self._cache) > BLOCK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(block_idx)
+        return enc
+
+    def read_chunk(self, chunk_idx: int) -> bytes:
+        if not 0 <= chunk_idx < self.total_chunks:
+            raise IndexError(chunk_idx)
+        pos = chunk_idx * self.chunk_size
+        if self.blocks is None:
+            end = min(pos + self.chunk_size, self.manifest['total_size'])
+            out = bytearray(end - pos)
+            for fi, file_off, a, b in self._map.segments(pos, end - pos):
+                out[a:b] = self._read(fi, file_off, b - a)
+            return bytes(out)
+        end = min(pos + self.chunk_size, self._enc_starts[-1])
+        out = bytearray()
+        # last block starting at or before pos (skips empty blocks sharing that start)
+        b = bisect.bisect_right(self._enc_starts, pos) - 1
+        while pos < end:
+            start = self._enc_starts[b]
+            enc = self._cached_block(b)
+            piece = enc[pos - start: end - start]
+            out += piece
+            pos += len(piece)
+            b += 1
+        return bytes(out)
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        if self.blocks is None:
+            yield from iter_stream_chunks(self.paths, self.chunk_size)
+            return
+        buf = bytearray()
+        idx = 0
+        for enc in parallel_map(self.encode_block, range(len(self.blocks)), self.workers):
+            buf += enc
+            while len(buf) >= self.chunk_size:
+                yield idx, bytes(buf[:self.chunk_size])
+                del buf[:self.chunk_size]
+                idx += 1
+        if buf:
+            yield idx, bytes(buf)
+
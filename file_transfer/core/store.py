@@ -0,0 +1,127 @@
+import os
+from collections import OrderedDict
+from typing import List
+
+MAX_OPEN_FILES = 64
+FILL_PIECE = 1 << 20  # bytes written per call when a constant region has to be written out
+_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+class ChunkStore:
+    """Positional writes into a fixed set of preallocated files.
+
+    Each file is created at its final size up front with ftruncate, which
+    leaves it sparse until data arrives, and payloads are written straight to
+    their offsets with os.pwrite on raw descriptors: nothing is buffered in
+    Python, so memory stays flat however large the files are. flush() fsyncs
+    only the files written since the last flush. fill() leaves a run of
+    zeros in a file it created as a hole.
+    """
+
+    def __init__(self, paths: List[str], sizes: List[int], max_open: int = MAX_OPEN_FILES):
+        self.paths = list(paths)
+        self.sizes = list(sizes)
+        self.max_open = max_open
+        self._fds: 'OrderedDict[int, int]' = OrderedDict()
+        self._dirty = set()
+        self._fresh = set()  # files created here, still all holes where nothing was written
+        for i, path in enumerate(self.paths):
+            self._preallocate(i, path)
+
+    def _preallocate(self, file_idx: int, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) == self.sizes[file_idx]:
+            return  # already allocated (resuming)
+        if not os.path.exists(path):
+            self._fresh.add(file_idx)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | _BINARY, 0o644)
+        try:
+            os.ftruncate(fd, self.sizes[file_idx])
+        finally:
+            os.close(fd)
+
+    def _fd(self, file_idx: int) -> int:
+        fd = self._fds.get(file_idx)
+        if fd is None:
+            if len(self._fds) >= self.max_open:
+                old_idx, old_fd = self._fds.popitem(last=False)
+                if old_idx in self._dirty:
+                    os.fsync(old_fd)
+                    self._dirty.discard(old_idx)
+                os.close(old_fd)
+            fd = os.open(self.paths[file_idx], os.O_RDWR | _BINARY)
+            self._fds[file_idx] = fd
+        else:
+            self._fds.move_to_end(file_idx)
+        return fd
+
+    def write(self, file_idx: int, offset: int, data: bytes):
+        if offset + len(data) > self.sizes[file_idx]:
+            raise ValueError(f'Write past end of {self.paths[file_idx]}')
+        fd = self._fd(file_idx)
+        view = memoryview(data)
+        while view:
+            n = _pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+        self._dirty.add(file_idx)
+
+    def fill(self, file_idx: int, offset: int, length: int, value: int = 0):
+        """Set length bytes at offset to value; zeros in a file created by this store are left as a hole."""
+        if offset + length > self.sizes[file_idx]:
+            raise ValueError(f'Write past end of {self.paths[file_idx]}')
+        if value == 0 and file_idx in self._fresh:
+            return
+        piece = bytes([value]) * min(length, FILL_PIECE)
+        end = offset + length
+        while offset < end:
+            n = min(len(piece), end - offset)
+            self.write(file_idx, offset, piece[:n] if n < len(piece) else piece)
+            offset += n
+
+    def close_file(self, file_idx: int):
+        """Make one file's data durable and release its descriptor (it is reopened if written again)."""
+        fd = self._fds.pop(file_idx, None)
+        if fd is None:
+            return
+        if file_idx in self._dirty:
+            os.fsync(fd)
+            self._dirty.discard(file_idx)
+        os.close(fd)
+
+    def read(self, file_idx: int, offset: int, length: int) -> bytes:
+        fd = self._fd(file_idx)
+        out = bytearray()
+        while len(out) < length:
+            data = _pread(fd, length - len(out), offset + len(out))
+            if not data:
+                break
+            out += data
+        return bytes(out)
+
+    def flush(self, fsync: bool = True):
+        """Make written data durable (positional writes are already in the OS cache)."""
+        if fsync:
+            for file_idx in list(self._dirty):
+                fd = self._fds.get(file_idx)
+                if fd is not None:
+                    os.fsync(fd)
+        self._dirty.clear()
+
+    def close(self):
+        self.flush()
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+if hasattr(os, 'pwrite'):
+    _pwrite, _pread = os.pwrite, os.pread
+else:  # Windows: no pread/pwrite, seek the raw descriptor instead
+    def _pwrite(fd: int, data, offset: int) -> int:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+    def _pread(fd: int, n: int, offset: int) -> bytes:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, n)
@@ -0,0 +1,225 @@
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from PIL import Image
+from .compression import parallel_map
+from .encoding_grid import grid_symbols, render_symbols, GRID_W, GRID_H, BITS_PER_SYMBOL, CELL_SIZE
+from .decoding_grid import decode_grid_image, frame_phase, PaletteLUT
+
+TILE_GAP = 1  # blank cells between neighbouring tiles, so their borders never touch
+# Layouts tried, in order, when a receiver has to find the tiles itself
+TILE_LAYOUTS = ((1, 1), (2, 1), (1, 2), (2, 2), (3, 2), (2, 3), (3, 3), (4, 3), (4, 4))
+
+Layout = Tuple[int, int]  # (cols, rows)
+
+
+def parse_layout(text: str) -> Layout:
+    """'3x2' -> (3, 2)."""
+    try:
+        cols, rows = (int(v) for v in text.lower().split('x'))
+    except ValueError:
+        raise ValueError(f"Tile layout must look like 2x2, not {text!r}")
+    if cols < 1 or rows < 1:
+        raise ValueError(f"Tile layout must have at least one column and row: {text!r}")
+    return cols, rows
+
+
+def manifest_layout(manifest: Optional[dict]) -> Optional[Layout]:
+    """Tile layout a manifest announces (1x1 for manifests from before tiling), or None without one."""
+    if not manifest:
+        return None
+    cols, rows = manifest.get('encoding', {}).get('tiles', (1, 1))
+    return cols, rows
+
+
+def mosaic_cells(layout: Layout, grid_w: int = GRID_W, grid_h: int = GRID_H) -> Tuple[int, int]:
+    """(width, height) in cells of a mosaic of bordered grids."""
+    cols, rows = layout
+    return cols * (grid_w + 2) + (cols - 1) * TILE_GAP, rows * (grid_h + 2) + (rows - 1) * TILE_GAP
+
+
+def mosaic_size(layout: Layout, cell: int = CELL_SIZE, grid_w: int = GRID_W, grid_h: int = GRID_H) -> Tuple[int, int]:
+    """(width, height) in pixels of a rendered mosaic; a 1x1 mosaic is exactly one grid frame."""
+    w, h = mosaic_cells(layout, grid_w, grid_h)
+    return w * cell, h * cell
+
+
+def _tile_origin(k: int, layout: Layout, grid_w: int, grid_h: int) -> Tuple[int, int]:
+    """Top-left cell (border included) of tile k, tiles numbered row by row."""
+    cols, _rows = layout
+    return (k % cols) * (grid_w + 2 + TILE_GAP), (k // cols) * (grid_h + 2 + TILE_GAP)
+
+
+def render_mosaic(tiles: Sequence[Tuple[bytes, int, int]], layout: Layout, phase: int,
+                  grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL,
+                  cell: int = CELL_SIZE) -> np.ndarray:
+    """Render up to cols x rows (payload, seq, chunk_idx) tiles as one RGB frame.
+
+    Every tile is a complete grid frame with its own border, anchors,
+    header and seq. All tiles carry the phase marker of the displayed frame
+    (phase, alternating between frames), so tearing is caught per tile.
+    Missing tiles at the end of a transfer are left blank.
+    """
+    grids = [grid_symbols(data, seq, chunk_idx, grid_w, grid_h, bits_per_symbol) for data, seq, chunk_idx in tiles]
+    return render_symbol_mosaic(grids, layout, phase, grid_w, grid_h, bits_per_symbol, cell)
+
+
+def render_symbol_mosaic(grids: Sequence[np.ndarray], layout: Layout, phase: int,
+                         grid_w: int = GRID_W, grid_h: int = GRID_H, bits_per_symbol: int = BITS_PER_SYMBOL,
+                         cell: int = CELL_SIZE) -> np.ndarray:
+    """render_mosaic for tiles given as (grid_h, grid_w) symbol maps (see encoding_grid.grid_symbols)."""
+    cols, rows = layout
+    if len(grids) > cols * rows:
+        raise ValueError(f"{len(grids)} tiles do not fit a {cols}x{rows} layout")
+    width, height = mosaic_size(layout, cell, grid_w, grid_h)
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    for k, symbols in enumerate(grids):
+        if symbols.shape != (grid_h, grid_w):
+            raise ValueError(f"A {symbols.shape[1]}x{symbols.shape[0]} symbol map in a {grid_w}x{grid_h} mosaic")
+        x0, y0 = _tile_origin(k, layout, grid_w, grid_h)
+        frame[y0 * cell:(y0 + grid_h + 2) * cell, x0 * cell:(x0 + grid_w + 2) * cell] = render_symbols(
+            symbols, phase, bits_per_symbol, cell)
+    return frame
+
+
+def iter_mosaics(source: Iterable[Tuple[int, bytes]], layout: Layout, grid_w: int = GRID_W, grid_h: int = GRID_H,
+                 bits_per_symbol: int = BITS_PER_SYMBOL, cell: int = CELL_SIZE) -> Iterator[np.ndarray]:
+    """Render a chunk stream cols x rows chunks per frame; seq keeps counting chunks across tiles.
+
+    Frames of a source with read_symbols (see archive) are expanded from its symbol maps.
+    """
+    if hasattr(source, 'read_symbols'):
+        for frame in range(frame_count(len(source), layout)):
+            yield render_frame(source, frame, layout, frame & 1, grid_w, grid_h, bits_per_symbol, cell)
+        return
+    per_frame = layout[0] * layout[1]
+    tiles = []
+    frame = 0
+    for seq, (chunk_idx, data) in enumerate(source):
+        tiles.append((data, seq, chunk_idx))
+        if len(tiles) == per_frame:
+            yield render_mosaic(tiles, layout, frame & 1, grid_w, grid_h, bits_per_symbol, cell)
+            tiles = []
+            frame += 1
+    if tiles:
+        yield render_mosaic(tiles, layout, frame & 1, grid_w, grid_h, bits_per_symbol, cell)
+
+
+def frame_count(chunks: int, layout: Layout) -> int:
+    """Displayed data frames needed for chunks chunks, cols x rows per frame."""
+    per_frame = layout[0] * layout[1]
+    return (chunks + per_frame - 1) // per_frame
+
+
+def render_frame(source, index: int, layout: Layout, phase: int, grid_w: int = GRID_W, grid_h: int = GRID_H,
+                 bits_per_symbol: int = BITS_PER_SYMBOL, cell: int = CELL_SIZE) -> np.ndarray:
+    """Render data frame index of a random-access chunk source (read_chunk), in any display order.
+
+    The frame holds the same chunks iter_mosaics puts in it; phase is
+    the parity of its position in the display order. A source that keeps
+    frames ready as symbol maps (read_symbols, see archive) only has them
+    expanded to pixels.
+    """
+    per_frame = layout[0] * layout[1]
+    first = index * per_frame
+    chunks = range(first, min(first + per_frame, len(source)))
+    if hasattr(source, 'read_symbols'):
+        return render_symbol_mosaic([source.read_symbols(c) for c in chunks], layout, phase,
+                                    grid_w, grid_h, bits_per_symbol, cell)
+    tiles = [(source.read_chunk(c), c, c) for c in chunks]
+    return render_mosaic(tiles, layout, phase, grid_w, grid_h, bits_per_symbol, cell)
+
+
+def tile_regions(layout: Layout, width: int, height: int, corners: Sequence[Tuple[float, float]] = None,
+                 grid_w: int = GRID_W, grid_h: int = GRID_H) -> List[Union[Tuple[slice, slice], List[Tuple[int, int]]]]:
+    """Where each tile is in a capture.
+
+    Without corners the capture is the rendered mosaic and each tile is a
+    (rows, cols) slice of it, border included. With corners, which enclose
+    the data area of the whole mosaic (first tile's data grid top-left to
+    the last one's bottom-right; for 1x1, the usual data grid corners),
+    each tile gets its own data grid corners for decode_grid_image.
+    """
+    mw, mh = mosaic_cells(layout, grid_w, grid_h)
+    count = layout[0] * layout[1]
+    if corners is None:
+        sx, sy = width / mw, height / mh
+        regions = []
+        for k in range(count):
+            x0, y0 = _tile_origin(k, layout, grid_w, grid_h)
+            regions.append((slice(round(y0 * sy), round((y0 + grid_h + 2) * sy)),
+                            slice(round(x0 * sx), round((x0 + grid_w + 2) * sx))))
+        return regions
+    import cv2  # deferred: only perspective correction needs OpenCV
+    area = np.array([[1, 1], [mw - 1, 1], [mw - 1, mh - 1], [1, mh - 1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(area, np.array(corners, dtype=np.float32))
+    grids = []
+    for k in range(count):
+        x0, y0 = _tile_origin(k, layout, grid_w, grid_h)
+        x0, y0 = x0 + 1, y0 + 1
+        grids.append([[x0, y0], [x0 + grid_w, y0], [x0 + grid_w, y0 + grid_h], [x0, y0 + grid_h]])
+    pts = cv2.perspectiveTransform(np.array(grids, dtype=np.float32).reshape(1, -1, 2), M)[0]
+    return [[(int(round(x)), int(round(y))) for x, y in pts[4 * k:4 * k + 4]] for k in range(count)]
+
+
+def _as_array(img: Union[Image.Image, np.ndarray, memoryview]) -> np.ndarray:
+    if isinstance(img, Image.Image):
+        return np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+    return np.asarray(img)
+
+
+def _region_phase(arr: np.ndarray, region, grid_w: int, grid_h: int) -> Optional[int]:
+    if isinstance(region, tuple):
+        return frame_phase(arr[region], grid_w, grid_h)
+    return frame_phase(arr, grid_w, grid_h, region)
+
+
+def detect_layout(img: Union[Image.Image, np.ndarray, memoryview], corners: Sequence[Tuple[float, float]] = None,
+                  grid_w: int = GRID_W, grid_h: int = GRID_H,
+                  candidates: Sequence[Layout] = TILE_LAYOUTS) -> Optional[Layout]:
+    """The first candidate layout whose first tile shows a clean phase marker and whose last
+    tile shows one too or is blank (the last frame of a transfer may be partly filled), or None.
+
+    A wrong layout puts the marker samples on data cells, which almost
+    never read as a consistent marker; each try costs two marker reads.
+    """
+    arr = _as_array(img)
+    height, width = arr.shape[:2]
+    for layout in candidates:
+        regions = tile_regions(layout, width, height, corners, grid_w, grid_h)
+        if _region_phase(arr, regions[0], grid_w, grid_h) in (0, 1) \
+                and _region_phase(arr, regions[-1], grid_w, grid_h) != -1:
+            return layout
+    return None
+
+
+def decode_mosaic(img: Union[Image.Image, np.ndarray, memoryview], layout: Layout,
+                  corners: Sequence[Tuple[float, float]] = None, grid_w: int = GRID_W, grid_h: int = GRID_H,
+                  bits_per_symbol: int = BITS_PER_SYMBOL, channel_order: str = 'RGB',
+                  workers: int = None, diags: Optional[List[dict]] = None,
+                  lut: Optional[PaletteLUT] = None) -> List[Optional[Tuple[dict, bytes]]]:
+    """Decode every tile of a capture independently, in parallel; one result (or None) per tile.
+
+    Tiles are decoded from views of the capture (or warped from it with
+    their own corners), so a tile that fails, e.g. torn or out of focus,
+    costs the others nothing. If diags is given it receives one diag dict
+    per tile (see decode_grid_image), and lut, if given, classifies the
+    cells of every tile first.
+    """
+    arr = _as_array(img)
+    if isinstance(img, Image.Image):
+        channel_order = 'RGB'
+    height, width = arr.shape[:2]
+    regions = tile_regions(layout, width, height, corners, grid_w, grid_h)
+    tile_diags = [{} for _ in regions]
+    if diags is not None:
+        diags[:] = tile_diags
+
+    def decode(k):
+        region = regions[k]
+        if isinstance(region, tuple):
+            return decode_grid_image(arr[region], grid_w, grid_h, bits_per_symbol,
+                                     diag=tile_diags[k], channel_order=channel_order, lut=lut)
+        return decode_grid_image(arr, grid_w, grid_h, bits_per_symbol, corners=region,
+                                 diag=tile_diags[k], channel_order=channel_order, lut=lut)
+
+    return list(parallel_map(decode, range(len(regions)), workers if len(regions) > 1 else 1))
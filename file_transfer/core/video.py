@@ -0,0 +1,152 @@
+import sys
+from typing import Dict, Iterable, Iterator, Tuple
+import numpy as np
+from .encoding_grid import GRID_W, GRID_H, CELL_SIZE
+from .encoding_qr import manifest_to_qr_frames
+from .tiling import Layout, iter_mosaics, mosaic_size, render_frame
+
+FORMATS = ('video', 'y4m', 'rgb24')
+# Lossless codecs tried in order for cv2.VideoWriter
+# HuffYUV first: ~5x faster to encode than FFV1 at 792x456, at ~9x the file size
+LOSSLESS_FOURCCS = ('HFYU', 'FFV1', 'png ')
+QR_BORDER = 4  # quiet zone in modules
+
+
+def frame_size(cell: int = CELL_SIZE) -> Tuple[int, int]:
+    """(width, height) of a rendered grid frame, border included."""
+    return (GRID_W + 2) * cell, (GRID_H + 2) * cell
+
+
+def qr_to_array(qr, width: int, height: int) -> np.ndarray:
+    """Draw a segno QR code centred on a white width x height RGB canvas, as large as fits."""
+    matrix = np.array([list(row) for row in qr.matrix], dtype=bool)
+    matrix = np.pad(matrix, QR_BORDER, constant_values=False)
+    scale = min(width // matrix.shape[1], height // matrix.shape[0])
+    if scale < 1:
+        raise ValueError(f'QR code ({matrix.shape[1]} modules) does not fit a {width}x{height} frame')
+    modules = np.where(matrix, 0, 255).astype(np.uint8)
+    modules = np.repeat(np.repeat(modules, scale, axis=0), scale, axis=1)
+    canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+    y0 = (height - modules.shape[0]) // 2
+    x0 = (width - modules.shape[1]) // 2
+    canvas[y0:y0 + modules.shape[0], x0:x0 + modules.shape[1]] = modules[:, :, None]
+    return canvas
+
+
+def iter_transfer_frames(manifest: Dict, source: Iterable[Tuple[int, bytes]], fps: float = 10,
+                         hold: int = 1, qr_hold: float = 2.0, cell: int = CELL_SIZE,
+                         tiles: Layout = (1, 1), schedule=None, cycles: int = 1) -> Iterator[np.ndarray]:
+    """Yield the RGB frames of a transfer at the output frame rate.
+
+    The manifest QR frames come first, each shown for qr_hold seconds, then
+    every data frame (tiles cols x rows grids, see tiling) is repeated hold
+    times (so it is on screen hold / fps seconds).
+
+    With a schedule (see carousel), cycles cycles of its slots are played
+    instead; data frames are then rendered in that order from
+    source.read_chunk.
+    """
+    width, height = mosaic_size(tiles, cell)
+    qr_repeat = max(1, round(qr_hold * fps))
+    qr_frames = [qr_to_array(qr, width, height) for _idx, qr in manifest_to_qr_frames(manifest)]
+    if schedule is not None:
+        shown = 0
+        for kind, idx in schedule.slots(cycles):
+            if kind == 'qr':
+                frame, repeat = qr_frames[idx], qr_repeat
+            else:
+                frame, repeat = render_frame(source, idx, tiles, shown & 1, cell=cell), hold
+                shown += 1
+            for _ in range(repeat):
+                yield frame
+        return
+    for frame in qr_frames:
+        for _ in range(qr_repeat):
+            yield frame
+    for frame in iter_mosaics(source, tiles, cell=cell):
+        for _ in range(hold):
+            yield frame
+
+
+class VideoSink:
+    """Write RGB frames to a lossless video file through cv2.VideoWriter."""
+
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        import cv2  # only needed for video output
+        self._cv2 = cv2
+        self.writer = None
+        for fourcc in LOSSLESS_FOURCCS:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+            if writer.isOpened():
+                self.writer, self.fourcc = writer, fourcc
+                break
+            writer.release()
+        if self.writer is None:
+            raise RuntimeError(f'No lossless codec ({", ".join(LOSSLESS_FOURCCS)}) available for {path}')
+
+    def write(self, frame: np.ndarray):
+        self.writer.write(self._cv2.cvtColor(frame, self._cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        self.writer.release()
+
+
+class _StreamSink:
+    def __init__(self, path: str):
+        self._own = path != '-'
+        self.out = open(path, 'wb') if self._own else sys.stdout.buffer
+
+    def close(self):
+        self.out.flush()
+        if self._own:
+            self.out.close()
+
+
+class RawSink(_StreamSink):
+    """Headerless rgb24 frames, e.g. for ffplay -f rawvideo -pixel_format rgb24."""
+
+    def write(self, frame: np.ndarray):
+        self.out.write(np.ascontiguousarray(frame).tobytes())
+
+
+class Y4MSink(_StreamSink):
+    """YUV4MPEG2 stream in full-range 4:4:4, so the palette colours survive exactly enough to decode."""
+
+    # BT.601 full-range RGB -> YCbCr
+    _M = np.array([[0.299, 0.587, 0.114],
+                   [-0.168736, -0.331264, 0.5],
+                   [0.5, -0.418688, -0.081312]], dtype=np.float32)
+
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        super().__init__(path)
+        num, den = (int(round(fps * 1000)), 1000) if fps != int(fps) else (int(fps), 1)
+        self.out.write(f'YUV4MPEG2 W{width} H{height} F{num}:{den} Ip A1:1 C444 XCOLORRANGE=FULL\n'.encode())
+        self._last = self._data = None
+
+    def write(self, frame: np.ndarray):
+        # Held frames are the same array object, so convert each distinct frame once
+        if frame is not self._last:
+            rgb = np.ascontiguousarray(frame.transpose(2, 0, 1), dtype=np.float32)
+            planes = []
+            for i, (kr, kg, kb) in enumerate(self._M):
+                plane = rgb[0] * kr
+                plane += rgb[1] * kg
+                plane += rgb[2] * kb
+                if i:
+                    plane += 128.0
+                np.rint(plane, out=plane)
+                np.clip(plane, 0, 255, out=plane)
+                planes.append(plane.astype(np.uint8).tobytes())
+            self._last, self._data = frame, b''.join(planes)
+        self.out.write(b'FRAME\n')
+        self.out.write(self._data)
+
+
+def open_sink(fmt: str, path: str, width: int, height: int, fps: float):
+    if fmt == 'video':
+        return VideoSink(path, width, height, fps)
+    if fmt == 'y4m':
+        return Y4MSink(path, width, height, fps)
+    if fmt == 'rgb24':
+        return RawSink(path)
+    raise ValueError(f'Unknown output format: {fmt}')
@@ -1,16 +1,36 @@
 import sys
 import os
+import shutil
+import threading
 import cv2
 import numpy as np
 import json
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                               QHBoxLayout, QPushButton, QLabel, QProgressBar, QTextEdit, QMessageBox, QCheckBox)
+                               QHBoxLayout, QPushButton, QLabel, QProgressBar, QPlainTextEdit, QMessageBox, QCheckBox)
 from PySide6.QtCore import Qt, QTimer, Slot, Signal, QPoint
-from PySide6.QtGui import QImage, QPixmap, QPainter, QPen, QColor
+from PySide6.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QFontDatabase
 from PIL import Image
-from pyzbar.pyzbar import decode as decode_qr
 
-from file_transfer.core.decoding_grid import decode_grid_image
+from file_transfer.core.capture import scan_qr_codes
+from file_transfer.core.assembly import FileAssembler, safe_join
+from file_transfer.core.manifest import verify_file
+from file_transfer.core.encoding_qr import ManifestCollector
+from file_transfer.core.profiling import PROFILER, configure_from_env
+from file_transfer.core.linkstats import RateCounters, format_eta, format_ranges
+from file_transfer.core.calibration import CalibrationAnalyzer, parse_plan
+from file_transfer.core.tiling import decode_mosaic, detect_layout, manifest_layout
+from file_transfer.core.decoding_grid import PaletteLUT
+from file_transfer.core.combining import SoftCombiner, soft_evidence
+from file_transfer.core.security import ChunkCipher, load_key
+
+# Received chunks are written here per session, so progress survives restarts
+WORK_ROOT = os.path.join(os.path.expanduser('~'), '.optical_transfer')
+CHECKPOINT_EVERY = 64  # chunks between resume checkpoints
+MAX_PENDING_CHUNKS = 4096  # chunks buffered in memory while waiting for the manifest
+HUD_INTERVAL_MS = 250  # status panel refresh; the capture path only bumps counters
+LOG_MAX_LINES = 500  # older log lines are dropped
+HUD_COUNTERS = ('captured', 'attempts', 'decoded', 'new', 'duplicate', 'crc_fail', 'torn', 'payload_fail',
+                'combined', 'auth_fail', 'new_bytes')
 
 class VideoLabel(QLabel):
     corners_changed = Signal(list)
@@ -117,10 +137,14 @@ class VideoLabel(QLabel):
 
 
 class ReceiverApp(QMainWindow):
+    verify_done = Signal(list)
+    files_checked = Signal(object, list)  # assembler, [(file index, verify_file result), ...]
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Optical File Transfer - Receiver")
         self.resize(900, 700)
+        configure_from_env()  # OFT_PROFILE=<path>[,interval[,format]] times the decode stages
         
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -155,19 +179,34 @@ class ReceiverApp(QMainWindow):
         self.btn_load.clicked.connect(self.load_file_frame)
         self.controls_layout.addWidget(self.btn_load)
         
+        self.btn_key = QPushButton("Load Key")
+        self.btn_key.setToolTip("Key file of an encrypted transfer")
+        self.btn_key.clicked.connect(self.select_key)
+        self.controls_layout.addWidget(self.btn_key)
+
         self.btn_save = QPushButton("Save File")
         self.btn_save.clicked.connect(self.save_file)
         self.btn_save.setEnabled(False)
         self.controls_layout.addWidget(self.btn_save)
+
+        self.btn_calibration = QPushButton("Calibration Report")
+        self.btn_calibration.clicked.connect(self.finish_calibration)
+        self.btn_calibration.setEnabled(False)
+        self.controls_layout.addWidget(self.btn_calibration)
         
         self.controls_layout.addWidget(self.lbl_status)
         self.layout.addLayout(self.controls_layout)
         
-        # Progress & Log
+        # Progress, link-quality HUD & Log
         self.progress = QProgressBar()
         self.layout.addWidget(self.progress)
-        self.log_view = QTextEdit()
+        self.lbl_hud = QLabel()
+        self.lbl_hud.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.lbl_hud.setWordWrap(True)
+        self.layout.addWidget(self.lbl_hud)
+        self.log_view = QPlainTextEdit()
         self.log_view.setReadOnly(True)
+        self.log_view.setMaximumBlockCount(LOG_MAX_LINES)
         self.log_view.setMaximumHeight(150)
         self.layout.addWidget(self.log_view)
         
@@ -176,15 +215,30 @@ class ReceiverApp(QMainWindow):
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_frame)
         self.current_frame_cv = None
-        self.received_frames = {}
+        self.received_frames = {}  # chunks decoded before the manifest arrived
+        self.assembler = None
+        self.unsaved_chunks = 0
+        self.key = None
+        self.cipher = None  # opens the chunks of an encrypted session
         self.manifest = None
+        self.manifest_parts = ManifestCollector()
         self.expected_frames = 0
+        self.calibration = None  # CalibrationAnalyzer while a calibration sweep is being measured
+        self.combiner = SoftCombiner()  # evidence from captures whose payload CRC failed
+        self.lut = PaletteLUT()  # table classifier, rebuilt as the camera's colours drift
         self.is_camera_active = False
+        self.counters = RateCounters(HUD_COUNTERS)
+        self.hud_timer = QTimer()
+        self.hud_timer.timeout.connect(self.update_hud)
+        self.hud_timer.start(HUD_INTERVAL_MS)
+        self.update_hud()
         
         # Default corners (TL, TR, BR, BL)
         self.corners = [(0.1, 0.1), (0.9, 0.1), (0.9, 0.9), (0.1, 0.9)]
         self.lbl_video.set_corners(self.corners)
         self.lbl_video.corners_changed.connect(self.update_corners)
+        self.verify_done.connect(self.on_verify_done)
+        self.files_checked.connect(self.on_files_checked)
 
     def update_corners(self, corners):
         self.corners = corners
@@ -214,15 +268,14 @@ class ReceiverApp(QMainWindow):
                 for c in self.corners:
                     pixel_corners.append((int(c[0]*w), int(c[1]*h)))
 
-            result = decode_grid_image(pil_img, corners=pixel_corners if len(pixel_corners)==4 else None)
-            if result:
-                header, payload = result
-                seq = header['seq']
-                self.log(f"Decoded Frame #{seq} from file")
-                if seq not in self.received_frames:
-                    self.received_frames[seq] = payload
+            corners = pixel_corners if len(pixel_corners)==4 else None
+            layout = self.tile_layout(pil_img, corners)
+            results = [r for r in decode_mosaic(pil_img, layout, corners, lut=self.lut) if r]
+            for header, payload in results:
+                self.log(f"Decoded Frame #{header['seq']} from file")
+                if self.store_chunk(header['chunk_idx'], payload):
                     self.update_progress()
-            else:
+            if not results:
                 self.log(f"Failed to decode {os.path.basename(path)}")
 
     @Slot()
@@ -252,34 +305,41 @@ class ReceiverApp(QMainWindow):
             return
             
         self.current_frame_cv = frame
+        self.counters.count('captured')
         
         # Convert to Qt
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_frame.shape
-        bytes_per_line = ch * w
-        qimg = QImage(rgb_frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        self.lbl_video.setPixmap(QPixmap.fromImage(qimg).scaled(self.lbl_video.size(), Qt.KeepAspectRatio))
+        with PROFILER.stage('ui_update'):
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            h, w, ch = rgb_frame.shape
+            bytes_per_line = ch * w
+            qimg = QImage(rgb_frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
+            self.lbl_video.setPixmap(QPixmap.fromImage(qimg).scaled(self.lbl_video.size(), Qt.KeepAspectRatio))
 
         if self.chk_auto.isChecked():
             self.process_frame(frame, verbose=False)
 
     def process_frame(self, frame_cv, verbose=False):
-        # Convert to PIL
-        rgb_frame = cv2.cvtColor(frame_cv, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(rgb_frame)
-        
-        # 1. Try QR Decode (Manifest) - only if not loaded
-        if not self.manifest:
-            decoded_qrs = decode_qr(pil_img)
+        # The decoders read the camera's BGR frame in place; no RGB/PIL copy is made
+        # 1. Try QR Decode (Manifest or calibration plan) - only if not loaded
+        if not self.manifest and self.calibration is None:
+            with PROFILER.stage('qr_scan'):
+                decoded_qrs = scan_qr_codes(cv2.cvtColor(frame_cv, cv2.COLOR_BGR2GRAY))
             if decoded_qrs:
-                for qr in decoded_qrs:
+                for data in decoded_qrs:
                     try:
-                        data = qr.data.decode('utf-8')
-                        # Check if it looks like manifest JSON
-                        if '"files":' in data and '"total_chunks":' in data:
-                            self.manifest = json.loads(data)
+                        plan = parse_plan(data)
+                        if plan is not None:
+                            self.start_calibration(plan)
+                            return
+                        manifest = self.manifest_parts.add(data)
+                        if manifest is None and self.manifest_parts.count > 1:
+                            got, total = self.manifest_parts.progress
+                            self.log(f"Manifest part {got}/{total}")
+                        if manifest is not None:
+                            self.manifest = manifest
                             self.expected_frames = self.manifest.get('total_chunks', 0)
                             self.log(f"Manifest loaded! Expecting {self.expected_frames} frames.")
+                            self.open_session()
                             self.progress.setMaximum(self.expected_frames)
                             self.update_progress()
                             return # Found manifest, stop
@@ -294,19 +354,137 @@ class ReceiverApp(QMainWindow):
             for c in self.corners:
                 pixel_corners.append((int(c[0]*w), int(c[1]*h)))
         
-        result = decode_grid_image(pil_img, corners=pixel_corners if len(pixel_corners)==4 else None)
-        if result:
-            header, payload = result
+        if self.calibration is not None:
+            with PROFILER.stage('calibration'):
+                self.calibration.feed(frame_cv, pixel_corners if len(pixel_corners) == 4 else None, 'BGR')
+            self.counters.count('attempts')
+            return
+
+        # Every tile is its own grid, so the counters below are per tile, not per capture
+        corners = pixel_corners if len(pixel_corners)==4 else None
+        diags = []
+        with PROFILER.stage('grid_decode'):
+            layout = self.tile_layout(frame_cv, corners)
+            results = decode_mosaic(frame_cv, layout, corners, channel_order='BGR', diags=diags, lut=self.lut)
+        self.counters.count('attempts', len(results))
+        decoded = [r for r in results if r]
+        for diag in diags:
+            if diag.get('error') == 'crc':
+                self.counters.count('crc_fail')
+            elif diag.get('error') == 'transition':
+                self.counters.count('torn')
+            elif diag.get('error') == 'payload':
+                self.counters.count('payload_fail')
+        self.counters.count('decoded', len(decoded))
+        chunks = self.combiner.collect(decoded, soft_evidence(diags))
+        self.counters.count('combined', len(chunks) - len(decoded))
+        for header, payload in chunks:
             seq = header['seq']
             if verbose:
                 self.log(f"Decoded Frame #{seq} (len={len(payload)})")
-            if seq not in self.received_frames:
-                self.received_frames[seq] = payload
+            with PROFILER.stage('store'):
+                stored = self.store_chunk(header['chunk_idx'], payload)
+            if stored:
+                self.counters.count('new')
+                self.counters.count('new_bytes', len(payload))
                 if not verbose:
                     self.log(f"Received Frame #{seq}")
-                self.update_progress()
-        elif verbose:
-            self.log("Decode failed (alignment?)")
+            else:
+                self.counters.count('duplicate')
+        if verbose:
+            if chunks:
+                self.update_progress()  # the HUD timer covers the live path
+            else:
+                self.log("Decode failed (alignment?)")
+
+    def tile_layout(self, img, corners):
+        """Tile layout announced by the manifest, or detected from the capture until one arrives."""
+        return manifest_layout(self.manifest) or detect_layout(img, corners) or (1, 1)
+
+    def start_calibration(self, plan):
+        self.calibration = CalibrationAnalyzer(plan)
+        self.btn_calibration.setEnabled(True)
+        self.log(f"Calibration plan received: {len(plan['steps'])} settings. "
+                 f"Press 'Calibration Report' once the sweep has played.")
+
+    @Slot()
+    def finish_calibration(self):
+        """Log the per-setting measurements and the recommendation, and leave calibration mode."""
+        if self.calibration is None:
+            return
+        self.log(self.calibration.report())
+        self.calibration = None
+        self.btn_calibration.setEnabled(False)
+
+    @Slot()
+    def select_key(self):
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getOpenFileName(self, "Select Key File")
+        if not path:
+            return
+        try:
+            self.key = load_key(path)
+        except (OSError, ValueError) as e:
+            self.log(str(e))
+            return
+        self.btn_key.setText(f"Key: {os.path.basename(path)}")
+        if self.manifest and self.assembler is None:
+            self.open_session()
+            self.update_progress()
+
+    def open_session(self):
+        """Start (or resume) writing chunks for the loaded manifest to its work directory.
+
+        An encrypted session waits for the key; chunks decoded meanwhile stay buffered.
+        """
+        try:
+            self.cipher = ChunkCipher.for_manifest(self.manifest, self.key)
+        except ValueError as e:
+            self.log(f"{e}; press 'Load Key' (decoded chunks are kept until then)")
+            return
+        work_dir = os.path.join(WORK_ROOT, self.manifest.get('session_id', 'session'))
+        self.assembler = FileAssembler(self.manifest, work_dir, resume=True)
+        if len(self.assembler.received):
+            self.log(f"Resuming session: {len(self.assembler.received)} chunks already received")
+        for chunk_idx, payload in self.received_frames.items():
+            payload = self.open_chunk(chunk_idx, payload)
+            if payload is not None:
+                self.assembler.write_chunk(chunk_idx, payload)
+        self.received_frames = {}
+        self.assembler.checkpoint()
+        self.finish_files()
+
+    def open_chunk(self, chunk_idx, payload):
+        """Verify and decrypt a chunk of an encrypted session (None if it fails); plain chunks pass through."""
+        if self.cipher is None:
+            return payload
+        with PROFILER.stage('decrypt'):
+            payload = self.cipher.decrypt(chunk_idx, payload)
+        if payload is None:
+            self.counters.count('auth_fail')
+        return payload
+
+    def store_chunk(self, chunk_idx, payload):
+        """Keep a decoded chunk; returns False if it was already received."""
+        if self.assembler is None:
+            if chunk_idx in self.received_frames or len(self.received_frames) >= MAX_PENDING_CHUNKS:
+                return False
+            self.received_frames[chunk_idx] = payload
+            return True
+        payload = self.open_chunk(chunk_idx, payload)
+        if payload is None or not self.assembler.write_chunk(chunk_idx, payload):
+            return False
+        self.finish_files()
+        self.unsaved_chunks += 1
+        if self.unsaved_chunks >= CHECKPOINT_EVERY:
+            self.assembler.checkpoint()
+            self.unsaved_chunks = 0
+        return True
+
+    def received_count(self):
+        if self.assembler is not None:
+            return len(self.assembler.received)
+        return len(self.received_frames)
 
     @Slot()
     def manual_decode(self):
@@ -317,25 +495,64 @@ class ReceiverApp(QMainWindow):
 
     @Slot()
     def save_file(self):
-        if not self.received_frames:
+        if self.received_count() == 0:
             return
             
         from PySide6.QtWidgets import QFileDialog
-        default_name = "reconstructed.bin"
-        if self.manifest and self.manifest.get('files'):
-            default_name = self.manifest['files'][0]['path']
-            
-        path, _ = QFileDialog.getSaveFileName(self, "Save Reconstructed File", default_name)
+        if self.assembler is not None:
+            files = self.manifest.get('files', [])
+            if len(files) != 1 or '/' in files[0]['path'] or self.manifest.get('dirs'):
+                # Folder transfer (even of one file, e.g. sub/a.txt): rebuild the directory tree under the chosen folder
+                out_dir = QFileDialog.getExistingDirectory(self, "Save Reconstructed Folder")
+                if not out_dir:
+                    return
+                targets = [safe_join(out_dir, f['path']) for f in files]
+                for d in self.manifest.get('dirs', []):
+                    os.makedirs(safe_join(out_dir, d), exist_ok=True)
+                where = out_dir
+            else:
+                path, _ = QFileDialog.getSaveFileName(self, "Save Reconstructed File", os.path.basename(files[0]['path']))
+                if not path:
+                    return
+                targets = [path]
+                where = path
+            # Chunks are already on disk: flush, then move the files into place
+            self.assembler.close()
+            for src, dst in zip(self.assembler.paths, targets):
+                os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+                try:
+                    os.replace(src, dst)
+                except OSError:
+                    shutil.move(src, dst)  # different filesystem
+            shutil.rmtree(self.assembler.out_dir, ignore_errors=True)
+            self.log(f"Saved {len(targets)} file(s) to {where}; verifying hashes...")
+            checks = list(zip(targets, files))
+            threading.Thread(target=self.verify_files, args=(self.manifest, checks), daemon=True).start()
+            self.assembler = None
+            self.cipher = None
+            self.manifest = None
+            self.manifest_parts = ManifestCollector()
+            self.expected_frames = 0
+            self.counters = RateCounters(HUD_COUNTERS)
+            self.combiner = SoftCombiner()
+            self.btn_save.setEnabled(False)
+            return
+
+        if self.manifest and self.manifest.get('encryption', {}).get('enabled'):
+            self.log("The transfer is encrypted; load its key before saving")
+            return
+        # No manifest: concatenate what was decoded in chunk order
+        path, _ = QFileDialog.getSaveFileName(self, "Save Reconstructed File", "reconstructed.bin")
         if path:
-            sorted_seqs = sorted(self.received_frames.keys())
+            sorted_idx = sorted(self.received_frames.keys())
             with open(path, 'wb') as f:
-                for seq in sorted_seqs:
-                    f.write(self.received_frames[seq])
+                for chunk_idx in sorted_idx:
+                    f.write(self.received_frames[chunk_idx])
             self.log(f"Saved to {path}")
             QMessageBox.information(self, "Success", f"File saved to {path}")
 
     def update_progress(self):
-        count = len(self.received_frames)
+        count = self.received_count()
         if self.expected_frames > 0:
             self.lbl_status.setText(f"Received: {count} / {self.expected_frames}")
             self.progress.setValue(count)
@@ -346,8 +563,94 @@ class ReceiverApp(QMainWindow):
             self.progress.setValue(count % 100)
             self.btn_save.setEnabled(count > 0)
 
+    def update_hud(self):
+        """Refresh progress and the link-quality panel from the rate counters."""
+        with PROFILER.stage('ui_update'):
+            self.update_progress()
+            c = self.counters
+            success = c.ratio('decoded', 'attempts')
+            dup = c.ratio('duplicate', 'decoded')
+            torn = c.ratio('torn', 'attempts')  # captures spanning two sender frames, rejected before decoding
+            new_rate = c.rate('new')
+            remaining = max(self.expected_frames - self.received_count(), 0)
+            eta = remaining / new_rate if self.expected_frames and new_rate > 0 else None
+            lines = [
+                f"Capture {c.rate('captured'):5.1f} fps   Decode {c.rate('attempts'):5.1f}/s   "
+                f"OK {'--' if success is None else f'{success:.0%}':>4}   "
+                f"Dup {'--' if dup is None else f'{dup:.0%}':>4}   "
+                f"CRC fail {c.totals['crc_fail']} ({c.rate('crc_fail'):.1f}/s)   "
+                f"Torn {'--' if torn is None else f'{torn:.0%}':>4}",
+                f"Goodput {c.rate('new_bytes') / 1024:6.1f} KB/s   New {new_rate:5.1f} chunks/s   "
+                f"ETA {format_eta(eta) if remaining else 'done'}   "
+                f"Combined {c.totals['combined']} ({c.totals['payload_fail']} payload CRC fails)",
+            ]
+            if self.cipher is not None:
+                lines[-1] += f"   Auth fail {c.totals['auth_fail']}"
+            if self.calibration is not None:
+                got, total = self.calibration.progress()
+                lines.append(f"Calibration: {got}/{total} sweep frames captured, "
+                             f"{self.calibration.undecoded} captures undecoded")
+            if self.assembler is not None and remaining:
+                ranges = self.assembler.missing_ranges(limit=8)
+                more = ', ...' if len(ranges) == 8 else ''
+                lines.append(f"Missing: {format_ranges(ranges)}{more}")
+            self.lbl_hud.setText('\n'.join(lines))
+
     def log(self, msg):
-        self.log_view.append(msg)
+        self.log_view.appendPlainText(msg)
+
+    def finish_files(self):
+        """Verify the files the last chunks completed, on a worker thread, so they are usable straight away."""
+        done = self.assembler.completed_files()
+        if done:
+            checks = [(fi, self.assembler.paths[fi], self.assembler.files[fi]) for fi in done]
+            threading.Thread(target=self.check_files, args=(self.assembler, checks), daemon=True).start()
+
+    def check_files(self, assembler, checks):
+        # Runs on a worker thread; the assembler is only touched back on the UI thread
+        results = []
+        for fi, path, entry in checks:
+            try:
+                results.append((fi, verify_file(assembler.manifest, entry, path)))
+            except OSError:
+                return  # moved away by Save meanwhile
+        self.files_checked.emit(assembler, results)
+
+    @Slot(object, list)
+    def on_files_checked(self, assembler, results):
+        if assembler is not self.assembler:
+            return  # saved or replaced meanwhile
+        for fi, ok in results:
+            assembler.file_checked(fi, ok)
+            path = assembler.files[fi]['path']
+            if ok is False:
+                self.log(f"Hash mismatch: {path}; receiving it again")
+            else:
+                self.log(f"Completed {path}{'' if ok is None else ' (verified)'}")
+        self.update_progress()
+
+    def verify_files(self, manifest, checks):
+        # Runs on a worker thread; results go back to the UI through a signal
+        bad = [path for path, entry in checks if verify_file(manifest, entry, path) is False]
+        self.verify_done.emit(bad)
+
+    @Slot(list)
+    def on_verify_done(self, bad):
+        for path in bad:
+            self.log(f"Hash mismatch: {path}")
+        if bad:
+            QMessageBox.warning(self, "Verification failed", f"{len(bad)} file(s) failed hash verification")
+        else:
+            self.log("All saved files verified")
+            QMessageBox.information(self, "Success", "Files saved and verified")
+
+    def closeEvent(self, event):
+        if self.assembler is not None:
+            self.assembler.checkpoint()
+        if PROFILER.enabled:
+            PROFILER.stop_dump()
+            print(PROFILER.summary())
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
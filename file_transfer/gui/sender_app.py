@@ -3,18 +3,29 @@ import os
 import time
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                                QHBoxLayout, QPushButton, QLabel, QFileDialog, 
-                               QSlider, QProgressBar, QSizePolicy)
+                               QSlider, QProgressBar, QSizePolicy, QComboBox, QLineEdit)
 from PySide6.QtCore import Qt, QTimer, Slot
 from PySide6.QtGui import QImage, QPixmap, QKeyEvent
+from PIL import Image
 
 
 # Import core logic
 from file_transfer.core.manifest import build_manifest
+from file_transfer.core.source import ChunkSource
+from file_transfer.core.security import ChunkCipher, EncryptedSource, TAG_SIZE, encryption_info, load_key
 from file_transfer.core.encoding_qr import manifest_to_qr_frames
-from file_transfer.core.encoding_grid import encode_grid_frame
-from file_transfer.core.chunking import iter_file_chunks, DEFAULT_CHUNK_SIZE
+from file_transfer.core.chunking import DEFAULT_CHUNK_SIZE
+from file_transfer.core.encoding_grid import FRAME_PAYLOAD_SIZE
+from file_transfer.core.calibration import build_plan, plan_to_qr, iter_calibration_frames
+from file_transfer.core.video import qr_to_array, frame_size
+from file_transfer.core.tiling import frame_count, manifest_layout, parse_layout, render_frame
+from file_transfer.core.carousel import SCHEDULERS, frames_for_chunks, lead_frames
+from file_transfer.core.linkstats import format_ranges, parse_ranges
+from file_transfer.core.archive import ARCHIVE_SUFFIX, FrameArchive, write_archive
 
-FRAME_PAYLOAD_SIZE = 544
+CALIBRATION_QR_MS = 3000  # how long the calibration plan QR stays up before the sweep
+TILE_CHOICES = ('1x1', '2x1', '2x2', '3x2', '3x3')  # grids per displayed frame; 2x2 and up suit 4K displays
+HISTORY_FRAMES = 256  # shown slots kept for stepping back with '<'
 
 class SenderApp(QMainWindow):
     def __init__(self):
@@ -30,6 +41,24 @@ class SenderApp(QMainWindow):
         self.top_layout = QHBoxLayout()
         self.btn_select = QPushButton("Select File")
         self.btn_select.clicked.connect(self.select_file)
+        self.btn_select_folder = QPushButton("Select Folder")
+        self.btn_select_folder.clicked.connect(self.select_folder)
+        self.btn_calibrate = QPushButton("Calibrate")
+        self.btn_calibrate.clicked.connect(self.prepare_calibration)
+        self.combo_tiles = QComboBox()
+        self.combo_tiles.addItems(TILE_CHOICES)
+        self.combo_tiles.setToolTip("Independent grids per displayed frame")
+        self.combo_tiles.currentTextChanged.connect(self.change_tiles)
+        self.btn_key = QPushButton("Encrypt...")
+        self.btn_key.setToolTip("Encrypt chunks with a key file (created if it does not exist); the receiver needs the same file")
+        self.btn_key.clicked.connect(self.select_key)
+        self.btn_open_archive = QPushButton("Open Archive")
+        self.btn_open_archive.setToolTip("Send a transfer saved earlier, without reading or re-encoding the files")
+        self.btn_open_archive.clicked.connect(self.open_archive)
+        self.btn_save_archive = QPushButton("Save Archive")
+        self.btn_save_archive.setToolTip("Store this transfer's manifest and frames for an instant repeat send")
+        self.btn_save_archive.clicked.connect(self.save_archive)
+        self.btn_save_archive.setEnabled(False)
         self.lbl_file = QLabel("No file selected")
         
         self.btn_start = QPushButton("Start Transfer")
@@ -37,6 +66,13 @@ class SenderApp(QMainWindow):
         self.btn_start.setEnabled(False)
         
         self.top_layout.addWidget(self.btn_select)
+        self.top_layout.addWidget(self.btn_select_folder)
+        self.top_layout.addWidget(self.btn_calibrate)
+        self.top_layout.addWidget(QLabel("Tiles:"))
+        self.top_layout.addWidget(self.combo_tiles)
+        self.top_layout.addWidget(self.btn_key)
+        self.top_layout.addWidget(self.btn_open_archive)
+        self.top_layout.addWidget(self.btn_save_archive)
         self.top_layout.addWidget(self.btn_start)
         self.top_layout.addWidget(self.lbl_file)
         self.layout.addLayout(self.top_layout)
@@ -81,6 +117,24 @@ class SenderApp(QMainWindow):
         self.controls_layout.addWidget(self.slider_fps)
         self.controls_layout.addWidget(self.lbl_fps)
         self.layout.addLayout(self.controls_layout)
+
+        # Frame order: carousel (manifest re-inserted, rotating start) or linear; optionally only missing chunks
+        self.schedule_layout = QHBoxLayout()
+        self.combo_schedule = QComboBox()
+        self.combo_schedule.addItems(list(SCHEDULERS))
+        self.combo_schedule.setCurrentText('carousel')
+        self.combo_schedule.setToolTip("carousel: manifest every few frames, each loop starting further on; linear: manifest, then frames in order")
+        self.combo_schedule.currentTextChanged.connect(self.change_schedule)
+        self.edit_missing = QLineEdit()
+        self.edit_missing.setPlaceholderText("Missing chunks from the receiver, e.g. 3-7, 12 (empty: all)")
+        self.edit_missing.returnPressed.connect(self.apply_missing)
+        self.btn_missing = QPushButton("Repeat")
+        self.btn_missing.clicked.connect(self.apply_missing)
+        self.schedule_layout.addWidget(QLabel("Order:"))
+        self.schedule_layout.addWidget(self.combo_schedule)
+        self.schedule_layout.addWidget(self.edit_missing)
+        self.schedule_layout.addWidget(self.btn_missing)
+        self.layout.addLayout(self.schedule_layout)
         
         # Progress
         self.progress_layout = QHBoxLayout()
@@ -92,7 +146,19 @@ class SenderApp(QMainWindow):
         
         # State
         self.file_path = None
-        self.frames = []  # List of (type, data/image)
+        self.key = None  # chunks are sealed with this key when set
+        self.frames = []  # calibration sweep images, shown in order
+        self.frame_intervals = None  # per-frame display ms for the calibration sweep; None = speed slider
+        # A transfer is shown in the order of a scheduler (see carousel), rendering data frames as they come up
+        self.schedule = None
+        self.slots = None
+        self.qr_frames = []
+        self.manifest = None
+        self.source = None  # a ChunkSource, or an open FrameArchive
+        self.tiles = (1, 1)
+        self.data_shown = 0  # data frames displayed; its parity is the phase marker of the next one
+        self.history = []
+        self.history_pos = -1
         self.timer = QTimer()
 
         self.timer.timeout.connect(self.next_frame)
@@ -108,19 +174,176 @@ class SenderApp(QMainWindow):
             self.btn_start.setEnabled(True)
             self.prepare_frames()
 
+    @Slot()
+    def select_folder(self):
+        path = QFileDialog.getExistingDirectory(self, "Select Folder to Send")
+        if path:
+            self.file_path = path
+            self.lbl_file.setText(os.path.basename(path) + "/")
+            self.btn_start.setEnabled(True)
+            self.prepare_frames()
+
+    @Slot(str)
+    def change_tiles(self, _text):
+        if self.file_path:
+            if self.is_running:
+                self.start_transfer()  # pause
+            self.prepare_frames()
+
+    @Slot()
+    def select_key(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Key File (an existing file is reused)", "transfer.key",
+                                              options=QFileDialog.Option.DontConfirmOverwrite)
+        if not path:
+            return
+        try:
+            self.key = load_key(path, create=True)
+        except (OSError, ValueError) as e:
+            self.lbl_file.setText(str(e))
+            return
+        self.btn_key.setText(f"Key: {os.path.basename(path)}")
+        if self.file_path:
+            if self.is_running:
+                self.start_transfer()  # pause
+            self.prepare_frames()
+
+    @Slot()
+    def open_archive(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Open Frame Archive", "", f"Frame archives (*{ARCHIVE_SUFFIX});;All files (*)")
+        if not path:
+            return
+        try:
+            archive = FrameArchive(path)
+        except (OSError, ValueError) as e:
+            self.lbl_file.setText(str(e))
+            return
+        if self.is_running:
+            self.start_transfer()  # pause
+        # The archive fixes the tiles and holds the chunks already sealed, so neither control applies to it
+        self.file_path = None
+        self.lbl_file.setText(os.path.basename(path))
+        self.combo_tiles.blockSignals(True)
+        self.combo_tiles.setCurrentText('x'.join(map(str, manifest_layout(archive.manifest))))
+        self.combo_tiles.blockSignals(False)
+        self.combo_tiles.setEnabled(False)
+        self.btn_key.setEnabled(False)
+        self.btn_start.setEnabled(True)
+        self.load_transfer(archive.manifest, archive, manifest_layout(archive.manifest), os.path.basename(path))
+
+    @Slot()
+    def save_archive(self):
+        if self.manifest is None:
+            return
+        name = os.path.splitext(os.path.basename(self.file_path or 'transfer'))[0] + ARCHIVE_SUFFIX
+        path, _ = QFileDialog.getSaveFileName(self, "Save Frame Archive", name, f"Frame archives (*{ARCHIVE_SUFFIX})")
+        if not path:
+            return
+        self.lbl_display.setText("Saving archive...")
+        QApplication.processEvents()
+        try:
+            size = write_archive(path, self.manifest, self.source)
+        except (OSError, ValueError) as e:
+            self.lbl_file.setText(str(e))
+            return
+        self.lbl_file.setText(f"Saved {os.path.basename(path)} ({size / 1024:.0f} KB)")
+
+    @Slot(str)
+    def change_schedule(self, _text):
+        if self.schedule is not None:
+            if self.is_running:
+                self.start_transfer()  # pause
+            self.make_schedule()
+            self.next_frame()
+
+    def make_schedule(self):
+        frames = frame_count(len(self.source), self.tiles)
+        lead = lead_frames(self.manifest.get('order', {}).get('lead_chunks', 0), self.tiles[0] * self.tiles[1], frames)
+        self.schedule = SCHEDULERS[self.combo_schedule.currentText()](len(self.qr_frames), frames, lead=lead)
+        self.apply_missing()
+        self.restart_schedule()
+
+    @Slot()
+    def apply_missing(self):
+        """Repeat only the frames holding the chunks typed in (as the receiver's HUD lists them), or all."""
+        if self.schedule is None:
+            return
+        try:
+            ranges = parse_ranges(self.edit_missing.text())
+        except ValueError as e:
+            self.lbl_total_frames.setText(str(e))
+            return
+        frames = self.schedule.frame_count
+        only = frames_for_chunks(ranges, self.tiles[0] * self.tiles[1], frames) if ranges else None
+        self.schedule.set_missing(only)
+        if only:
+            self.lbl_total_frames.setText(f"Repeating {len(only)} of {frames} frames (chunks {format_ranges(ranges)})")
+        else:
+            self.lbl_total_frames.setText(f"Total Frames: {frames} data + {len(self.qr_frames)} QR")
+
+    @Slot()
+    def prepare_calibration(self):
+        """Load the calibration sweep: plan QR, then test patterns at each cell size, palette and rate."""
+        if self.is_running:
+            self.start_transfer()  # pause
+        self.schedule = None
+        self.manifest = None
+        self.btn_save_archive.setEnabled(False)
+        plan = build_plan()
+        width, height = frame_size()
+        self.frames = [Image.fromarray(qr_to_array(plan_to_qr(plan), width, height))]
+        self.frame_intervals = [CALIBRATION_QR_MS]
+        for step, _seq, arr in iter_calibration_frames(plan, (width, height)):
+            self.frames.append(Image.fromarray(arr))
+            self.frame_intervals.append(1000 // plan['steps'][step][3])
+        self.lbl_file.setText("Calibration sweep")
+        self.lbl_filename.setText(f"Calibration: {len(plan['steps'])} settings")
+        self.lbl_size.setText(f"Duration: {sum(self.frame_intervals) / 1000:.0f} s")
+        self.lbl_total_frames.setText(f"Total Frames: {len(self.frames)}")
+        self.progress.setMaximum(len(self.frames))
+        self.btn_start.setEnabled(True)
+        self.current_frame_idx = 0
+        self.next_frame()
+
+    def frame_interval(self, idx):
+        if self.frame_intervals:
+            return self.frame_intervals[idx % len(self.frame_intervals)]
+        return 1000 // self.slider_fps.value()
+
     def prepare_frames(self):
-        self.frames = []
         self.lbl_display.setText("Generating frames...")
         QApplication.processEvents()
+        self.combo_tiles.setEnabled(True)
+        self.btn_key.setEnabled(True)
         
+        # Manifest: we must use FRAME_PAYLOAD_SIZE as chunk_size so the manifest total_chunks matches the number of frames we generate;
+        # a sealed chunk carries the AEAD tag on top
+        chunk_size = FRAME_PAYLOAD_SIZE - TAG_SIZE if self.key else FRAME_PAYLOAD_SIZE
+        # Smallest files first: under a short capture window most files finish instead of one large one
+        manifest = build_manifest(self.file_path, chunk_size=chunk_size, compression='auto', elide=True, order='size')
+        tiles = parse_layout(self.combo_tiles.currentText())
+        if tiles != (1, 1):
+            manifest['encoding']['tiles'] = list(tiles)  # the receiver splits captures by this
+        source = ChunkSource(manifest, self.file_path)
+        if self.key:
+            manifest['encryption'] = encryption_info(self.key)
+            source = EncryptedSource(source, ChunkCipher(self.key, manifest['session_id']))
+        self.load_transfer(manifest, source, tiles, os.path.basename(self.file_path))
+
+    def load_transfer(self, manifest, source, tiles, name):
+        """Show a prepared transfer: manifest QR codes, then data frames in schedule order."""
+        if isinstance(self.source, FrameArchive):
+            self.source.close()
+        self.frames = []
+        self.qr_frames = []
+        self.frame_intervals = None
+        self.manifest = manifest
+        self.btn_save_archive.setEnabled(not isinstance(source, FrameArchive))
+
         # Update metadata
-        size_bytes = os.path.getsize(self.file_path)
-        self.lbl_filename.setText(f"File: {os.path.basename(self.file_path)}")
-        self.lbl_size.setText(f"Size: {size_bytes} bytes")
-        
-        # 1. Manifest & QR
-        # We must use FRAME_PAYLOAD_SIZE as chunk_size so the manifest total_chunks matches the number of frames we generate
-        manifest = build_manifest(self.file_path, chunk_size=FRAME_PAYLOAD_SIZE)
+        n_files = len(manifest['files'])
+        self.lbl_filename.setText(f"File: {name}" if n_files == 1 else f"Folder: {name} ({n_files} files)")
+        self.lbl_size.setText(f"Size: {manifest['total_size']} bytes")
+
         for idx, qr in manifest_to_qr_frames(manifest):
             # Convert segno QR to PIL Image
             import io
@@ -129,31 +352,25 @@ class SenderApp(QMainWindow):
             buff.seek(0)
             from PIL import Image
             img = Image.open(buff)
-            self.frames.append(img)
+            self.qr_frames.append(img)
             
-        # 2. Data Grid Frames
-        frame_seq = 0
-        with open(self.file_path, 'rb') as f:
-            while True:
-                data = f.read(FRAME_PAYLOAD_SIZE)
-                if not data:
-                    break
-                img = encode_grid_frame(data, seq=frame_seq, chunk_idx=frame_seq)
-                # No need to pre-scale here, we scale in next_frame to fit window
-                self.frames.append(img)
-                frame_seq += 1
+        # Data Grid Frames (all files as one continuous chunk stream, cols x rows chunks per frame),
+        # rendered from the source as the scheduler reaches them. Missing ranges typed in for the
+        # previous transfer no longer apply
+        self.source, self.tiles = source, tiles
+        self.data_shown = 0
+        self.edit_missing.clear()
+        self.make_schedule()
 
-        self.lbl_total_frames.setText(f"Total Frames: {len(self.frames)}")
-        self.progress.setMaximum(len(self.frames))
-        
         # Show first frame immediately (QR)
-        if self.frames:
-            self.current_frame_idx = 0
-            self.next_frame() # Displays frame 0, increments idx to 1
+        self.next_frame()
+
+    def has_frames(self):
+        return bool(self.frames) or self.schedule is not None
 
     @Slot()
     def start_transfer(self):
-        if not self.frames:
+        if not self.has_frames():
             return
             
         if self.is_running:
@@ -161,24 +378,29 @@ class SenderApp(QMainWindow):
             self.btn_start.setText("Resume Transfer")
             self.is_running = False
         else:
-            fps = self.slider_fps.value()
-            self.timer.start(1000 // fps)
+            self.timer.start(self.frame_interval(self.current_frame_idx))
             self.btn_start.setText("Pause Transfer")
             self.is_running = True
 
     @Slot()
     def prev_frame(self):
-        if not self.frames: return
+        if not self.has_frames(): return
         # Pause if running
         if self.is_running:
             self.start_transfer() # Toggles to pause
-            
+
+        if self.schedule is not None:
+            # Step back through what was shown; next_frame replays forward from there
+            if self.history_pos > 0:
+                self.history_pos -= 1
+                self.show_slot(self.history[self.history_pos])
+            return
         self.current_frame_idx = (self.current_frame_idx - 1 + len(self.frames)) % len(self.frames)
         self.display_current_frame()
 
     @Slot()
     def manual_next_frame(self):
-        if not self.frames: return
+        if not self.has_frames(): return
         # Pause if running
         if self.is_running:
             self.start_transfer() # Toggles to pause
@@ -186,28 +408,31 @@ class SenderApp(QMainWindow):
 
     @Slot()
     def go_to_first_frame(self):
-        if not self.frames: return
+        if not self.has_frames(): return
         # Pause if running
         if self.is_running:
             self.start_transfer() # Toggles to pause
+        if self.schedule is not None:
+            self.restart_schedule()
+            self.next_frame()
+            return
         self.current_frame_idx = 0
         self.display_current_frame()
 
     @Slot()
     def go_to_last_frame(self):
-        if not self.frames: return
+        if not self.has_frames(): return
         # Pause if running
         if self.is_running:
             self.start_transfer() # Toggles to pause
+        if self.schedule is not None:
+            if self.schedule.frame_count:
+                self.show_slot(('data', self.schedule.frame_count - 1))
+            return
         self.current_frame_idx = len(self.frames) - 1
         self.display_current_frame()
 
-    def display_current_frame(self):
-        if self.current_frame_idx >= len(self.frames):
-            self.current_frame_idx = 0
-            
-        pil_img = self.frames[self.current_frame_idx]
-        
+    def show_image(self, pil_img):
         # Convert PIL to QPixmap
         data = pil_img.convert("RGBA").tobytes("raw", "RGBA")
         qimg = QImage(data, pil_img.width, pil_img.height, QImage.Format_RGBA8888)
@@ -216,6 +441,12 @@ class SenderApp(QMainWindow):
         # Scale to fit label
         scaled_pixmap = pixmap.scaled(self.lbl_display.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.lbl_display.setPixmap(scaled_pixmap)
+
+    def display_current_frame(self):
+        if self.current_frame_idx >= len(self.frames):
+            self.current_frame_idx = 0
+            
+        self.show_image(self.frames[self.current_frame_idx])
         self.progress.setValue(self.current_frame_idx + 1)
         self.lbl_counter.setText(f"Frame: {self.current_frame_idx + 1}/{len(self.frames)}")
         
@@ -233,29 +464,50 @@ class SenderApp(QMainWindow):
         else:
             super().keyPressEvent(event)
 
+    def restart_schedule(self):
+        self.slots = self.schedule.slots()
+        self.history = []
+        self.history_pos = -1
+
+    def show_slot(self, slot):
+        """Display one scheduler slot; data frames are rendered now, with the phase of their display position."""
+        kind, idx = slot
+        if kind == 'qr':
+            self.show_image(self.qr_frames[idx])
+            self.lbl_counter.setText(f"Manifest QR {idx + 1}/{len(self.qr_frames)}")
+            return
+        arr = render_frame(self.source, idx, self.tiles, self.data_shown & 1)
+        self.data_shown += 1
+        self.show_image(Image.fromarray(arr))
+        cycle_len = len(self.schedule.cycle_frames)
+        self.progress.setMaximum(cycle_len)
+        self.progress.setValue(min(self.schedule.position + 1, cycle_len))
+        self.lbl_counter.setText(f"Cycle {self.schedule.cycle + 1}  Frame: {idx + 1}/{self.schedule.frame_count}")
+
     def next_frame(self):
+        if self.schedule is not None:
+            if self.history_pos < len(self.history) - 1:
+                self.history_pos += 1  # replaying after stepping back
+            else:
+                self.history.append(next(self.slots))
+                if len(self.history) > HISTORY_FRAMES:
+                    del self.history[0]
+                self.history_pos = len(self.history) - 1
+            self.show_slot(self.history[self.history_pos])
+            self.timer.setInterval(self.frame_interval(0))
+            return
+
         if self.current_frame_idx >= len(self.frames):
             self.current_frame_idx = 0  # Loop or stop? Let's loop for now
             
-        pil_img = self.frames[self.current_frame_idx]
-        
-        # Convert PIL to QPixmap
-        data = pil_img.convert("RGBA").tobytes("raw", "RGBA")
-        qimg = QImage(data, pil_img.width, pil_img.height, QImage.Format_RGBA8888)
-        pixmap = QPixmap.fromImage(qimg)
-        
-        # Scale to fit label
-        scaled_pixmap = pixmap.scaled(self.lbl_display.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.lbl_display.setPixmap(scaled_pixmap)
+        self.show_image(self.frames[self.current_frame_idx])
         self.progress.setValue(self.current_frame_idx + 1)
         self.lbl_counter.setText(f"Frame: {self.current_frame_idx + 1}/{len(self.frames)}")
         
-        self.current_frame_idx += 1
+        # Update timer if FPS changed (calibration frames carry their own timing)
+        self.timer.setInterval(self.frame_interval(self.current_frame_idx))
 
-        
-        # Update timer if FPS changed
-        fps = self.slider_fps.value()
-        self.timer.setInterval(1000 // fps)
+        self.current_frame_idx += 1
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
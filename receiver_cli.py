@@ -1,64 +1,364 @@
-import argparse, os, json, glob
-from file_transfer.core.decoding_grid import decode_grid_frame
+import argparse, os, json, glob, time
+from PIL import Image
+from file_transfer.core.assembly import FileAssembler
+from file_transfer.core.compression import parallel_map
+from file_transfer.core.combining import SoftCombiner, soft_evidence
+from file_transfer.core.decoding_grid import PaletteLUT
+from file_transfer.core.encoding_qr import ManifestCollector
+from file_transfer.core.profiling import PROFILER
+from file_transfer.core.security import ChunkCipher, load_key
+from file_transfer.core.tiling import decode_mosaic, detect_layout, manifest_layout, parse_layout
+
+CHECKPOINT_EVERY = 256  # chunks written between resume checkpoints
+MAX_PENDING_CHUNKS = 4096  # chunks buffered while the manifest QR is still incomplete
+
+
+def parse_corners(text):
+    """'x1,y1,x2,y2,x3,y3,x4,y4' (normalized, TL TR BR BL) -> [(x, y)] * 4."""
+    values = [float(v) for v in text.split(',')]
+    if len(values) != 8:
+        raise argparse.ArgumentTypeError('--corners needs 8 comma-separated values')
+    return list(zip(values[0::2], values[1::2]))
+
+
+class ChunkWriter:
+    """Feed decoded chunks to a FileAssembler, checkpointing every CHECKPOINT_EVERY new chunks.
+
+    With a cipher, each chunk's tag is verified and the chunk decrypted
+    first; chunks that fail are dropped and counted in rejected. Each file
+    is verified as soon as its last chunk is written; one that fails its
+    digest is received again.
+    """
+
+    def __init__(self, assembler, cipher=None):
+        self.assembler = assembler
+        self.cipher = cipher
+        self.written = 0
+        self.rejected = 0
+        self.finish_files()  # files a resumed run had already completed
+
+    def write(self, chunk_idx, payload):
+        if self.cipher is not None:
+            with PROFILER.stage('decrypt'):
+                payload = self.cipher.decrypt(chunk_idx, payload)
+            if payload is None:
+                self.rejected += 1
+                return
+        with PROFILER.stage('write'):
+            new = self.assembler.write_chunk(chunk_idx, payload)
+        if new:
+            self.written += 1
+            self.finish_files()
+            if self.written % CHECKPOINT_EVERY == 0:
+                self.assembler.checkpoint()
+
+    def finish_files(self):
+        for fi in self.assembler.completed_files():
+            with PROFILER.stage('verify'):
+                ok = self.assembler.check_file(fi)
+            path = self.assembler.files[fi]['path']
+            if ok is False:
+                print(f"  {path}: HASH MISMATCH, receiving it again")
+            else:
+                print(f"  {path}: complete{'' if ok is None else ', verified'}")
+
+
+def open_assembler(manifest, out_dir, resume):
+    assembler = FileAssembler(manifest, out_dir, resume=resume)
+    if len(assembler.received):
+        print(f"Resuming: {len(assembler.received)} of {assembler.total_chunks} chunks already received")
+    return assembler
+
+
+def open_cipher(manifest, key):
+    """ChunkCipher for an encrypted manifest, None for a plain one; exits if the key is missing or wrong."""
+    try:
+        cipher = ChunkCipher.for_manifest(manifest, key)
+    except ValueError as e:
+        raise SystemExit(f"{e} (--key)")
+    if cipher is not None:
+        print(f"Decrypting chunks with {manifest['encryption']['algo']} (key {manifest['encryption']['key_id']})")
+    return cipher
+
+
+def finish(assembler, manifest, out_dir, writer=None):
+    """Report what is missing, or verify the reconstructed files; closes the assembler."""
+    if writer is not None and writer.rejected:
+        print(f"Dropped {writer.rejected} chunk(s) that failed authentication")
+    with assembler:
+        if not assembler.is_complete():
+            missing = assembler.total_chunks - len(assembler.received)
+            ranges = ', '.join(f"{a}-{b - 1}" for a, b in assembler.missing_ranges(limit=10))
+            print(f"Missing {missing} of {assembler.total_chunks} chunks (first ranges: {ranges})")
+            print(f"Progress saved; run again with more frames to resume into {out_dir}")
+            return
+        for path, ok in assembler.verify().items():
+            status = 'OK' if ok else ('UNVERIFIED' if ok is None else 'HASH MISMATCH')
+            print(f"  {path}: {status}")
+    print(f"Reconstructed {len(manifest['files'])} file(s) under {out_dir}")
+
+
+def save_by_seq(received_chunks, out_dir):
+    """No manifest: concatenate whatever was decoded in sequence order."""
+    if not received_chunks:
+        print("No valid data decoded.")
+        return
+    out_path = os.path.join(out_dir, "reconstructed_file.bin")
+    with open(out_path, 'wb') as f:
+        for seq in sorted(received_chunks):
+            f.write(received_chunks[seq])
+    print(f"Reconstructed file saved to {out_path}")
+
+
+def decode_frame_file(path, layout, combiner, workers=None, lut=None):
+    """Decoded (header, payload) tiles of one frame image; a layout of None is detected per frame.
+
+    Tiles that fail only their payload CRC go to combiner, and come back
+    once earlier captures of the same frame make up for them.
+    """
+    with PROFILER.stage('image_load'):
+        img = Image.open(path)
+        img.load()
+    if layout is None:
+        layout = detect_layout(img) or (1, 1)
+    diags = []
+    results = decode_mosaic(img, layout, workers=workers, diags=diags, lut=lut)
+    failed = sum(1 for r in results if r is None)
+    if failed and len(results) > 1:
+        print(f"Failed to decode {failed} of {len(results)} tiles in {os.path.basename(path)}")
+    elif failed:
+        print(f"Failed to decode {os.path.basename(path)}")
+    return combiner.collect([r for r in results if r], soft_evidence(diags))
+
+
+def report_combined(combiner):
+    if combiner.combined:
+        print(f"Recovered {combiner.combined} frame(s) by combining repeated captures")
+
+
+def receive_frames(args, manifest):
+    frame_files = sorted(glob.glob(os.path.join(args.frames, "frame_*.png")))
+    if not frame_files:
+        print("No grid frames found.")
+        return
+
+    print(f"Found {len(frame_files)} frames. Decoding...")
+    layout = args.tiles or manifest_layout(manifest)
+    combiner = SoftCombiner()
+
+    if manifest:
+        # Write each chunk straight into its file(s) under the output tree
+        cipher = open_cipher(manifest, args.key)
+        assembler = open_assembler(manifest, args.out, not args.no_resume)
+        writer = ChunkWriter(assembler, cipher)
+        for fp in frame_files:
+            for header, payload in decode_frame_file(fp, layout, combiner, args.workers, args.lut):
+                writer.write(header['chunk_idx'], payload)
+        report_combined(combiner)
+        finish(assembler, manifest, args.out, writer)
+        return
+
+    received_chunks = {}
+    for fp in frame_files:
+        for header, payload in decode_frame_file(fp, layout, combiner, args.workers, args.lut):
+            received_chunks[header['seq']] = payload
+    report_combined(combiner)
+    save_by_seq(received_chunks, args.out)
+
+
+def receive_video(args, manifest):
+    """Decode a recording or live capture device.
+
+    Reading, duplicate dropping, decoding and writing form a pipeline: a
+    reader thread pulls frames and drops repeated captures, a thread pool
+    decodes the distinct ones (grid first, manifest QR while it is still
+    missing) and this thread writes the results in capture order.
+    """
+    # OpenCV is only loaded in the modes that read video
+    from file_transfer.core.capture import open_capture, iter_capture, prefetch, decode_capture, FrameDeduper
+    cap = open_capture(args.video)
+    fps = cap.get(5) or 0  # cv2.CAP_PROP_FPS; 0 for most live devices
+    deduper = FrameDeduper(args.diff_threshold)
+    collector = ManifestCollector()
+    combiner = SoftCombiner()
+    state = {'manifest': manifest, 'layout': args.tiles or manifest_layout(manifest)}
+    assembler = writer = None
+    pending = {}  # seq -> (chunk_idx, payload) decoded before the manifest arrived
+    decoded = failed = 0
+
+    def start(m):
+        nonlocal assembler, writer
+        state['manifest'] = m
+        state['layout'] = args.tiles or manifest_layout(m)
+        cipher = open_cipher(m, args.key)
+        assembler = open_assembler(m, args.out, not args.no_resume)
+        writer = ChunkWriter(assembler, cipher)
+        for chunk_idx, payload in pending.values():
+            writer.write(chunk_idx, payload)
+        pending.clear()
+
+    if manifest:
+        start(manifest)
+
+    def work(frame):
+        return decode_capture(frame, args.corners, scan_qr=state['manifest'] is None, layout=state['layout'],
+                              lut=args.lut)
+
+    print(f"Decoding {args.video}...")
+    t0 = time.time()
+    frames = prefetch(deduper.filter(iter_capture(cap)))
+    try:
+        for result in parallel_map(work, frames, args.workers):
+            if result is None:
+                failed += 1
+            elif result[0] == 'grid':
+                _kind, direct, soft = result
+                if direct:
+                    decoded += 1
+                else:
+                    failed += 1  # counted as failed even if it completes a frame below
+                for header, payload in combiner.collect(direct, soft):
+                    if writer:
+                        writer.write(header['chunk_idx'], payload)
+                    elif len(pending) < MAX_PENDING_CHUNKS:
+                        pending[header['seq']] = (header['chunk_idx'], payload)
+            elif state['manifest'] is None:
+                for data in result[1]:
+                    m = collector.add(data)
+                    if m is None and collector.count > 1:
+                        got, total = collector.progress
+                        print(f"Manifest part {got}/{total}")
+                    if m is not None:
+                        print(f"Loaded manifest for session {m.get('session_id')} from QR")
+                        start(m)
+                        break
+    except KeyboardInterrupt:
+        print("Interrupted; saving progress")  # stopping a live device
+    finally:
+        cap.release()
+
+    elapsed = max(time.time() - t0, 1e-9)
+    speed = f", {deduper.seen / fps / elapsed:.1f}x real time" if fps > 0 else ''
+    print(f"Read {deduper.seen} frames in {elapsed:.1f} s ({deduper.seen / elapsed:.0f} fps{speed}): "
+          f"{deduper.dropped} repeated, {decoded} decoded, {failed} undecodable, "
+          f"{combiner.combined} recovered by combining")
+
+    if assembler:
+        finish(assembler, state['manifest'], args.out, writer)
+    else:
+        print("No manifest found; concatenating decoded frames in sequence order")
+        save_by_seq({seq: payload for seq, (_idx, payload) in pending.items()}, args.out)
+
+
+def calibrate_video(args):
+    """Measure a calibration sweep recording and recommend grid density, palette and FPS."""
+    import cv2
+    from file_transfer.core.capture import (open_capture, iter_capture, prefetch, scan_qr_codes,
+                                            pixel_corners, FrameDeduper)
+    from file_transfer.core.calibration import CalibrationAnalyzer, parse_plan
+    cap = open_capture(args.video)
+    deduper = FrameDeduper(args.diff_threshold)
+    state = {'analyzer': None}
+
+    def work(frame):
+        analyzer = state['analyzer']
+        if analyzer is None:
+            return 'qr', scan_qr_codes(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        h, w = frame.shape[:2]
+        return 'obs', analyzer.decode(frame, pixel_corners(args.corners, w, h), channel_order='BGR')
+
+    print(f"Calibrating from {args.video}...")
+    try:
+        for kind, value in parallel_map(work, prefetch(deduper.filter(iter_capture(cap))), args.workers):
+            analyzer = state['analyzer']
+            if kind == 'qr':
+                for data in value:
+                    plan = parse_plan(data)
+                    if plan is not None and analyzer is None:
+                        state['analyzer'] = CalibrationAnalyzer(plan)
+                        print(f"Calibration plan: {len(plan['steps'])} steps")
+            elif analyzer is not None:
+                analyzer.add(value)
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        cap.release()
+
+    if state['analyzer'] is None:
+        print("No calibration plan QR found")
+        return
+    print(state['analyzer'].report())
+
 
 def main():
     ap = argparse.ArgumentParser(description="Hybrid optical receiver prototype")
-    ap.add_argument('--frames', required=True, help='Directory containing captured frames')
-    ap.add_argument('--out', required=True, help='Output directory for reconstructed files')
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument('--frames', help='Directory containing captured frames')
+    src.add_argument('--video', help='Video file or capture device index to decode')
+    ap.add_argument('--out', help='Output directory for reconstructed files')
+    ap.add_argument('--manifest', help='Manifest JSON (default: manifest.json in --frames, or the QR codes in --video)')
+    ap.add_argument('--corners', type=parse_corners,
+                    help='Grid corners as normalized x1,y1,...,x4,y4 (TL TR BR BL) for perspective correction')
+    ap.add_argument('--tiles', type=parse_layout, metavar='COLSxROWS',
+                    help='Grids per displayed frame (default: from the manifest, else detected per frame)')
+    ap.add_argument('--diff-threshold', type=float,
+                    help='Mean pixel difference below which a capture is dropped as a repeat (default: 3.0)')
+    ap.add_argument('--workers', type=int, default=None, help='Decoder threads (default: CPU count)')
+    ap.add_argument('--key', metavar='PATH', help='Key file of an encrypted transfer')
+    ap.add_argument('--no-lut', action='store_true',
+                    help='Classify cells by distance to every palette colour only, not by table lookup first')
+    ap.add_argument('--no-resume', action='store_true', help='Do not keep or use progress from earlier runs')
+    ap.add_argument('--calibrate', action='store_true',
+                    help='Analyze a calibration sweep (--video) and recommend density, palette and FPS')
+    ap.add_argument('--profile', nargs='?', const='', metavar='PATH',
+                    help='Time each pipeline stage and print a summary; with PATH also dump the stats there '
+                         'every --profile-interval seconds (*.prom: Prometheus text file, otherwise JSON lines)')
+    ap.add_argument('--profile-interval', type=float, default=10.0, help='Seconds between profile dumps')
     args = ap.parse_args()
-    
-    if not os.path.isdir(args.frames):
+
+    if args.frames and not os.path.isdir(args.frames):
         raise SystemExit('Frames directory not found')
-    
-    os.makedirs(args.out, exist_ok=True)
-    
-    # 1. Try to load manifest (simulating QR decode)
-    manifest_path = os.path.join(args.frames, 'manifest.json')
+    if args.calibrate and args.video is None:
+        ap.error('--calibrate needs --video')
+    if args.out is None and not args.calibrate:
+        ap.error('the following arguments are required: --out')
+    if args.key:
+        try:
+            args.key = load_key(args.key)
+        except (OSError, ValueError) as e:
+            ap.error(f'--key: {e}')
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    args.lut = None if args.no_lut else PaletteLUT()
+
+    # Try to load manifest (simulating QR decode)
+    manifest_path = args.manifest or (os.path.join(args.frames, 'manifest.json') if args.frames else None)
     manifest = None
-    if os.path.exists(manifest_path):
+    if manifest_path and os.path.exists(manifest_path):
         with open(manifest_path) as f:
             manifest = json.load(f)
         print(f"Loaded manifest for session {manifest.get('session_id')}")
-    
-    # 2. Decode grid frames
-    frame_files = sorted(glob.glob(os.path.join(args.frames, "frame_*.png")))
-    if not frame_files:
-        print("No grid frames found.")
-        return
 
-    received_chunks = {}
-    
-    print(f"Found {len(frame_files)} frames. Decoding...")
-    
-    for fp in frame_files:
-        result = decode_grid_frame(fp)
-        if result:
-            header, payload = result
-            seq = header['seq']
-            received_chunks[seq] = payload
+    profile_fmt = 'prom' if (args.profile or '').endswith('.prom') else 'jsonl'
+    if args.profile is not None:
+        PROFILER.enable()
+        if args.profile:
+            PROFILER.start_dump(args.profile, args.profile_interval, profile_fmt)
+
+    try:
+        if args.calibrate:
+            calibrate_video(args)
+        elif args.video is not None:
+            receive_video(args, manifest)
         else:
-            print(f"Failed to decode {os.path.basename(fp)}")
-            
-    # 3. Reassemble
-    sorted_seqs = sorted(received_chunks.keys())
-    if not sorted_seqs:
-        print("No valid data decoded.")
-        return
-        
-    # Determine output filename
-    out_filename = "reconstructed_file.bin"
-    if manifest and manifest.get('files'):
-        # Use the first file's name
-        out_filename = manifest['files'][0]['path']
-        
-    out_path = os.path.join(args.out, out_filename)
-    
-    with open(out_path, 'wb') as f:
-        for seq in sorted_seqs:
-            f.write(received_chunks[seq])
-            
-    print(f"Reconstructed file saved to {out_path}")
+            receive_frames(args, manifest)
+    finally:
+        if args.profile is not None:
+            PROFILER.stop_dump()
+            if args.profile:
+                PROFILER.dump(args.profile, profile_fmt)
+            print(PROFILER.summary())
 
 if __name__ == '__main__':
     main()
-
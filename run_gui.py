@@ -1,19 +1,20 @@
 import sys
 import argparse
-from PySide6.QtWidgets import QApplication
-from file_transfer.gui.sender_app import SenderApp
-from file_transfer.gui.receiver_app import ReceiverApp
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('mode', choices=['sender', 'receiver'], help='Mode to run')
     args = parser.parse_args()
-    
+
+    # Import only the window for this mode: the sender never needs OpenCV or a QR reader
+    from PySide6.QtWidgets import QApplication
     app = QApplication(sys.argv)
     
     if args.mode == 'sender':
+        from file_transfer.gui.sender_app import SenderApp
         window = SenderApp()
     else:
+        from file_transfer.gui.receiver_app import ReceiverApp
         window = ReceiverApp()
         
     window.show()
@@ -1,9 +1,21 @@
-import argparse, os
-from file_transfer.core.manifest import build_manifest, save_manifest
-from file_transfer.core.chunking import iter_file_chunks, DEFAULT_CHUNK_SIZE
+import argparse, json, os, sys, time
+from PIL import Image
+from file_transfer.core.manifest import build_manifest, changed_files, save_manifest, ORDERS
+from file_transfer.core.chunking import DEFAULT_CHUNK_SIZE, DEFAULT_DIGEST, DEFAULT_LEAF_SIZE, DIGEST_ALGOS, digest_size
+from file_transfer.core.compression import MODES
+from file_transfer.core.source import ChunkSource
+from file_transfer.core.security import ChunkCipher, EncryptedSource, TAG_SIZE, encryption_info, load_key
 from file_transfer.core.encoding_qr import manifest_to_qr_frames
-from file_transfer.core.encoding_grid import encode_grid_frame, FRAME_PAYLOAD_SIZE
+from file_transfer.core.encoding_grid import FRAME_PAYLOAD_SIZE, GRID_W, GRID_H, BITS_PER_SYMBOL
+from file_transfer.core.archive import FrameArchive, write_archive
 from file_transfer.core.fec import xor_parity
+from file_transfer.core.video import FORMATS, frame_size, iter_transfer_frames, open_sink, qr_to_array
+from file_transfer.core.tiling import iter_mosaics, mosaic_size, parse_layout, frame_count, render_frame, manifest_layout
+from file_transfer.core.carousel import SCHEDULERS, QR_EVERY, frames_for_chunks, lead_frames
+from file_transfer.core.linkstats import format_ranges, parse_ranges
+from file_transfer.core.calibration import build_plan, plan_to_qr, iter_calibration_frames, stream_rate
+
+DEFAULT_STREAM_NAMES = {'video': 'transfer.mkv', 'y4m': 'transfer.y4m', 'rgb24': 'transfer.rgb'}
 
 def write_qr_frames(manifest, out_dir):
     for idx, qr in manifest_to_qr_frames(manifest):
@@ -15,37 +27,235 @@ def write_qr_frames(manifest, out_dir):
                 f.write(qr)  # raw bytes fallback
 
 
-def write_grid_frames(path, out_dir):
+def write_grid_frames(source, out_dir, tiles=(1, 1), only=None):
+    """Encode a ChunkSource (all files as one continuous chunk stream), cols x rows chunks per frame.
+
+    With only (data frame indices), just those frames are written, under their usual names.
+    """
+    if only is not None:
+        for i, frame_idx in enumerate(only):
+            Image.fromarray(render_frame(source, frame_idx, tiles, i & 1)).save(
+                os.path.join(out_dir, f"frame_{frame_idx:05d}.png"))
+        print(f"Generated {len(only)} grid frames for the missing chunks.")
+        return
     frame_seq = 0
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(FRAME_PAYLOAD_SIZE)
-            if not data:
-                break
-            
-            # Encode frame
-            # Using frame_seq as chunk_idx for this transport-layer view
-            img = encode_grid_frame(data, seq=frame_seq, chunk_idx=frame_seq)
-            img.save(os.path.join(out_dir, f"frame_{frame_seq:05d}.png"))
-            frame_seq += 1
-            
+    # Every chunk is its own grid, so seq follows the global chunk order across tiles and frames
+    for frame in iter_mosaics(source, tiles):
+        Image.fromarray(frame).save(os.path.join(out_dir, f"frame_{frame_seq:05d}.png"))
+        frame_seq += 1
+
     print(f"Generated {frame_seq} grid frames.")
 
 
+def write_stream(manifest, source, fmt, path, fps, hold, qr_hold, tiles=(1, 1), schedule=None, cycles=1, log=print):
+    """Render the whole transfer (manifest QR frames first) into one video or raw stream,
+    or cycles cycles of a schedule's slots."""
+    width, height = mosaic_size(tiles)
+    sink = open_sink(fmt, path, width, height, fps)
+    count = 0
+    try:
+        for frame in iter_transfer_frames(manifest, source, fps=fps, hold=hold, qr_hold=qr_hold, tiles=tiles,
+                                          schedule=schedule, cycles=cycles):
+            sink.write(frame)
+            count += 1
+    finally:
+        sink.close()
+    log(f"Wrote {count} {width}x{height} frames at {fps} FPS ({count / fps:.1f} s) to {path}")
+
+
+def write_calibration_stream(fmt, path, qr_hold, log=print):
+    """Render the calibration sweep (plan QR first) into one stream at a rate every step divides."""
+    plan = build_plan()
+    fps = stream_rate(plan)
+    width, height = frame_size()
+    sink = open_sink(fmt, path, width, height, fps)
+    count = 0
+    try:
+        qr = qr_to_array(plan_to_qr(plan), width, height)
+        for _ in range(max(1, round(qr_hold * fps))):
+            sink.write(qr)
+            count += 1
+        for step, _seq, frame in iter_calibration_frames(plan, (width, height)):
+            for _ in range(fps // plan['steps'][step][3]):
+                sink.write(frame)
+                count += 1
+    finally:
+        sink.close()
+    log(f"Wrote {len(plan['steps'])}-step calibration sweep: {count} frames at {fps} FPS ({count / fps:.1f} s) to {path}")
+
+
+def report_goodput(manifest, log=print):
+    """Print source bytes carried per displayed data frame, with and without compression."""
+    total = manifest['total_size']
+    cols, rows = manifest['encoding'].get('tiles', (1, 1))
+    per_frame = cols * rows
+    frames = (manifest['total_chunks'] + per_frame - 1) // per_frame
+    chunk = manifest['chunk_size']
+    raw_frames = (total + chunk * per_frame - 1) // (chunk * per_frame)
+    if not frames:
+        return
+    log(f"Goodput: {total / frames:.0f} source bytes/frame over {frames} frames "
+          f"(uncompressed: {total / max(raw_frames, 1):.0f} bytes/frame over {raw_frames} frames, "
+          f"{raw_frames / frames:.2f}x fewer frames)")
+    dedup = manifest.get('dedup', {})
+    if dedup.get('enabled'):
+        log(f"Dedup: {len(manifest['blocks'])} unique blocks, {dedup['duplicate_bytes']} duplicate bytes not sent")
+    elide = manifest.get('elide', {})
+    if elide.get('filled_bytes'):
+        log(f"Elided: {elide['filled_bytes']} bytes of constant blocks recreated by the receiver, not sent")
+
 
 def main():
     ap = argparse.ArgumentParser(description="Hybrid optical sender prototype")
-    ap.add_argument('--input', required=True, help='File or folder to send')
+    ap.add_argument('--input', help='File or folder to send')
     ap.add_argument('--out', required=True, help='Output directory for frames')
+    ap.add_argument('--compress', choices=MODES, default='auto', help='Per-block compression before framing')
+    ap.add_argument('--block-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Source bytes per compression block')
+    ap.add_argument('--workers', type=int, default=None, help='Compression threads (default: CPU count)')
+    ap.add_argument('--dedup', action='store_true', help='Send identical blocks only once')
+    ap.add_argument('--cdc', action='store_true', help='Content-defined block boundaries (implies --dedup)')
+    ap.add_argument('--no-elide', dest='elide', action='store_false',
+                    help='Send constant blocks (e.g. the zeros of disk images) instead of recording them in the manifest')
+    ap.add_argument('--digest', choices=DIGEST_ALGOS, default=DEFAULT_DIGEST,
+                    help='Hash for file, block and Merkle digests (BLAKE2 is faster where SHA-256 has no CPU support)')
+    ap.add_argument('--digest-bytes', type=int, default=None,
+                    help='Digest length in bytes, at least 16 (default: the full length)')
+    ap.add_argument('--leaf-size', type=int, default=DEFAULT_LEAF_SIZE,
+                    help='Chunk stream bytes per Merkle leaf, independent of the frame payload size')
+    ap.add_argument('--order', choices=ORDERS, default='path',
+                    help='File order in the stream: sorted path, or size (smallest first, so small files finish early)')
+    ap.add_argument('--priority', action='append', default=[], metavar='PATTERN',
+                    help='Send files matching this glob (relative path, e.g. "docs/*.pdf") first and repeat them at the '
+                         'start of every cycle; may be given several times, earlier patterns first')
+    ap.add_argument('--format', choices=('png',) + FORMATS, default='png',
+                    help='png: one image per frame; video: lossless video file; y4m/rgb24: raw frame stream')
+    ap.add_argument('--stream', default=None, help='Output file for video/y4m/rgb24 ("-" for stdout with y4m/rgb24)')
+    ap.add_argument('--fps', type=float, default=10, help='Output frame rate for video/raw streams')
+    ap.add_argument('--hold', type=int, default=1, help='Output frames per data frame')
+    ap.add_argument('--qr-hold', type=float, default=2.0, help='Seconds each manifest QR frame is shown')
+    ap.add_argument('--tiles', type=parse_layout, default=(1, 1), metavar='COLSxROWS',
+                    help='Independent grids per displayed frame, e.g. 2x2 for a 4K display (default 1x1)')
+    ap.add_argument('--schedule', choices=SCHEDULERS, default='linear',
+                    help='Frame order for streams: linear (manifest, then every frame once per cycle) or carousel '
+                         '(manifest re-inserted every --qr-every frames, each cycle starting further on)')
+    ap.add_argument('--cycles', type=int, default=1, help='Times the schedule goes through the data frames (streams)')
+    ap.add_argument('--qr-every', type=int, default=None,
+                    help=f'Data frames between manifest repeats (carousel default {QR_EVERY}; 0: once per cycle)')
+    ap.add_argument('--missing', type=parse_ranges, metavar='RANGES',
+                    help='Only send the frames holding these chunks, e.g. "3-7, 12" as the receiver reports them')
+    ap.add_argument('--manifest', metavar='PATH',
+                    help='Reuse the manifest.json of an earlier run (same session, so receivers resume), e.g. with --missing')
+    ap.add_argument('--key', metavar='PATH',
+                    help='Encrypt every chunk with this 32-byte key file (created if missing; share it with the receiver)')
+    ap.add_argument('--save-archive', metavar='PATH',
+                    help='Also store the prepared transfer (manifest and frames as packed symbol maps) for --archive')
+    ap.add_argument('--archive', metavar='PATH',
+                    help='Send a transfer stored with --save-archive, without reading, compressing or sealing anything')
+    ap.add_argument('--calibrate', action='store_true',
+                    help='Write the calibration sweep (cell sizes, palettes, rates) instead of a transfer')
     args = ap.parse_args()
+    if args.calibrate and args.format == 'png':
+        ap.error('--calibrate needs --format video, y4m or rgb24 (the sweep is timed)')
+    if not args.calibrate and not args.input and not args.archive:
+        ap.error('--input or --archive is required')
+    if args.archive and (args.input or args.manifest or args.key):
+        ap.error('--archive already holds the manifest and the (sealed) frames; drop --input, --manifest and --key')
+    if args.cycles < 1:
+        ap.error('--cycles must be at least 1')
+    if args.leaf_size < 1:
+        ap.error('--leaf-size must be at least 1')
+    try:
+        digest_size(args.digest, args.digest_bytes)
+    except ValueError as e:
+        ap.error(f'--digest-bytes: {e}')
+    if args.stream == '-' and args.format not in ('y4m', 'rgb24'):
+        ap.error('--stream - needs --format y4m or rgb24')
+    # Keep stdout clean when frames are piped through it
+    log = (lambda *a: print(*a, file=sys.stderr)) if args.stream == '-' else print
+    started = time.perf_counter()
     os.makedirs(args.out, exist_ok=True)
-    manifest = build_manifest(args.input, chunk_size=FRAME_PAYLOAD_SIZE)
+    if args.calibrate:
+        path = args.stream or os.path.join(args.out, 'calibration' + os.path.splitext(DEFAULT_STREAM_NAMES[args.format])[1])
+        write_calibration_stream(args.format, path, args.qr_hold, log=log)
+        return
+    key = load_key(args.key, create=True) if args.key else None
+    if args.archive:
+        try:
+            archive = FrameArchive(args.archive)
+        except (OSError, ValueError) as e:
+            ap.error(f'--archive: {e}')
+        if (archive.grid_w, archive.grid_h, archive.bits_per_symbol) != (GRID_W, GRID_H, BITS_PER_SYMBOL):
+            ap.error(f'--archive holds {archive.grid_w}x{archive.grid_h} grids at {archive.bits_per_symbol} bits, '
+                     f'this sender renders {GRID_W}x{GRID_H} at {BITS_PER_SYMBOL}')
+        manifest = archive.manifest
+        args.tiles = manifest_layout(manifest)
+        log(f"Opened {args.archive}: {len(archive)} frames ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+    elif args.manifest:
+        with open(args.manifest, encoding='utf-8') as f:
+            manifest = json.load(f)
+        args.tiles = manifest_layout(manifest)
+        if key and not manifest['encryption'].get('enabled'):
+            ap.error('--key given, but the --manifest transfer is not encrypted')
+        try:
+            cipher = ChunkCipher.for_manifest(manifest, key)
+        except ValueError as e:
+            ap.error(f'--manifest: {e}')
+        if cipher:
+            # The session's nonces are fixed per chunk index: sealing other plaintext under them would reuse them
+            changed = changed_files(manifest, args.input)
+            if changed:
+                ap.error(f"--manifest: {len(changed)} file(s) of the encrypted session differ from --input "
+                         f"(first: {changed[0]}); resending them would reuse nonces. Send without --manifest "
+                         f"to start a new session")
+    else:
+        # Each sealed chunk grows by the AEAD tag, so chunks shrink to keep one per frame
+        chunk_size = FRAME_PAYLOAD_SIZE - TAG_SIZE if key else FRAME_PAYLOAD_SIZE
+        manifest = build_manifest(args.input, chunk_size=chunk_size, compression=args.compress,
+                                  block_size=args.block_size, workers=args.workers,
+                                  chunking='cdc' if args.cdc else 'fixed', dedup=args.dedup or args.cdc,
+                                  elide=args.elide, digest=args.digest, digest_bytes=args.digest_bytes,
+                                  leaf_size=args.leaf_size, order=args.order, priority=args.priority)
+        if args.tiles != (1, 1):
+            manifest['encoding']['tiles'] = list(args.tiles)
+        if key:
+            manifest['encryption'] = encryption_info(key)
+        cipher = ChunkCipher(key, manifest['session_id']) if key else None
     save_manifest(manifest, os.path.join(args.out, 'manifest.json'))
-    write_qr_frames(manifest, args.out)
-    # For prototype: if input is a file, create grid frames; if folder, skip for now
-    if os.path.isfile(args.input):
-        write_grid_frames(args.input, args.out)
-    print("Frames written to", args.out)
+    if args.archive:
+        source = archive
+    else:
+        source = ChunkSource(manifest, args.input, workers=args.workers)
+        if cipher:
+            source = EncryptedSource(source, cipher, workers=args.workers)
+            log(f"Encrypting chunks with {manifest['encryption']['algo']} (key {manifest['encryption']['key_id']})")
+    if args.save_archive:
+        size = write_archive(args.save_archive, manifest, source)
+        log(f"Saved frame archive {args.save_archive} ({size} bytes, {size / max(len(source), 1):.0f} per chunk)")
+    frames = frame_count(len(source), args.tiles)
+    lead = lead_frames(manifest.get('order', {}).get('lead_chunks', 0), args.tiles[0] * args.tiles[1], frames)
+    if lead:
+        log(f"Priority files fill the first {lead} of {frames} data frames")
+    only = None
+    if args.missing:
+        only = frames_for_chunks(args.missing, args.tiles[0] * args.tiles[1], frames)
+        log(f"Sending {len(only)} of {frames} data frames (chunks {format_ranges(args.missing)})")
+    if args.format == 'png':
+        write_qr_frames(manifest, args.out)
+        write_grid_frames(source, args.out, args.tiles, only)
+    else:
+        path = args.stream or os.path.join(args.out, DEFAULT_STREAM_NAMES[args.format])
+        schedule = None
+        if args.schedule != 'linear' or args.cycles > 1 or only is not None:
+            qr_count = len(list(manifest_to_qr_frames(manifest)))
+            options = {'lead': lead}
+            if args.qr_every is not None:
+                options['qr_every'] = args.qr_every
+            schedule = SCHEDULERS[args.schedule](qr_count, frames, **options)
+            schedule.set_missing(only)
+        write_stream(manifest, source, args.format, path, args.fps, args.hold, args.qr_hold, args.tiles,
+                     schedule, args.cycles, log=log)
+    report_goodput(manifest, log=log)
+    log(f"Frames written to {args.out} in {time.perf_counter() - started:.1f} s")
 
 if __name__ == '__main__':
     main()